@@ -0,0 +1,377 @@
+## this file contains the offline benchmark suite for the dashboard hot paths
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import platform
+import tempfile
+import numpy as np
+import pandas as pd
+import h3
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+from s3_loader import S3ObjectCache
+from prediction_cache import MODEL_KEY
+from listings_store import LISTINGS_CSV_KEY, open_listings_store
+from hexagon_geojson import HEXAGON_GEOJSON_KEY, load_market_geojson
+from hexagon_features import add_h3_columns, add_median_features, build_hexagon_features
+from startup_profiler import MIN_REGRESSION_SECONDS, REGRESSION_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = 'benchmark-bucket'
+
+# Centers of the synthetic markets; listings are spread around them
+MARKET_CENTERS = {
+    'albany': (42.65, -73.75),
+    'chicago': (41.88, -87.63),
+    'los-angeles': (34.05, -118.24),
+    'new-york-city': (40.71, -74.0),
+    'san-francisco': (37.77, -122.42),
+    'seattle': (47.6, -122.33),
+    'washington-dc': (38.9, -77.03)
+}
+
+ROOM_TYPES = ['Entire home/apt', 'Hotel room', 'Private room', 'Shared room']
+
+# Market the per-market benchmarks run on
+BENCHMARK_MARKET = 'new-york-city'
+
+DEFAULT_LISTINGS = 20_000
+DEFAULT_REVIEWS = 2_000
+DEFAULT_ESTIMATORS = 50
+DEFAULT_REPEATS = 5
+
+REVIEW_WORDS = ['the', 'place', 'was', 'great', 'clean', 'host', 'very', 'helpful', 'location', 'noisy', 'bed',
+                'comfortable', 'would', 'stay', 'again', 'not', 'recommend', 'dirty', 'amazing', 'walking',
+                'distance', 'restaurants', 'quiet', 'small', 'bathroom', 'kitchen', 'checked', 'in', 'easily', '!']
+
+_cell_to_boundary = h3.cell_to_boundary if hasattr(h3, 'cell_to_boundary') else h3.h3_to_geo_boundary
+
+
+class LocalS3Client:
+    """
+    Stand-in for the boto3 S3 client that serves objects from a local directory.
+
+    Implements what S3ObjectCache uses (get_object with If-None-Match, head_object) plus
+    put_object and upload_file, so the benchmarks exercise the real caching code with no network.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _etag(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def _missing(self, operation, key):
+        return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key},
+                            'ResponseMetadata': {'HTTPStatusCode': 404}}, operation)
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body if isinstance(Body, bytes) else Body.read())
+        return {'ETag': f'"{self._etag(path)}"'}
+
+    def upload_file(self, Filename, Bucket, Key):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise self._missing('HeadObject', Key)
+        return {'ETag': f'"{self._etag(path)}"', 'ContentLength': os.path.getsize(path)}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise self._missing('GetObject', Key)
+        etag = self._etag(path)
+        if IfNoneMatch is not None and IfNoneMatch.strip('"') == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'},
+                               'ResponseMetadata': {'HTTPStatusCode': 304}}, 'GetObject')
+        size = os.path.getsize(path)
+        return {'ETag': f'"{etag}"', 'ContentLength': size, 'Body': StreamingBody(open(path, 'rb'), size)}
+
+
+def synthetic_listings(n=DEFAULT_LISTINGS, seed=0):
+    """
+    Generates listings_cleaned_h3-like data and its hexagon_data.
+
+    Returns:
+        tuple: (listings, hexagon_data) DataFrames.
+    """
+    rng = np.random.default_rng(seed)
+    markets = rng.choice(list(MARKET_CENTERS), n)
+    centers = np.array([MARKET_CENTERS[market] for market in markets])
+
+    listings = pd.DataFrame({
+        'id': np.arange(n),
+        'market': markets,
+        'room_type': rng.choice(ROOM_TYPES, n),
+        'accommodates': rng.integers(1, 9, n).astype(float),
+        'bathrooms': rng.integers(1, 4, n).astype(float),
+        'beds': rng.integers(1, 6, n).astype(float),
+        'latitude': centers[:, 0] + rng.normal(0, 0.06, n),
+        'longitude': centers[:, 1] + rng.normal(0, 0.06, n)
+    })
+    listings['price'] = (40 + 25 * listings['accommodates'] + 15 * listings['bathrooms'] + rng.gamma(2, 15, n)).round()
+
+    add_h3_columns(listings)
+    hexagon_data = build_hexagon_features(listings).drop(columns=['listing_count'])
+    return add_median_features(listings, hexagon_data), hexagon_data
+
+
+def synthetic_geojson(hexagon_data):
+    """
+    Builds hexagon_data.geojson for the given hexagons.
+    """
+    features = []
+    for record in hexagon_data.to_dict('records'):
+        ring = [[lng, lat] for lat, lng in _cell_to_boundary(record['h3_index'])]
+        features.append({
+            'type': 'Feature',
+            'properties': record,
+            'geometry': {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def synthetic_pipeline(listings, n_estimators=DEFAULT_ESTIMATORS, seed=0):
+    """
+    Trains a pipeline shaped like model_h3.joblib (scaler and one-hot encoder into a random forest).
+    """
+    from sklearn.compose import ColumnTransformer
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    numerical_features = ['accommodates', 'bathrooms', 'beds', 'accommodates_median', 'bathrooms_median',
+                          'beds_median', 'price_median']
+    preprocessor = ColumnTransformer(transformers=[
+        ('num', StandardScaler(), numerical_features),
+        ('cat', OneHotEncoder(), ['market', 'room_type'])
+    ])
+    pipeline = Pipeline(steps=[
+        ('preprocessor', preprocessor),
+        ('model', RandomForestRegressor(n_estimators=n_estimators, min_samples_leaf=2, n_jobs=-1, random_state=seed))
+    ])
+    features = listings.drop(columns=['id', 'price', 'latitude', 'longitude', 'h3_index'])
+    return pipeline.fit(features, listings['price'])
+
+
+def synthetic_reviews(n=DEFAULT_REVIEWS, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(5, 60, n)
+    comments = [' '.join(rng.choice(REVIEW_WORDS, length)) for length in lengths]
+    return pd.DataFrame({'id': np.arange(n), 'comments': comments})
+
+
+def build_fixtures(directory, listings_count=DEFAULT_LISTINGS, n_estimators=DEFAULT_ESTIMATORS, seed=0):
+    """
+    Writes the synthetic artifacts into a local bucket.
+
+    Returns:
+        dict: client (LocalS3Client), listings, hexagon_data and pipeline.
+    """
+    import joblib
+
+    client = LocalS3Client(os.path.join(directory, 'bucket'))
+    listings, hexagon_data = synthetic_listings(listings_count, seed)
+    pipeline = synthetic_pipeline(listings, n_estimators, seed)
+
+    model_bytes = io.BytesIO()
+    joblib.dump(pipeline, model_bytes)
+    client.put_object(Bucket=BUCKET_NAME, Key=MODEL_KEY, Body=model_bytes.getvalue())
+    client.put_object(Bucket=BUCKET_NAME, Key=LISTINGS_CSV_KEY, Body=listings.to_csv(index=False).encode())
+    client.put_object(Bucket=BUCKET_NAME, Key='models/hexagon_data.csv', Body=hexagon_data.to_csv(index=False).encode())
+    client.put_object(Bucket=BUCKET_NAME, Key=HEXAGON_GEOJSON_KEY,
+                      Body=json.dumps(synthetic_geojson(hexagon_data)).encode())
+
+    return {'client': client, 'listings': listings, 'hexagon_data': hexagon_data, 'pipeline': pipeline}
+
+
+def time_call(function, repeats=DEFAULT_REPEATS, setup=None):
+    """
+    Times a function.
+
+    Without a setup the function is called once untimed first, so warm benchmarks don't
+    include filling a cache.
+
+    Args:
+        function (callable): Called with setup's result, or with no arguments.
+        repeats (int, optional): Timed calls.
+        setup (callable, optional): Untimed call before each timed call, e.g. to empty a cache.
+
+    Returns:
+        dict: median, min and max seconds and the number of repeats.
+    """
+    if setup is None:
+        function()
+
+    seconds = []
+    for _ in range(repeats):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        function(state) if setup is not None else function()
+        seconds.append(time.perf_counter() - start)
+    return {'median': float(np.median(seconds)), 'min': min(seconds), 'max': max(seconds), 'repeats': repeats}
+
+
+def run_benchmarks(listings_count=DEFAULT_LISTINGS, reviews_count=DEFAULT_REVIEWS, n_estimators=DEFAULT_ESTIMATORS,
+                   repeats=DEFAULT_REPEATS, only=None):
+    """
+    Builds the fixtures in a temporary directory and times each hot path.
+
+    Cold benchmarks start from an empty local cache (download and any conversion included);
+    warm ones read what the previous run cached.
+
+    Args:
+        listings_count (int, optional): Synthetic listings.
+        reviews_count (int, optional): Synthetic reviews for the sentiment benchmark.
+        n_estimators (int, optional): Trees in the synthetic model.
+        repeats (int, optional): Timed runs per benchmark.
+        only (list, optional): Names of the benchmarks to run; all when None.
+
+    Returns:
+        dict: Benchmark name to timing (see time_call), or to {'skipped': reason}.
+    """
+    import joblib
+    from pricing import FastPricer
+    from map_cache import build_choropleth_map, render_map_html
+
+    directory = tempfile.mkdtemp(prefix='airbnb-benchmarks-')
+    try:
+        fixtures = build_fixtures(directory, listings_count, n_estimators)
+        client = fixtures['client']
+        cache_dir = os.path.join(directory, 'cache')
+
+        def cache(empty=False):
+            if empty:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            return S3ObjectCache(client=client, bucket_name=BUCKET_NAME, cache_dir=cache_dir)
+
+        warm_cache = cache()
+        store = open_listings_store(warm_cache, cache_dir)
+        market_listings = store.market(BENCHMARK_MARKET)
+        geojson_data = load_market_geojson(warm_cache, BENCHMARK_MARKET, cache_dir)
+        pipeline = joblib.load(warm_cache.get_path(MODEL_KEY))
+        pricer = FastPricer(pipeline)
+        features = market_listings.drop(columns=['id', 'price', 'latitude', 'longitude', 'h3_index'])
+        hexagon_prices = market_listings[['h3_index', 'price_median']].drop_duplicates('h3_index')
+        map_center = [market_listings['latitude'].mean(), market_listings['longitude'].mean()]
+
+        benchmarks = {
+            'load_model_cold': (lambda c: joblib.load(c.get_path(MODEL_KEY)), lambda: cache(empty=True)),
+            'load_model_warm': (lambda: joblib.load(warm_cache.get_path(MODEL_KEY)), None),
+            'load_listings_data_cold': (lambda c: open_listings_store(c, cache_dir), lambda: cache(empty=True)),
+            'load_listings_data_warm': (lambda: open_listings_store(warm_cache, cache_dir), None),
+            'load_geojson_data_cold': (lambda c: load_market_geojson(c, BENCHMARK_MARKET, cache_dir),
+                                       lambda: cache(empty=True)),
+            'load_geojson_data_warm': (lambda: load_market_geojson(warm_cache, BENCHMARK_MARKET, cache_dir), None),
+            'market_filter': (lambda: store.market(BENCHMARK_MARKET), None),
+            'pipeline_predict_market': (lambda: pipeline.predict(features), None),
+            'fast_pricer_predict_market': (lambda: pricer.predict(features), None),
+            'choropleth_build': (lambda: build_choropleth_map(geojson_data, hexagon_prices,
+                                                              ['h3_index', 'price_median'], 'Median Price',
+                                                              map_center), None),
+            'choropleth_render': (lambda: render_map_html(build_choropleth_map(
+                geojson_data, hexagon_prices, ['h3_index', 'price_median'], 'Median Price', map_center)), None),
+        }
+
+        results = {}
+        for name, (function, setup) in benchmarks.items():
+            if only and name not in only:
+                continue
+            results[name] = time_call(function, repeats, setup)
+            # Cold benchmarks replace the cache directory, so reopen it for the warm ones
+            warm_cache = cache()
+            print(f'{name}: {results[name]["median"]:.4f}s')
+
+        if not only or 'sentiment_clean_and_score' in only:
+            results['sentiment_clean_and_score'] = _benchmark_sentiment(reviews_count, repeats)
+            print(f'sentiment_clean_and_score: {results["sentiment_clean_and_score"]}')
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _benchmark_sentiment(reviews_count, repeats):
+    # clean_text + VADER over synthetic reviews; needs the NLTK data, which is downloaded separately
+    from sentiment_scoring import score_reviews, _clean_token
+
+    reviews = synthetic_reviews(reviews_count)
+    try:
+        score_reviews(reviews.head(1).copy())
+    except LookupError:
+        return {'skipped': 'NLTK data is missing, run sentiment_scoring.download_nltk_resources() first'}
+
+    # Start every run with an empty token cache so repeats measure the same work
+    return time_call(lambda df: score_reviews(df), repeats,
+                     setup=lambda: (_clean_token.cache_clear(), reviews.copy())[1])
+
+
+def compare_to_baseline(results, baseline, threshold=REGRESSION_THRESHOLD, min_seconds=MIN_REGRESSION_SECONDS):
+    """
+    Lists the benchmarks whose median got slower than in a baseline run.
+
+    Returns:
+        list: (name, baseline median, median) for every regression.
+    """
+    regressions = []
+    for name, timing in results.items():
+        before = baseline.get('results', {}).get(name, {}).get('median')
+        if before is None or 'median' not in timing:
+            continue
+        if timing['median'] > before * (1 + threshold) and timing['median'] - before >= min_seconds:
+            regressions.append((name, before, timing['median']))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+
+    logging.basicConfig(level=logging.WARNING)
+    # folium warns about the CartoDB tiles on every map built
+    warnings.filterwarnings('ignore', category=UserWarning, module='folium')
+
+    parser = argparse.ArgumentParser(description='Time the dashboard hot paths on synthetic data, offline')
+    parser.add_argument('--listings', type=int, default=DEFAULT_LISTINGS)
+    parser.add_argument('--reviews', type=int, default=DEFAULT_REVIEWS)
+    parser.add_argument('--estimators', type=int, default=DEFAULT_ESTIMATORS)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--only', nargs='+', help='Benchmarks to run')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Results of an earlier run to report regressions against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    output = {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'listings': args.listings, 'reviews': args.reviews, 'estimators': args.estimators},
+        'results': run_benchmarks(args.listings, args.reviews, args.estimators, args.repeats, args.only)
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(output['results'], json.load(f), args.threshold)
+        for name, before, seconds in regressions:
+            print(f'REGRESSION {name}: {before:.4f}s -> {seconds:.4f}s')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,318 @@
+## this file contains the compact, memory-mapped export of the H3 RandomForest and its vectorized inference engine
+import os
+import json
+import time
+import logging
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from pricing import FastPricer
+
+logger = logging.getLogger(__name__)
+
+COMPACT_MODEL_KEY = 'models/model_h3.forest.arrow'
+
+# Leaf values are stored as uint16 steps between the smallest and largest leaf
+LEAF_LEVELS = np.iinfo(np.uint16).max
+
+# Rows evaluated together; every step gathers n_trees * PREDICT_BATCH_SIZE nodes
+PREDICT_BATCH_SIZE = 4096
+
+
+def _float32_at_most(values):
+    # The largest float32 <= each value. sklearn compares float32 inputs against float64
+    # thresholds, and for a float32 x, x <= t exactly when x <= round_down_to_float32(t)
+    rounded = values.astype(np.float32)
+    too_large = rounded.astype(np.float64) > values
+    rounded[too_large] = np.nextafter(rounded[too_large], np.float32(-np.inf))
+    return rounded
+
+
+def pack_forest(forest, quantize_leaves=True):
+    """
+    Packs the trees of a fitted forest into one flat node table.
+
+    Nodes keep sklearn's depth-first order, so an internal node's left child is always the
+    next node and only the right child is stored. Leaves point right at themselves with a
+    NaN threshold, so a traversal step treats leaves and internal nodes alike.
+
+    Args:
+        forest (sklearn.ensemble.RandomForestRegressor): Fitted single-output forest.
+        quantize_leaves (bool, optional): Store leaves as uint16 levels instead of float32.
+
+    Returns:
+        tuple: (pa.Table of nodes, dict of metadata with roots, max_depth and leaf encoding).
+    """
+    if getattr(forest, 'n_outputs_', 1) != 1:
+        raise ValueError('Only single-output forests can be exported')
+
+    features, thresholds, rights, values, roots = [], [], [], [], []
+    max_depth = 0
+    offset = 0
+
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        node_ids = np.arange(n_nodes)
+        is_leaf = tree.children_left < 0
+
+        if (tree.children_left[~is_leaf] != node_ids[~is_leaf] + 1).any():
+            raise ValueError('Trees must be built depth first (max_leaf_nodes is not supported)')
+
+        features.append(np.where(is_leaf, 0, tree.feature).astype(np.int16))
+        thresholds.append(np.where(is_leaf, np.nan, _float32_at_most(tree.threshold)).astype(np.float32))
+        rights.append(np.where(is_leaf, node_ids, tree.children_right).astype(np.int32) + offset)
+        values.append(tree.value[:, 0, 0])
+        roots.append(offset)
+
+        max_depth = max(max_depth, int(tree.max_depth))
+        offset += n_nodes
+
+    values = np.concatenate(values)
+    metadata = {'roots': roots, 'max_depth': max_depth, 'n_trees': len(roots),
+                'n_features': int(forest.n_features_in_)}
+
+    if quantize_leaves:
+        low, high = float(values.min()), float(values.max())
+        step = (high - low) / LEAF_LEVELS if high > low else 1.0
+        leaf_values = np.round((values - low) / step).astype(np.uint16)
+        # Each tree's leaf is off by at most half a step, and so is their average
+        metadata['leaf_encoding'] = {'type': 'uint16', 'offset': low, 'step': step, 'max_error': step / 2}
+    else:
+        leaf_values = values.astype(np.float32)
+        metadata['leaf_encoding'] = {'type': 'float32'}
+
+    nodes = pa.table({
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'right': np.concatenate(rights),
+        'value': leaf_values
+    })
+    return nodes, metadata
+
+
+def export_forest(pipeline, path, model_version=None, quantize_leaves=True):
+    """
+    Writes the pipeline's forest and encoder parameters to one Arrow IPC file.
+
+    Args:
+        pipeline (sklearn.pipeline.Pipeline): Trained H3 pipeline.
+        path (str): Destination file.
+        model_version (str, optional): Version of the source model, e.g. the ETag of models/model_h3.joblib.
+        quantize_leaves (bool, optional): See pack_forest.
+
+    Returns:
+        dict: Metadata written with the node table.
+    """
+    pricer = FastPricer(pipeline)
+    nodes, metadata = pack_forest(pricer.model, quantize_leaves)
+    metadata['preprocessing'] = pricer.preprocessing_state()
+    metadata['model_version'] = model_version
+
+    if metadata['n_features'] != pricer.n_features:
+        raise ValueError(f'Forest expects {metadata["n_features"]} features, the encoders produce {pricer.n_features}')
+
+    nodes = nodes.replace_schema_metadata({b'forest': json.dumps(metadata).encode('utf-8')})
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with ipc.new_file(sink, nodes.schema) as writer:
+            writer.write_table(nodes)
+    os.replace(tmp_path, path)
+    return metadata
+
+
+class CompactForest:
+    """
+    Vectorized inference over a forest exported with export_forest.
+
+    The node table is memory mapped and its columns are used as NumPy views without a
+    copy, so opening a model costs a few page faults instead of unpickling every tree.
+    All trees advance one level per step for a whole batch of rows, and (tree, row) pairs
+    drop out of the batch once they reach a leaf.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._source = pa.memory_map(path, 'r')
+        nodes = ipc.open_file(self._source).read_all()
+
+        self.metadata = json.loads(nodes.schema.metadata[b'forest'])
+        self.roots = np.asarray(self.metadata['roots'], dtype=np.int32)
+        self.max_depth = self.metadata['max_depth']
+        self.n_features_in_ = self.metadata['n_features']
+        self.num_nodes = nodes.num_rows
+
+        # Zero-copy views into the memory map
+        self.feature = nodes.column('feature').chunk(0).to_numpy()
+        self.threshold = nodes.column('threshold').chunk(0).to_numpy()
+        self.right = nodes.column('right').chunk(0).to_numpy()
+        self.value = nodes.column('value').chunk(0).to_numpy()
+
+        encoding = self.metadata['leaf_encoding']
+        if encoding['type'] == 'uint16':
+            self._leaf_offset, self._leaf_step = encoding['offset'], encoding['step']
+        else:
+            self._leaf_offset, self._leaf_step = 0.0, 1.0
+
+    def apply(self, X):
+        """
+        Returns the leaf reached by every row in every tree, shape (n_trees, n_rows).
+        """
+        X = np.asarray(X, dtype=np.float32)
+        n_rows = len(X)
+        nodes = np.repeat(self.roots, n_rows)
+        rows = np.tile(np.arange(n_rows), len(self.roots))
+
+        # Only (tree, row) pairs that have not reached a leaf take another step
+        active = np.flatnonzero(self.right[nodes] != nodes)
+        for _ in range(self.max_depth):
+            if not active.size:
+                break
+            current = nodes[active]
+            go_left = X[rows[active], self.feature[current]] <= self.threshold[current]
+            current = np.where(go_left, current + 1, self.right[current])
+            nodes[active] = current
+            active = active[self.right[current] != current]
+        return nodes.reshape(len(self.roots), n_rows)
+
+    def predict(self, X, batch_size=PREDICT_BATCH_SIZE):
+        """
+        Averages the trees' leaf values for each row, like RandomForestRegressor.predict.
+
+        Args:
+            X (np.ndarray): Encoded features of shape (n_rows, n_features).
+            batch_size (int, optional): Rows evaluated together.
+
+        Returns:
+            np.ndarray: Prediction for each row.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        predictions = np.empty(len(X))
+        for start in range(0, len(X), batch_size):
+            leaves = self.apply(X[start:start + batch_size])
+            predictions[start:start + batch_size] = self.value[leaves].mean(axis=0, dtype=np.float64)
+        return self._leaf_offset + self._leaf_step * predictions
+
+
+def load_compact_pricer(path, model_version=None):
+    """
+    Opens an exported forest as a pricing.FastPricer, a drop-in for FastPricer(pipeline).
+
+    Args:
+        path (str): Exported forest.
+        model_version (str, optional): Expected source model version; None skips the check.
+
+    Returns:
+        pricing.FastPricer or None: Pricer, or None when the file was exported from another model version.
+    """
+    forest = CompactForest(path)
+    if model_version is not None and forest.metadata.get('model_version') != model_version:
+        logger.info(f'{path} was exported from model {forest.metadata.get("model_version")}, not {model_version}')
+        return None
+    return FastPricer.from_state(forest.metadata['preprocessing'], forest)
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _measure_load(kind, path):
+    # Runs in a fresh process so neither loader benefits from the other's imports or pages
+    import joblib
+
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    model = joblib.load(path) if kind == 'joblib' else load_compact_pricer(path)
+    return {'load_seconds': time.perf_counter() - start, 'rss_bytes': _rss_bytes() - rss_before,
+            'type': type(model).__name__}
+
+
+def benchmark(pipeline, joblib_path, compact_path, specs, market_stats=None, repeats=20):
+    """
+    Compares the joblib pipeline with the compact forest.
+
+    Args:
+        pipeline (sklearn.pipeline.Pipeline): Trained H3 pipeline, loaded from joblib_path.
+        joblib_path (str): Pickled pipeline.
+        compact_path (str): Exported forest.
+        specs (pd.DataFrame): Listing specs used for predict latency, see pricing.join_market_medians.
+        market_stats (pd.DataFrame, optional): Median features indexed by market.
+        repeats (int, optional): Timed repetitions of each predict.
+
+    Returns:
+        dict: File sizes, cold load time and RSS growth, median predict latency for one row and
+            for the whole batch, and the largest difference between the predictions.
+    """
+    import multiprocessing
+    from pricing import price_listings
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        joblib_load = pool.apply(_measure_load, ('joblib', joblib_path))
+    with context.Pool(1) as pool:
+        compact_load = pool.apply(_measure_load, ('compact', compact_path))
+
+    compact = load_compact_pricer(compact_path)
+
+    def latency(predict, batch):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            predict(batch)
+            times.append(time.perf_counter() - start)
+        return float(np.median(times))
+
+    one_row = specs.iloc[:1]
+    results = {
+        'joblib': {
+            'file_bytes': os.path.getsize(joblib_path), **joblib_load,
+            'predict_1_seconds': latency(lambda batch: price_listings(pipeline, batch, market_stats), one_row),
+            'predict_batch_seconds': latency(lambda batch: price_listings(pipeline, batch, market_stats), specs)
+        },
+        'compact': {
+            'file_bytes': os.path.getsize(compact_path), **compact_load,
+            'predict_1_seconds': latency(lambda batch: compact.predict(batch, market_stats), one_row),
+            'predict_batch_seconds': latency(lambda batch: compact.predict(batch, market_stats), specs)
+        },
+        'batch_rows': len(specs),
+        'max_abs_difference': float(np.abs(price_listings(pipeline, specs, market_stats)
+                                           - compact.predict(specs, market_stats)).max())
+    }
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import joblib
+    from s3_loader import CACHE_DIR, S3ObjectCache
+    from prediction_cache import MODEL_KEY
+    from listings_store import open_listings_store
+
+    parser = argparse.ArgumentParser(description='Export the H3 RandomForest to a compact memory-mapped file')
+    parser.add_argument('--bucket', default='airbnb-capstone-project')
+    parser.add_argument('--output', default=os.path.join(CACHE_DIR, 'model_h3.forest.arrow'))
+    parser.add_argument('--float-leaves', action='store_true', help='Store leaves as float32 instead of uint16')
+    parser.add_argument('--upload', action='store_true', help=f'Upload the file to {COMPACT_MODEL_KEY}')
+    parser.add_argument('--benchmark', action='store_true', help='Compare load time, RSS and latency with joblib')
+    parser.add_argument('--sample', type=int, default=1000, help='Listings used for the benchmark batch')
+    args = parser.parse_args()
+
+    object_cache = S3ObjectCache(bucket_name=args.bucket)
+    model = object_cache.fetch(MODEL_KEY)
+    pipeline = joblib.load(model.path)
+
+    metadata = export_forest(pipeline, args.output, model_version=model.etag, quantize_leaves=not args.float_leaves)
+    print(f'Exported {metadata["n_trees"]} trees (max depth {metadata["max_depth"]}) to {args.output}: '
+          f'{os.path.getsize(args.output) / 1e6:.1f} MB, joblib {os.path.getsize(model.path) / 1e6:.1f} MB')
+
+    if args.benchmark:
+        listings = open_listings_store(object_cache).to_pandas().sample(args.sample, random_state=42)
+        print(json.dumps(benchmark(pipeline, model.path, args.output, listings), indent=4))
+
+    if args.upload:
+        object_cache.client.upload_file(args.output, args.bucket, COMPACT_MODEL_KEY)
+        print(f'Uploaded to s3://{args.bucket}/{COMPACT_MODEL_KEY}')
@@ -1,7 +1,17 @@
 ## this file contains helper funtions that are used in mutliple notebooks
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import snowflake.connector
 import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 from snowflake.connector.pandas_tools import write_pandas
@@ -11,51 +21,289 @@ import logging
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
-def connect_to_snowflake(schema_name=None):
-    # Load environment variables from a .env file
-    load_dotenv()
+# Connection pool defaults, overridable per pool
+SNOWFLAKE_POOL_SIZE = int(os.getenv('SNOWFLAKE_POOL_SIZE', '4'))
+SNOWFLAKE_POOL_IDLE_TIMEOUT = 600
+SNOWFLAKE_POOL_HEALTH_CHECK_AFTER = 60
+
+# bulk_write_to_snowflake defaults: rows per Parquet file, threads writing them and threads uploading them
+BULK_CHUNK_ROWS = 250_000
+BULK_WORKERS = min(4, os.cpu_count() or 1)
+BULK_UPLOAD_THREADS = 8
+
+_env_loaded = False
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _snowflake_credentials():
+    global _env_loaded
+    if not _env_loaded:
+        # Load environment variables from a .env file
+        load_dotenv()
+        _env_loaded = True
+    return os.getenv('SNOWFLAKE_USER'), os.getenv('SNOWFLAKE_PWD'), os.getenv('SNOWFLAKE_ACCOUNT')
+
+
+def _open_connection(warehouse, database, schema_name):
+    SNOWFLAKE_USER, SNOWFLAKE_PASSWORD, SNOWFLAKE_ACCOUNT = _snowflake_credentials()
 
-    SNOWFLAKE_USER = os.getenv('SNOWFLAKE_USER')
-    SNOWFLAKE_PASSWORD = os.getenv('SNOWFLAKE_PWD')
-    SNOWFLAKE_ACCOUNT = os.getenv('SNOWFLAKE_ACCOUNT')
-    
     if not SNOWFLAKE_USER:
-        logger.error("Environment variable SNOWFLAKE_USER must be set")
-        return None
+        raise ValueError("Environment variable SNOWFLAKE_USER must be set")
     if not SNOWFLAKE_PASSWORD:
-        logger.error("Environment variable SNOWFLAKE_PWD must be set")
-        return None
+        raise ValueError("Environment variable SNOWFLAKE_PWD must be set")
+
+    return snowflake.connector.connect(
+        user=SNOWFLAKE_USER,
+        password=SNOWFLAKE_PASSWORD,
+        account=SNOWFLAKE_ACCOUNT,
+        warehouse=warehouse,
+        database=database,
+        schema=schema_name
+    )
 
+
+def connect_to_snowflake(schema_name=None):
     try:
-        conn = snowflake.connector.connect(
-            user=SNOWFLAKE_USER,
-            password=SNOWFLAKE_PASSWORD,
-            account=SNOWFLAKE_ACCOUNT,
-            warehouse='COMPUTE_WH',
-            database='AIRBNB',
-            schema=schema_name
-        )
+        conn = _open_connection('COMPUTE_WH', 'AIRBNB', schema_name)
 
         print(f'Successfully connected to Snowflake schema {schema_name}')
         return conn
 
+    except ValueError as e:
+        logger.error(e)
+        return None
+
     except snowflake.connector.errors.Error as e:
         logger.error(f'Failed to connect to Snowflake due to error: {e}')
         return None
 
 
+class SnowflakeConnectionPool:
+    """
+    Thread safe pool of Snowflake sessions for one (warehouse, database, schema).
+
+    Sessions are reused most recently used first, checked with SELECT 1 when they have
+    been idle longer than health_check_after seconds, and closed once idle longer than
+    idle_timeout. At most max_size sessions exist; acquire blocks until one is released.
+    """
+
+    def __init__(self, warehouse='COMPUTE_WH', database='AIRBNB', schema_name=None, max_size=SNOWFLAKE_POOL_SIZE,
+                 idle_timeout=SNOWFLAKE_POOL_IDLE_TIMEOUT, health_check_after=SNOWFLAKE_POOL_HEALTH_CHECK_AFTER,
+                 connect=None):
+        self.warehouse = warehouse
+        self.database = database
+        self.schema_name = schema_name
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self._connect = connect or (lambda: _open_connection(warehouse, database, schema_name))
+
+        self._idle = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self.stats = {'created': 0, 'reused': 0, 'discarded': 0, 'evicted': 0,
+                      'waits': 0, 'wait_seconds': 0.0, 'connect_seconds': 0.0}
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning(f'Failed to close Snowflake connection: {e}')
+
+    def _is_healthy(self, conn):
+        if conn.is_closed():
+            return False
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            return True
+        except snowflake.connector.errors.Error:
+            return False
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def _evict_idle(self, now):
+        # Called with the lock held; the oldest idle sessions are at the left
+        evicted = []
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            evicted.append(self._idle.popleft()[0])
+            self._size -= 1
+            self.stats['evicted'] += 1
+        return evicted
+
+    def acquire(self, timeout=None):
+        """
+        Takes a session from the pool, opening one if the pool is not full.
+
+        Args:
+            timeout (float, optional): Seconds to wait for a free session. Waits forever when None.
+
+        Returns:
+            snowflake.connector.SnowflakeConnection: Session to hand back with release.
+        """
+        start = time.perf_counter()
+        waited = False
+
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise RuntimeError('Connection pool is closed')
+
+                evicted = self._evict_idle(time.time())
+                conn, idle_since = None, None
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                elif self._size < self.max_size:
+                    # Reserve the slot before connecting outside the lock
+                    self._size += 1
+                else:
+                    if not waited:
+                        self.stats['waits'] += 1
+                        waited = True
+                    remaining = None if timeout is None else timeout - (time.perf_counter() - start)
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f'No Snowflake connection available after {timeout}s')
+                    self._condition.wait(remaining)
+                    continue
+
+            for evicted_conn in evicted:
+                self._close_quietly(evicted_conn)
+
+            if waited:
+                with self._condition:
+                    self.stats['wait_seconds'] += time.perf_counter() - start
+
+            if conn is not None:
+                if time.time() - idle_since <= self.health_check_after or self._is_healthy(conn):
+                    with self._condition:
+                        self.stats['reused'] += 1
+                    return conn
+                self._discard(conn)
+                continue
+
+            connect_start = time.perf_counter()
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self.stats['created'] += 1
+                self.stats['connect_seconds'] += time.perf_counter() - connect_start
+            return conn
+
+    def _discard(self, conn):
+        self._close_quietly(conn)
+        with self._condition:
+            self._size -= 1
+            self.stats['discarded'] += 1
+            self._condition.notify()
+
+    def release(self, conn, discard=False):
+        """
+        Returns a session to the pool. Sessions that failed or were closed are discarded.
+        """
+        if discard or self._closed or conn.is_closed():
+            self._discard(conn)
+            return
+        with self._condition:
+            self._idle.append((conn, time.time()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager that acquires a session and releases it afterwards.
+
+        A session is discarded instead of reused when the block raises a Snowflake error.
+        """
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+        except snowflake.connector.errors.Error:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close(self):
+        """
+        Closes idle sessions; sessions in use are closed when released.
+        """
+        with self._condition:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def metrics(self):
+        """
+        Returns pool counters, e.g. for batch jobs to report time spent waiting on connections.
+        """
+        with self._condition:
+            return {
+                'schema': self.schema_name,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size,
+                **self.stats
+            }
+
+
+def get_connection_pool(schema_name=None, warehouse='COMPUTE_WH', database='AIRBNB', max_size=SNOWFLAKE_POOL_SIZE):
+    """
+    Returns the process wide pool for a (warehouse, database, schema), creating it on first use.
+    """
+    key = (warehouse, database, schema_name)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool._closed:
+            pool = SnowflakeConnectionPool(warehouse, database, schema_name, max_size=max_size)
+            _pools[key] = pool
+        return pool
+
+
+@contextmanager
+def _borrow(conn):
+    # get_data and get_data_batches accept a connection or a pool
+    if isinstance(conn, SnowflakeConnectionPool):
+        with conn.connection() as pooled_conn:
+            yield pooled_conn
+    else:
+        yield conn
+
+
 def get_data(sql_query, conn, date_columns=None):
     """
     Executes a SQL query and returns the result as a pandas DataFrame.
 
     Args:
         sql_query (str): SQL query to execute.
-        conn (snowflake.connector): Snowflake connection object.
+        conn (snowflake.connector or SnowflakeConnectionPool): Snowflake connection object,
+            or a pool to borrow a session from for the duration of the query.
         date_columns (list, optional): List of columns to parse as dates
 
     Returns:
         df_result: Resulting DataFrame from the SQL query.
     """
+    with _borrow(conn) as conn:
+        return _get_data(sql_query, conn, date_columns)
+
+
+def _get_data(sql_query, conn, date_columns):
+    cursor = None
     try:
         cursor = conn.cursor()
         
@@ -79,6 +327,100 @@ def get_data(sql_query, conn, date_columns=None):
     return df_result
 
 
+def _project_columns(sql_query, columns):
+    # Select only the needed columns in Snowflake so the rest is never transferred
+    if not columns:
+        return sql_query
+    column_list = ', '.join(column.upper() for column in columns)
+    return f'SELECT {column_list} FROM ({sql_query.strip().rstrip(";")}) AS projected'
+
+
+def _parse_dates(batch, date_columns):
+    if isinstance(batch, pd.DataFrame):
+        for col in date_columns:
+            batch[col] = pd.to_datetime(batch[col], errors='coerce')
+        return batch
+
+    for col in date_columns:
+        index = batch.schema.get_field_index(col)
+        parsed = pd.to_datetime(batch.column(index).to_pandas(), errors='coerce')
+        batch = batch.set_column(index, col, pa.array(parsed))
+    return batch
+
+
+def get_data_batches(sql_query, conn, date_columns=None, columns=None, params=None, as_arrow=False, spill_path=None):
+    """
+    Executes a SQL query and yields the result in batches instead of one DataFrame.
+
+    Only one batch is held in memory at a time, so results larger than RAM can be processed.
+
+    Args:
+        sql_query (str): SQL query to execute.
+        conn (snowflake.connector or SnowflakeConnectionPool): Snowflake connection object,
+            or a pool to borrow a session from until the batches are consumed.
+        date_columns (list, optional): List of columns to parse as dates, parsed per batch.
+        columns (list, optional): Columns to fetch; the query is wrapped so only these leave Snowflake.
+        params (tuple, optional): Query parameters.
+        as_arrow (bool, optional): Yield pyarrow Tables instead of DataFrames.
+        spill_path (str, optional): Also write every batch to this local Parquet file,
+            so the result can be read again with read_parquet_batches without re-running the query.
+
+    Yields:
+        pd.DataFrame or pa.Table: Batches with lowercase column names.
+    """
+    with _borrow(conn) as conn:
+        yield from _iter_batches(sql_query, conn, date_columns, columns, params, as_arrow, spill_path)
+
+
+def _iter_batches(sql_query, conn, date_columns, columns, params, as_arrow, spill_path):
+    cursor = conn.cursor()
+    writer = None
+    try:
+        cursor.execute(_project_columns(sql_query, columns), params)
+
+        batches = cursor.fetch_arrow_batches() if as_arrow else cursor.fetch_pandas_batches()
+        for batch in batches:
+            # Convert column names to lowercase
+            if as_arrow:
+                batch = batch.rename_columns([name.lower() for name in batch.column_names])
+            else:
+                batch.columns = map(str.lower, batch.columns)
+
+            if date_columns:
+                batch = _parse_dates(batch, date_columns)
+
+            if spill_path:
+                table = batch if as_arrow else pa.Table.from_pandas(batch, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(spill_path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+
+            yield batch
+
+    finally:
+        if writer is not None:
+            writer.close()
+        cursor.close()
+
+
+def read_parquet_batches(path, columns=None, batch_size=65536, as_arrow=False):
+    """
+    Reads a Parquet file, e.g. a get_data_batches spill, back in batches.
+
+    Args:
+        path (str): Parquet file.
+        columns (list, optional): Columns to read.
+        batch_size (int, optional): Maximum rows per batch.
+        as_arrow (bool, optional): Yield pyarrow Tables instead of DataFrames.
+
+    Yields:
+        pd.DataFrame or pa.Table: Batches of the file.
+    """
+    for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+        table = pa.Table.from_batches([record_batch])
+        yield table if as_arrow else table.to_pandas()
+
+
 def write_to_snowflake(df_name, conn, schema_name, table_name, overwrite_table=False):
     """
     Writes data from dataframe to Snowflake.
@@ -112,4 +454,171 @@ def write_to_snowflake(df_name, conn, schema_name, table_name, overwrite_table=F
             print(f'Data appended to table {table_name} in schema {schema_name} at {current_time}')
 
     except Exception as e:
-        logger.error(f'Failed to create table and load data to Snowflake due to error code {e}')
\ No newline at end of file
+        logger.error(f'Failed to create table and load data to Snowflake due to error code {e}')
+
+def _quote(identifier):
+    # Quoted like write_pandas does, so bulk writes target the same columns as write_to_snowflake
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+def _snowflake_type(arrow_type):
+    if pa.types.is_boolean(arrow_type):
+        return 'BOOLEAN'
+    if pa.types.is_integer(arrow_type):
+        return 'NUMBER(38, 0)'
+    if pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return 'FLOAT'
+    if pa.types.is_timestamp(arrow_type):
+        return 'TIMESTAMP_TZ' if arrow_type.tz else 'TIMESTAMP_NTZ'
+    if pa.types.is_date(arrow_type):
+        return 'DATE'
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return 'TEXT'
+    return 'VARIANT'
+
+
+def _write_parquet_chunk(table, path, compression):
+    # Snowflake reads microsecond timestamps; pandas writes nanoseconds by default
+    pq.write_table(table, path, compression=compression, coerce_timestamps='us', allow_truncated_timestamps=True)
+    return os.path.getsize(path)
+
+
+def _execute(conn, sql):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def bulk_write_to_snowflake(df, conn, schema_name, table_name, merge_keys=None, overwrite_table=False,
+                            chunk_rows=BULK_CHUNK_ROWS, workers=BULK_WORKERS, compression='snappy', staging_dir=None):
+    """
+    Writes a DataFrame to Snowflake through a stage, optionally upserting on a key.
+
+    The frame is split into chunks that are written to compressed Parquet files in parallel.
+    The files are uploaded to a temporary stage with one parallel PUT and loaded with COPY INTO.
+    Without merge_keys the rows are appended (or replace the table with overwrite_table). With
+    merge_keys they are copied into a temporary table and merged, so existing rows with the same
+    key are updated and the rest inserted. The table is created from the frame's columns if it
+    does not exist.
+
+    Args:
+        df (pd.DataFrame): Data to write; column names are used as given, like write_to_snowflake.
+        conn (snowflake.connector or SnowflakeConnectionPool): Snowflake connection object,
+            or a pool to borrow one session from for the whole write.
+        schema_name (str): Name of the schema to write to in Snowflake.
+        table_name (str): Name of the table to write to in Snowflake.
+        merge_keys (list, optional): Columns identifying a row, e.g. ['ID'] for review scores.
+        overwrite_table (bool, optional): Replace the table instead of appending; ignored with merge_keys.
+        chunk_rows (int, optional): Rows per Parquet file.
+        workers (int, optional): Threads writing Parquet files; uploads use BULK_UPLOAD_THREADS.
+        compression (str, optional): Parquet compression codec.
+        staging_dir (str, optional): Local directory for the Parquet files. A temporary
+            directory is used and removed when None; files in a given directory are kept.
+
+    Returns:
+        dict: rows, rows_per_second, and seconds and bytes of each stage
+            (serialize, upload, copy and merge).
+
+    Raises:
+        ValueError: When merge_keys are missing from df or repeat within it.
+    """
+    merge_keys = list(merge_keys or [])
+    missing = [key for key in merge_keys if key not in df.columns]
+    if missing:
+        raise ValueError(f'Merge keys {missing} are not columns of the DataFrame')
+    if merge_keys and df.duplicated(merge_keys).any():
+        raise ValueError(f'Merge keys {merge_keys} are not unique in the DataFrame')
+
+    schema_name = str.upper(schema_name)
+    table_name = str.upper(table_name)
+    target = f'{_quote(schema_name)}.{_quote(table_name)}'
+    suffix = uuid.uuid4().hex[:12].upper()
+    stage = f'{_quote(schema_name)}.{_quote(f"{table_name}_STAGE_{suffix}")}'
+
+    start = time.perf_counter()
+    stats = {'rows': len(df), 'chunks': 0}
+
+    owns_staging_dir = staging_dir is None
+    staging_dir = tempfile.mkdtemp(prefix='snowflake_stage_') if owns_staging_dir else staging_dir
+    os.makedirs(staging_dir, exist_ok=True)
+
+    try:
+        # Serialize: Arrow conversion and Parquet compression release the GIL, so chunks are written in parallel
+        stage_start = time.perf_counter()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        paths = [os.path.join(staging_dir, f'{table_name.lower()}_{suffix}_{i:05d}.parquet')
+                 for i in range(max((len(df) + chunk_rows - 1) // chunk_rows, 1))]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sizes = list(executor.map(lambda i: _write_parquet_chunk(table.slice(i * chunk_rows, chunk_rows),
+                                                                     paths[i], compression), range(len(paths))))
+        stats['chunks'] = len(paths)
+        stats['serialize'] = {'seconds': time.perf_counter() - stage_start,
+                              'bytes': int(df.memory_usage(index=False, deep=True).sum()),
+                              'output_bytes': sum(sizes)}
+
+        columns = ', '.join(f'{_quote(field.name)} {_snowflake_type(field.type)}' for field in table.schema)
+        column_names = [_quote(name) for name in table.column_names]
+
+        with _borrow(conn) as conn:
+            if overwrite_table and not merge_keys:
+                _execute(conn, f'CREATE OR REPLACE TABLE {target} ({columns})')
+            else:
+                _execute(conn, f'CREATE TABLE IF NOT EXISTS {target} ({columns})')
+            _execute(conn, f'CREATE TEMPORARY STAGE {stage} FILE_FORMAT = (TYPE = PARQUET)')
+
+            try:
+                stage_start = time.perf_counter()
+                pattern = os.path.join(staging_dir, f'{table_name.lower()}_{suffix}_*.parquet').replace('\\', '/')
+                uploaded = _execute(conn, f"PUT 'file://{pattern}' @{stage} PARALLEL = {BULK_UPLOAD_THREADS} AUTO_COMPRESS = FALSE")
+                stats['upload'] = {'seconds': time.perf_counter() - stage_start,
+                                   'bytes': sum(int(row[3]) for row in uploaded if len(row) > 3) or sum(sizes)}
+
+                # Rows go straight to the table, or to a temporary copy of it to merge from
+                copy_target = target
+                if merge_keys:
+                    copy_target = f'{_quote(schema_name)}.{_quote(f"{table_name}_MERGE_{suffix}")}'
+                    _execute(conn, f'CREATE TEMPORARY TABLE {copy_target} LIKE {target}')
+
+                stage_start = time.perf_counter()
+                loaded = _execute(conn, f'COPY INTO {copy_target} FROM @{stage} '
+                                        f'MATCH_BY_COLUMN_NAME = CASE_SENSITIVE PURGE = TRUE ON_ERROR = ABORT_STATEMENT')
+                stats['copy'] = {'seconds': time.perf_counter() - stage_start,
+                                 'rows': sum(int(row[3]) for row in loaded if len(row) > 3)}
+
+                if merge_keys:
+                    stage_start = time.perf_counter()
+                    on = ' AND '.join(f't.{_quote(key)} = s.{_quote(key)}' for key in merge_keys)
+                    updates = ', '.join(f't.{name} = s.{name}' for name in column_names
+                                        if name not in {_quote(key) for key in merge_keys})
+                    merged = _execute(conn, f"""
+                        MERGE INTO {target} t USING {copy_target} s ON {on}
+                        {f'WHEN MATCHED THEN UPDATE SET {updates}' if updates else ''}
+                        WHEN NOT MATCHED THEN INSERT ({', '.join(column_names)})
+                            VALUES ({', '.join(f's.{name}' for name in column_names)})
+                    """)
+                    inserted, updated = (list(merged[0]) + [0, 0])[:2] if merged else (None, None)
+                    stats['merge'] = {'seconds': time.perf_counter() - stage_start,
+                                      'inserted': inserted, 'updated': updated}
+                    _execute(conn, f'DROP TABLE IF EXISTS {copy_target}')
+            finally:
+                _execute(conn, f'DROP STAGE IF EXISTS {stage}')
+
+    except Exception as e:
+        logger.error(f'Failed to bulk load data to Snowflake table {schema_name}.{table_name} due to error {e}')
+        raise
+
+    finally:
+        if owns_staging_dir:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    seconds = time.perf_counter() - start
+    stats['seconds'] = seconds
+    stats['rows_per_second'] = len(df) / max(seconds, 1e-9)
+
+    action = 'merged into' if merge_keys else ('replaced' if overwrite_table else 'appended to')
+    print(f'{len(df)} rows {action} table {table_name} in schema {schema_name} in {seconds:.1f}s '
+          f'({stats["rows_per_second"]:.0f} rows/sec, {stats["serialize"]["output_bytes"] / 1e6:.1f} MB Parquet)')
+    return stats
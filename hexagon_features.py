@@ -0,0 +1,346 @@
+## this file contains the H3 hexagon assignment and per-hexagon median features behind hexagon_data.csv
+import logging
+import numpy as np
+import pandas as pd
+import h3
+
+from market_index import MEDIAN_COLUMNS
+from quantile_sketch import DEFAULT_K, build_group_sketches, merge_group_sketches, save_sketches
+
+logger = logging.getLogger(__name__)
+
+# Resolution of the hexagons the model and the maps use (about 1.4 km across)
+RESOLUTION = 7
+
+# Listing columns summarized per hexagon, in the order of MEDIAN_COLUMNS
+FEATURE_COLUMNS = ['accommodates', 'bathrooms', 'beds', 'price']
+
+# Columns that move a listing to another hexagon or change its hexagon's medians
+TRACKED_COLUMNS = ['market', 'latitude', 'longitude'] + FEATURE_COLUMNS
+
+# The notebooks were written against the h3 v3 API; the integer API avoids building a string per listing
+if hasattr(h3, 'latlng_to_cell'):
+    from h3.api import basic_int as _h3_int
+    _latlng_to_cell = _h3_int.latlng_to_cell
+    _cell_to_parent = _h3_int.cell_to_parent
+    _cell_to_latlng = _h3_int.cell_to_latlng
+    _grid_ring = _h3_int.grid_ring
+    _cell_to_str = h3.int_to_str
+    _str_to_cell = h3.str_to_int
+else:
+    from h3.api import basic_int as _h3_int
+    _latlng_to_cell = _h3_int.geo_to_h3
+    _cell_to_parent = _h3_int.h3_to_parent
+    _cell_to_latlng = _h3_int.h3_to_geo
+    _grid_ring = _h3_int.hex_ring
+    _cell_to_str = h3.h3_to_string
+    _str_to_cell = h3.string_to_h3
+
+
+def h3_column(resolution, base_resolution=RESOLUTION):
+    """
+    Column holding the cells of a resolution; h3_index for the model's resolution, h3_index_<resolution> otherwise.
+    """
+    return 'h3_index' if resolution == base_resolution else f'h3_index_{resolution}'
+
+
+def assign_h3_cells(latitudes, longitudes, resolutions=(RESOLUTION,)):
+    """
+    Assigns every coordinate to its H3 cell at one or more resolutions.
+
+    h3 only indexes one point per call, so points are indexed once, at the finest resolution,
+    through the integer API. Coarser resolutions are the parents of the distinct fine cells, so
+    every coarse hexagon is exactly the union of its children (near hexagon edges this can
+    differ from indexing the point directly at the coarse resolution). Cells are converted to
+    strings once per distinct cell instead of once per listing.
+
+    Args:
+        latitudes (array-like): Latitudes in degrees.
+        longitudes (array-like): Longitudes in degrees.
+        resolutions (iterable, optional): H3 resolutions to assign.
+
+    Returns:
+        dict: Resolution to an object array of cell strings; None where a coordinate is missing.
+    """
+    resolutions = sorted(set(resolutions), reverse=True)
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    valid = ~(np.isnan(latitudes) | np.isnan(longitudes))
+
+    points = int(valid.sum())
+    finest = np.fromiter(map(_latlng_to_cell, latitudes[valid].tolist(), longitudes[valid].tolist(),
+                             [resolutions[0]] * points), dtype=np.uint64, count=points)
+    fine_cells, fine_inverse = np.unique(finest, return_inverse=True)
+
+    cells = {}
+    for resolution in resolutions:
+        if resolution == resolutions[0]:
+            parents = fine_cells
+        else:
+            parents = np.fromiter((_cell_to_parent(int(cell), resolution) for cell in fine_cells),
+                                  dtype=np.uint64, count=len(fine_cells))
+        names = np.array([_cell_to_str(int(cell)) for cell in parents], dtype=object)
+
+        assigned = np.full(len(latitudes), None, dtype=object)
+        assigned[valid] = names[fine_inverse]
+        cells[resolution] = assigned
+    return cells
+
+
+def add_h3_columns(df, resolutions=(RESOLUTION,), base_resolution=RESOLUTION):
+    """
+    Adds a cell column per resolution (see h3_column) computed from latitude and longitude.
+
+    Returns:
+        pd.DataFrame: df, modified in place.
+    """
+    for resolution, cells in assign_h3_cells(df['latitude'], df['longitude'], resolutions).items():
+        df[h3_column(resolution, base_resolution)] = cells
+    return df
+
+
+def group_medians(keys, values):
+    """
+    Medians of each value column per group, computed by sorting instead of a groupby.
+
+    Each column is sorted by value, then stably by group id; group ids are stored in the
+    narrowest unsigned type so the second sort is a radix sort. Each group's median is then
+    read from the middle of its slice. NaN values are ignored like pandas does.
+
+    Args:
+        keys (list): Non-negative integer arrays identifying the group of each row, e.g. factorized
+            cells and markets.
+        values (np.ndarray): Float array of shape (rows, columns).
+
+    Returns:
+        tuple: Index of the first row of each group (into the original rows), listings per group,
+        and medians of shape (groups, columns).
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((0, values.shape[1]))
+
+    # Number the groups in key order
+    combined = np.asarray(keys[0], dtype=np.int64)
+    for key in keys[1:]:
+        combined = combined * (int(key.max()) + 1) + key
+    _, first_rows, group_ids, counts = np.unique(combined, return_index=True, return_inverse=True,
+                                                 return_counts=True)
+    group_ids = group_ids.reshape(-1).astype(np.min_scalar_type(len(counts)))
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+
+    medians = np.full((len(counts), values.shape[1]), np.nan)
+    for j in range(values.shape[1]):
+        # NaN sorts last, and the stable sort keeps that order inside each group
+        by_value = np.argsort(values[:, j])
+        column_order = by_value[np.argsort(group_ids[by_value], kind='stable')]
+        sorted_values = values[column_order, j]
+        valid = np.add.reduceat((~np.isnan(sorted_values)).astype(np.int64), starts)
+        has_values = valid > 0
+        low = starts + np.maximum(valid - 1, 0) // 2
+        high = starts + valid // 2
+        medians[has_values, j] = (sorted_values[low[has_values]] + sorted_values[high[has_values]]) / 2
+
+    return first_rows, counts, medians
+
+
+def build_hexagon_features(listings, resolution=RESOLUTION, by_market=True):
+    """
+    Computes the per-hexagon medians of hexagon_data.csv.
+
+    Equivalent to groupby(['h3_index', 'market']).agg(median) in EDA_using_hexagons.ipynb.
+
+    Args:
+        listings (pd.DataFrame): Listings with the cell column of the resolution (see add_h3_columns)
+            and FEATURE_COLUMNS.
+        resolution (int, optional): Resolution of the hexagons to aggregate.
+        by_market (bool, optional): Also group by market, as hexagon_data.csv does.
+
+    Returns:
+        pd.DataFrame: h3_index (and market), MEDIAN_COLUMNS and listing_count, sorted by hexagon.
+    """
+    column = h3_column(resolution)
+    listings = listings[listings[column].notna()]
+    group_columns = [column, 'market'] if by_market else [column]
+
+    cell_codes, cells = pd.factorize(listings[column], sort=True)
+    keys = [cell_codes]
+    if by_market:
+        market_codes, markets = pd.factorize(listings['market'], sort=True)
+        keys.append(market_codes)
+
+    first_rows, counts, medians = group_medians(keys, listings[FEATURE_COLUMNS].to_numpy(dtype=float))
+
+    hexagon_data = listings[group_columns].iloc[first_rows].reset_index(drop=True)
+    hexagon_data = hexagon_data.rename(columns={column: 'h3_index'})
+    for i, name in enumerate(MEDIAN_COLUMNS):
+        hexagon_data[name] = medians[:, i]
+    hexagon_data['listing_count'] = counts
+    return hexagon_data
+
+
+def touched_hexagons(previous, current, id_column='id', column='h3_index', tracked_columns=TRACKED_COLUMNS):
+    """
+    Finds the hexagons whose listings were added, removed or changed between two snapshots.
+
+    A changed listing touches both the hexagon it left and the one it is in now.
+
+    Args:
+        previous (pd.DataFrame): Earlier listings with the cell column.
+        current (pd.DataFrame): New listings with the cell column.
+        id_column (str, optional): Listing id.
+        column (str, optional): Cell column to report.
+        tracked_columns (list, optional): Columns compared to detect changed listings.
+
+    Returns:
+        set: Cells to recompute.
+    """
+    columns = [name for name in tracked_columns if name in previous.columns and name in current.columns]
+    previous_hashes = pd.Series(pd.util.hash_pandas_object(previous[columns], index=False).to_numpy(),
+                                index=previous[id_column].to_numpy())
+    current_hashes = pd.Series(pd.util.hash_pandas_object(current[columns], index=False).to_numpy(),
+                               index=current[id_column].to_numpy())
+
+    aligned = current_hashes.reindex(previous_hashes.index)
+    changed_or_removed = previous[id_column].isin(aligned.index[aligned.to_numpy() != previous_hashes.to_numpy()])
+    aligned = previous_hashes.reindex(current_hashes.index)
+    changed_or_added = current[id_column].isin(aligned.index[aligned.to_numpy() != current_hashes.to_numpy()])
+
+    cells = set(previous.loc[changed_or_removed.to_numpy(), column].dropna())
+    cells.update(current.loc[changed_or_added.to_numpy(), column].dropna())
+    return cells
+
+
+def update_hexagon_features(hexagon_data, listings, cells, resolution=RESOLUTION, by_market=True):
+    """
+    Recomputes only the given hexagons and keeps every other row of an earlier build.
+
+    Medians can't be updated from the old medians, so each touched hexagon is recomputed from
+    all of its current listings; hexagons left without listings are dropped.
+
+    Args:
+        hexagon_data (pd.DataFrame): Earlier build_hexagon_features result.
+        listings (pd.DataFrame): Current listings with the cell column.
+        cells (set): Hexagons to recompute, see touched_hexagons.
+        resolution (int, optional): Resolution of the hexagons.
+        by_market (bool, optional): Must match the earlier build.
+
+    Returns:
+        pd.DataFrame: Updated hexagon features, sorted by hexagon.
+    """
+    column = h3_column(resolution)
+    cells = list(cells)
+    kept = hexagon_data[~hexagon_data['h3_index'].isin(cells)]
+    updated = build_hexagon_features(listings[listings[column].isin(cells)], resolution, by_market)
+    logger.info(f'Recomputed {len(updated)} of {len(kept) + len(updated)} hexagons')
+
+    sort_columns = ['h3_index', 'market'] if by_market else ['h3_index']
+    return pd.concat([kept, updated], ignore_index=True).sort_values(sort_columns, ignore_index=True)
+
+
+def build_hexagon_sketches(listings, resolution=RESOLUTION, k=DEFAULT_K, columns=FEATURE_COLUMNS):
+    """
+    Builds a quantile sketch of each feature per hexagon.
+
+    The sketches can take newly streamed listings (quantile_sketch.update_group_sketches) and be
+    merged into parent hexagons or markets (see market_sketches), and serve any percentile, not
+    only the median. Hexagons with fewer than about k listings keep exact values.
+
+    Args:
+        listings (pd.DataFrame): Listings with the cell column of the resolution.
+        resolution (int, optional): Resolution of the hexagons.
+        k (int, optional): Sketch size; the rank error is quantile_sketch.normalized_rank_error(k).
+        columns (list, optional): Features to sketch.
+
+    Returns:
+        dict: Column to {h3_index: KLLSketch}.
+    """
+    column = h3_column(resolution)
+    listings = listings[listings[column].notna()]
+    return {name: build_group_sketches(listings[column], listings[name], k) for name in columns}
+
+
+def market_sketches(hexagon_sketches, hexagon_markets):
+    """
+    Merges hexagon sketches into one sketch per market.
+
+    Args:
+        hexagon_sketches (dict): build_hexagon_sketches result.
+        hexagon_markets (dict): h3_index to market.
+
+    Returns:
+        dict: Column to {market: KLLSketch}.
+    """
+    return {name: merge_group_sketches(groups, hexagon_markets) for name, groups in hexagon_sketches.items()}
+
+
+def add_median_features(listings, hexagon_data, resolution=RESOLUTION):
+    """
+    Joins the hexagon medians onto the listings, as listings_cleaned_h3 carries them.
+
+    Returns:
+        pd.DataFrame: listings with MEDIAN_COLUMNS.
+    """
+    medians = hexagon_data.drop_duplicates('h3_index')[['h3_index'] + MEDIAN_COLUMNS]
+    medians = medians.rename(columns={'h3_index': h3_column(resolution)})
+    return listings.drop(columns=[name for name in MEDIAN_COLUMNS if name in listings.columns]) \
+        .merge(medians, on=h3_column(resolution), how='left')
+
+
+if __name__ == '__main__':
+    import argparse
+    from helper_functions import connect_to_snowflake, get_data, write_to_snowflake
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Build the per-hexagon median features from listings_cleaned_h3')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[RESOLUTION])
+    parser.add_argument('--output', default='hexagon_data.csv')
+    parser.add_argument('--previous', help='Earlier hexagon_data.csv; only hexagons with changed listings are recomputed')
+    parser.add_argument('--previous-listings', help='Parquet snapshot of the listings the earlier file was built from')
+    parser.add_argument('--snapshot', help='Write the listings to this Parquet file for the next incremental run')
+    parser.add_argument('--sketches', help='Write per-hexagon and per-market quantile sketches to this .json.gz prefix')
+    parser.add_argument('--write-snowflake', action='store_true', help='Overwrite FEATURE_STORE.hexagon_aggregated_data')
+    args = parser.parse_args()
+
+    conn = connect_to_snowflake(schema_name='FEATURE_STORE')
+    # Listings after the per-market outlier filter of EDA_using_hexagons.ipynb
+    listings = get_data('select * from listings_cleaned_h3', conn)
+    add_h3_columns(listings, args.resolutions)
+
+    if args.previous and args.previous_listings:
+        previous_listings = pd.read_parquet(args.previous_listings)
+        add_h3_columns(previous_listings, [RESOLUTION])
+        cells = touched_hexagons(previous_listings, listings)
+        hexagon_data = update_hexagon_features(pd.read_csv(args.previous), listings, cells)
+    else:
+        hexagon_data = build_hexagon_features(listings)
+
+    hexagon_data.drop(columns=['listing_count']).to_csv(args.output, index=False)
+    print(f'{len(hexagon_data)} hexagons written to {args.output}')
+
+    if args.snapshot:
+        listings[['id'] + TRACKED_COLUMNS].to_parquet(args.snapshot, index=False)
+
+    for resolution in args.resolutions:
+        if resolution != RESOLUTION:
+            coarse = build_hexagon_features(listings, resolution)
+            path = args.output.replace('.csv', f'_r{resolution}.csv')
+            coarse.to_csv(path, index=False)
+            print(f'{len(coarse)} resolution {resolution} hexagons written to {path}')
+
+    if args.sketches:
+        hexagon_sketches = build_hexagon_sketches(listings)
+        hexagon_markets = dict(zip(hexagon_data['h3_index'], hexagon_data['market']))
+        save_sketches(hexagon_sketches, f'{args.sketches}_hexagons.json.gz')
+        save_sketches(market_sketches(hexagon_sketches, hexagon_markets), f'{args.sketches}_markets.json.gz')
+        print(f'Quantile sketches written to {args.sketches}_hexagons.json.gz and {args.sketches}_markets.json.gz')
+
+    if args.write_snowflake:
+        columns_to_keep = ['h3_index', 'accommodates_median', 'bathrooms_median', 'beds_median', 'price_median']
+        write_to_snowflake(hexagon_data[columns_to_keep], conn, schema_name='feature_store',
+                           table_name='hexagon_aggregated_data', overwrite_table=True)
+    conn.close()
@@ -0,0 +1,175 @@
+## this file contains the build step that splits the hexagon GeoJSON into compact per-market files
+import os
+import json
+import shutil
+import logging
+
+from s3_loader import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+HEXAGON_GEOJSON_KEY = 'models/hexagon_data.geojson'
+MARKET_GEOJSON_PREFIX = 'models/hexagons/'
+
+# 5 decimal places is roughly 1 m, far below what is visible for a 1.4 km hexagon
+COORDINATE_PRECISION = 5
+
+# The choropleth only joins on the hexagon id
+KEEP_PROPERTIES = ['h3_index']
+
+
+def market_geojson_key(market):
+    return f'{MARKET_GEOJSON_PREFIX}{market}.geojson'
+
+
+def _quantize(coordinates, precision):
+    if isinstance(coordinates[0], (int, float)):
+        return [round(value, precision) for value in coordinates]
+    return [_quantize(part, precision) for part in coordinates]
+
+
+def split_geojson_by_market(geojson_data, hexagon_markets=None, precision=COORDINATE_PRECISION,
+                            keep_properties=KEEP_PROPERTIES):
+    """
+    Splits the hexagon FeatureCollection into one compact FeatureCollection per market.
+
+    Args:
+        geojson_data (dict): Parsed hexagon_data.geojson.
+        hexagon_markets (dict, optional): h3_index to market, for features without a market property.
+        precision (int, optional): Decimal places kept for coordinates.
+        keep_properties (list, optional): Feature properties to keep.
+
+    Returns:
+        dict: Market to FeatureCollection.
+    """
+    collections = {}
+    skipped = 0
+
+    for feature in geojson_data['features']:
+        properties = feature.get('properties') or {}
+        market = properties.get('market')
+        if market is None and hexagon_markets is not None:
+            market = hexagon_markets.get(properties.get('h3_index'))
+        if market is None:
+            skipped += 1
+            continue
+
+        geometry = feature['geometry']
+        compact_feature = {
+            'type': 'Feature',
+            'properties': {name: properties[name] for name in keep_properties if name in properties},
+            'geometry': {'type': geometry['type'], 'coordinates': _quantize(geometry['coordinates'], precision)}
+        }
+        collections.setdefault(market, {'type': 'FeatureCollection', 'features': []})['features'].append(compact_feature)
+
+    if skipped:
+        logger.warning(f'Skipped {skipped} hexagons without a market')
+    return collections
+
+
+def dumps_compact(feature_collection):
+    """
+    Serializes a FeatureCollection without whitespace.
+
+    Returns:
+        bytes: UTF-8 encoded GeoJSON.
+    """
+    return json.dumps(feature_collection, separators=(',', ':')).encode('utf-8')
+
+
+def build_market_geojson(geojson_data, output_dir, hexagon_markets=None, precision=COORDINATE_PRECISION):
+    """
+    Writes one compact GeoJSON file per market.
+
+    Args:
+        geojson_data (dict): Parsed hexagon_data.geojson.
+        output_dir (str): Directory to write <market>.geojson files to.
+        hexagon_markets (dict, optional): h3_index to market, see split_geojson_by_market.
+        precision (int, optional): Decimal places kept for coordinates.
+
+    Returns:
+        dict: Market to path of the written file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = {}
+    for market, feature_collection in split_geojson_by_market(geojson_data, hexagon_markets, precision).items():
+        path = os.path.join(output_dir, f'{market}.geojson')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(dumps_compact(feature_collection))
+        os.replace(tmp_path, path)
+        paths[market] = path
+    return paths
+
+
+def load_market_geojson(object_cache, market, cache_dir=CACHE_DIR):
+    """
+    Returns the hexagons of one market.
+
+    Uses the published per-market artifact when it exists, otherwise splits the global
+    GeoJSON once per version into local per-market files.
+
+    Args:
+        object_cache (s3_loader.S3ObjectCache): Shared S3 loader.
+        market (str): Market name, e.g. new-york-city.
+        cache_dir (str, optional): Directory holding locally split files.
+
+    Returns:
+        dict: FeatureCollection for the market; empty when the market has no hexagons.
+    """
+    try:
+        with open(object_cache.get_path(market_geojson_key(market)), 'rb') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+
+    global_geojson = object_cache.fetch(HEXAGON_GEOJSON_KEY)
+    output_dir = os.path.join(cache_dir, 'hexagons', global_geojson.etag)
+    path = os.path.join(output_dir, f'{market}.geojson')
+
+    if not os.path.isdir(output_dir):
+        logger.info(f'Splitting {HEXAGON_GEOJSON_KEY} into per-market files')
+        # Build every market in a temporary directory and rename it so readers never see a partial split
+        tmp_dir = f'{output_dir}.{os.getpid()}.tmp'
+        with open(global_geojson.path, 'rb') as f:
+            build_market_geojson(json.load(f), tmp_dir)
+        try:
+            os.rename(tmp_dir, output_dir)
+        except OSError:
+            # Another process finished the split first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if not os.path.exists(path):
+        return {'type': 'FeatureCollection', 'features': []}
+
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    import argparse
+    import pandas as pd
+    from s3_loader import S3ObjectCache
+
+    parser = argparse.ArgumentParser(description='Split hexagon_data.geojson into compact per-market files')
+    parser.add_argument('--bucket', default='airbnb-capstone-project')
+    parser.add_argument('--output-dir', default=os.path.join(CACHE_DIR, 'hexagons', 'build'))
+    parser.add_argument('--upload', action='store_true', help=f'Upload the files under {MARKET_GEOJSON_PREFIX}')
+    args = parser.parse_args()
+
+    object_cache = S3ObjectCache(bucket_name=args.bucket)
+
+    with open(object_cache.get_path(HEXAGON_GEOJSON_KEY), 'rb') as f:
+        geojson_data = json.load(f)
+
+    # Fall back to hexagon_data.csv for the market of each hexagon
+    hexagon_data = pd.read_csv(object_cache.get_path('models/hexagon_data.csv'), usecols=['h3_index', 'market'])
+    hexagon_markets = dict(zip(hexagon_data['h3_index'], hexagon_data['market']))
+
+    paths = build_market_geojson(geojson_data, args.output_dir, hexagon_markets)
+    for market, path in paths.items():
+        print(f'{market}: {os.path.getsize(path) / 1024:.0f} KB written to {path}')
+        if args.upload:
+            object_cache.client.upload_file(path, args.bucket, market_geojson_key(market))
+            print(f'Uploaded to s3://{args.bucket}/{market_geojson_key(market)}')
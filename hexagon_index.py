@@ -0,0 +1,167 @@
+## this file contains the in-memory nearest-hexagon index that resolves a location to hexagon features
+import numpy as np
+import pandas as pd
+
+from market_index import MEDIAN_COLUMNS
+from hexagon_features import RESOLUTION, _cell_to_latlng, _cell_to_parent, _grid_ring, _latlng_to_cell, _str_to_cell
+
+# Rings of neighbours searched when the location's own hexagon has no listings
+MAX_RING = 2
+
+# Coarser resolutions tried after the rings, before falling back to the market
+PARENT_RESOLUTIONS = (6, 5)
+
+# Fallback results remembered per (cell, market); the cache is cleared when it grows past this
+MAX_CACHED_FALLBACKS = 100_000
+
+
+def _median_rows(features, groups):
+    # Median of each column over the rows of each group
+    medians = {}
+    for group, rows in groups.items():
+        medians[group] = np.nanmedian(features[rows], axis=0)
+    return medians
+
+
+class HexagonIndex:
+    """
+    Resolves a latitude/longitude to the hexagon features the H3 model was trained on.
+
+    Built once from hexagon_data; every lookup afterwards is a handful of dictionary probes on
+    integer cells. A location whose hexagon has no listings falls back to the median of its
+    neighbours one, then two rings out, then to its parent hexagons, then to the market.
+    Fallbacks are remembered per cell, so repeated lookups around the same empty hexagon only
+    pay for the search once. Lookups can be limited to one market's hexagons.
+    """
+
+    def __init__(self, hexagon_data, resolution=RESOLUTION, max_ring=MAX_RING, parent_resolutions=PARENT_RESOLUTIONS):
+        self.resolution = resolution
+        self.max_ring = max_ring
+        self.parent_resolutions = [r for r in parent_resolutions if r < resolution]
+
+        cells = [_str_to_cell(cell) for cell in hexagon_data['h3_index']]
+        markets = hexagon_data['market'].tolist()
+        self._features = hexagon_data[MEDIAN_COLUMNS].to_numpy(dtype=float)
+
+        # (cell, market) and (cell, None) to a row, so lookups can be limited to a market or not
+        self._rows = {}
+        parent_groups = {}
+        market_groups = {}
+        for row, (cell, market) in enumerate(zip(cells, markets)):
+            self._rows[(cell, market)] = row
+            self._rows.setdefault((cell, None), row)
+            market_groups.setdefault(market, []).append(row)
+            for parent_resolution in self.parent_resolutions:
+                parent = _cell_to_parent(cell, parent_resolution)
+                parent_groups.setdefault((parent, market), []).append(row)
+                parent_groups.setdefault((parent, None), []).append(row)
+
+        self._parents = _median_rows(self._features, parent_groups)
+        self._markets = _median_rows(self._features, market_groups)
+
+        # Center of each market's hexagons, e.g. for a default location on the page
+        centers = np.array([_cell_to_latlng(cell) for cell in cells]).reshape(-1, 2)
+        self._centers = {market: tuple(centers[rows].mean(axis=0)) for market, rows in market_groups.items()}
+        self._fallbacks = {}
+
+    @property
+    def markets(self):
+        return list(self._markets)
+
+    def __len__(self):
+        return len(self._features)
+
+    def market_center(self, market):
+        """
+        Returns the (latitude, longitude) center of a market's hexagons.
+        """
+        return self._centers[market]
+
+    def lookup_cell(self, cell, market=None):
+        """
+        Returns the features for an integer H3 cell at the index resolution.
+
+        Args:
+            cell (int): Cell at the index resolution.
+            market (str, optional): Only use this market's hexagons.
+
+        Returns:
+            tuple: Features in MEDIAN_COLUMNS order and where they came from: hexagon, ring-<k>,
+            parent-<resolution> or market. NaN features and None when nothing matched.
+        """
+        row = self._rows.get((cell, market))
+        if row is not None:
+            return self._features[row], 'hexagon'
+
+        fallback = self._fallbacks.get((cell, market))
+        if fallback is None:
+            if len(self._fallbacks) >= MAX_CACHED_FALLBACKS:
+                self._fallbacks.clear()
+            fallback = self._fallbacks[(cell, market)] = self._search(cell, market)
+        return fallback
+
+    def _search(self, cell, market):
+        for k in range(1, self.max_ring + 1):
+            rows = [self._rows[(neighbour, market)] for neighbour in _grid_ring(cell, k)
+                    if (neighbour, market) in self._rows]
+            if rows:
+                return np.nanmedian(self._features[rows], axis=0), f'ring-{k}'
+
+        for parent_resolution in self.parent_resolutions:
+            features = self._parents.get((_cell_to_parent(cell, parent_resolution), market))
+            if features is not None:
+                return features, f'parent-{parent_resolution}'
+
+        if market in self._markets:
+            return self._markets[market], 'market'
+        return np.full(len(MEDIAN_COLUMNS), np.nan), None
+
+    def lookup(self, latitude, longitude, market=None):
+        """
+        Returns the features for one location, see lookup_cell.
+        """
+        return self.lookup_cell(_latlng_to_cell(latitude, longitude, self.resolution), market)
+
+    def lookup_many(self, latitudes, longitudes, markets=None):
+        """
+        Resolves a batch of locations.
+
+        Args:
+            latitudes (array-like): Latitudes in degrees.
+            longitudes (array-like): Longitudes in degrees.
+            markets (array-like, optional): Market of each location, to only use that market's hexagons.
+
+        Returns:
+            pd.DataFrame: MEDIAN_COLUMNS plus hexagon_source, one row per location.
+        """
+        latitudes = np.asarray(latitudes, dtype=float).tolist()
+        longitudes = np.asarray(longitudes, dtype=float).tolist()
+        markets = [None] * len(latitudes) if markets is None else list(markets)
+
+        features = np.empty((len(latitudes), len(MEDIAN_COLUMNS)))
+        sources = []
+        for i, (latitude, longitude, market) in enumerate(zip(latitudes, longitudes, markets)):
+            features[i], source = self.lookup_cell(_latlng_to_cell(latitude, longitude, self.resolution), market)
+            sources.append(source)
+
+        result = pd.DataFrame(features, columns=MEDIAN_COLUMNS)
+        result['hexagon_source'] = sources
+        return result
+
+
+def with_hexagon_features(specs, hexagon_index):
+    """
+    Adds the hexagon features of each listing's location to its specs.
+
+    Args:
+        specs (dict or pd.DataFrame): Listing specs with market, latitude and longitude.
+        hexagon_index (HexagonIndex): Index over hexagon_data.
+
+    Returns:
+        dict: specs with MEDIAN_COLUMNS, ready for pricing.FastPricer.predict.
+    """
+    specs = {name: list(values) for name, values in dict(specs).items()}
+    features = hexagon_index.lookup_many(specs['latitude'], specs['longitude'], specs['market'])
+    for name in MEDIAN_COLUMNS:
+        specs[name] = features[name].to_numpy()
+    return specs
@@ -0,0 +1,314 @@
+## this file contains the concurrent, resumable ingestion of Inside Airbnb files into S3
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from botocore.exceptions import ClientError
+
+from s3_loader import BUCKET_NAME, CACHE_DIR, MULTIPART_PART_SIZE, S3MultipartWriter, get_s3_client
+
+logger = logging.getLogger(__name__)
+
+AIRBNB_DATA_URL = 'https://insideairbnb.com/get-the-data/'
+
+MARKETS = ['albany', 'los-angeles', 'san-francisco', 'new-york-city', 'chicago', 'seattle', 'washington-dc']
+
+# Files downloaded at the same time; each holds at most one upload part in memory
+MAX_CONCURRENT_DOWNLOADS = 4
+
+# Bytes read from a response at a time
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Seconds to wait for the connection and between bytes
+REQUEST_TIMEOUT = (10, 60)
+
+STATE_PATH = os.path.join(CACHE_DIR, 'ingest', 'uploads.json')
+
+_sessions = threading.local()
+
+
+def _session():
+    # requests sessions are not thread safe, so each download thread keeps its own
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def download_airbnb_urls(market, page_html=None):
+    """
+    Returns the URLs of the listings, reviews and geospatial files of a market on the Inside Airbnb page.
+
+    Args:
+        market (str): Market name, e.g. new-york-city.
+        page_html (str or bytes, optional): Already downloaded page, so several markets share one request.
+
+    Returns:
+        list: File URLs, calendar files excluded.
+    """
+    from bs4 import BeautifulSoup
+
+    if page_html is None:
+        response = _session().get(AIRBNB_DATA_URL, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            raise ValueError(f"Failed to download Inside Airbnb page. Status code: {response.status_code}")
+        page_html = response.content
+
+    soup = BeautifulSoup(page_html, 'html.parser')
+    urls = []
+    for link in soup.find_all('a', href=True):
+        href = link['href']
+        # Check if the link ends with .csv.gz or .geojson and contains the market name
+        if (href.endswith('.csv.gz') or href.endswith('.geojson')) and market.lower() in href.lower():
+            # Exclude links that contain 'calendar.csv.gz'
+            if 'calendar.csv.gz' not in href:
+                urls.append(href)
+    return urls
+
+
+def s3_key_for_url(url, market_name):
+    """
+    Returns the raw/ key a downloaded file is stored under, or None for files that are not ingested.
+    """
+    filename = url.rsplit('/', 1)[-1]
+
+    if filename == 'listings.csv.gz':
+        return f"raw/listings/{market_name}-listings.csv.gz"
+    elif filename == 'neighbourhoods.geojson':
+        return f"raw/geospatial/{market_name}-neighbourhoods.geojson"
+    elif filename == 'reviews.csv.gz':
+        return f"raw/reviews/{market_name}-reviews.csv.gz"
+    return None
+
+
+class IngestState:
+    """
+    Local record of unfinished multipart uploads, so an interrupted run resumes instead of restarting.
+    """
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self._uploads = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._uploads = {}
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._uploads, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        with self._lock:
+            return self._uploads.get(key)
+
+    def set(self, key, upload):
+        with self._lock:
+            self._uploads[key] = upload
+            self._write()
+
+    def remove(self, key):
+        with self._lock:
+            if self._uploads.pop(key, None) is not None:
+                self._write()
+
+
+def _source_version(response):
+    # What identifies a version of the source file, stored as S3 object metadata
+    return {
+        'source-etag': response.headers.get('ETag', ''),
+        'source-last-modified': response.headers.get('Last-Modified', ''),
+        'source-length': response.headers.get('Content-Length', '')
+    }
+
+
+def _same_version(version, stored):
+    if not stored:
+        return False
+    if version['source-etag']:
+        same = version['source-etag'] == stored.get('source-etag')
+    elif version['source-last-modified']:
+        same = version['source-last-modified'] == stored.get('source-last-modified')
+    else:
+        return False
+    return same and version['source-length'] == stored.get('source-length', version['source-length'])
+
+
+def _stored_version(client, bucket_name, key):
+    try:
+        response = client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    metadata = dict(response.get('Metadata', {}))
+    metadata.setdefault('source-length', str(response['ContentLength']))
+    return metadata
+
+
+def _abort(client, bucket_name, key, upload_id):
+    try:
+        client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+    except ClientError as e:
+        logger.warning(f'Could not abort multipart upload of {key}: {e}')
+
+
+def ingest_file(url, key, bucket_name=BUCKET_NAME, client=None, state=None, part_size=MULTIPART_PART_SIZE):
+    """
+    Streams one file from a URL into S3.
+
+    The file is skipped when the object in S3 was uploaded from the same source version
+    (ETag, or Last-Modified when the server sends no ETag, and size). Otherwise the response
+    is written part by part into a multipart upload. An upload interrupted on an earlier run
+    is resumed with an HTTP Range request when the source has not changed since.
+
+    Args:
+        url (str): Source URL.
+        key (str): Destination key.
+        bucket_name (str, optional): Destination bucket.
+        client (botocore.client.S3, optional): S3 client. Defaults to the shared client.
+        state (IngestState, optional): Record of unfinished uploads. Defaults to the local state file.
+        part_size (int, optional): Bytes per upload part.
+
+    Returns:
+        dict: url, key, status (skipped, uploaded or resumed), bytes downloaded and seconds.
+    """
+    start = time.perf_counter()
+    client = client if client is not None else get_s3_client()
+    state = state if state is not None else IngestState()
+    session = _session()
+
+    head = session.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+    head.raise_for_status()
+    version = _source_version(head)
+
+    if _same_version(version, _stored_version(client, bucket_name, key)):
+        logger.info(f'{key} is unchanged since the last run, skipping')
+        return {'url': url, 'key': key, 'status': 'skipped', 'bytes': 0, 'seconds': time.perf_counter() - start}
+
+    writer = None
+    headers = {}
+    upload = state.get(key)
+    if upload is not None:
+        validator = version['source-etag'] or version['source-last-modified']
+        if _same_version(version, upload['version']) and upload['part_size'] == part_size and validator \
+                and head.headers.get('Accept-Ranges') == 'bytes':
+            writer = S3MultipartWriter.resume(bucket_name, key, upload['upload_id'], client=client,
+                                              part_size=part_size)
+        else:
+            _abort(client, bucket_name, key, upload['upload_id'])
+            state.remove(key)
+        if writer is not None and version['source-length'] and writer.tell() == int(version['source-length']):
+            # Every part was uploaded before the last run stopped; only completing the upload is left
+            writer.close()
+            state.remove(key)
+            seconds = time.perf_counter() - start
+            print(f"Data uploaded to S3 bucket '{bucket_name}' with key '{key}' (resumed, 0.0 MB in {seconds:.1f}s)")
+            return {'url': url, 'key': key, 'status': 'resumed', 'bytes': 0, 'seconds': seconds}
+        if writer is not None and writer.tell():
+            # If-Range makes the server send the whole file instead if it changed after the HEAD
+            headers = {'Range': f'bytes={writer.tell()}-', 'If-Range': validator}
+
+    response = session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 416 and headers:
+        # The uploaded parts don't fit the source, e.g. they already cover all of it; start over
+        logger.info(f'{url} rejected the resume range, restarting the upload of {key}')
+        response.close()
+        writer.abort()
+        writer = None
+        state.remove(key)
+        response = session.get(url, stream=True, timeout=REQUEST_TIMEOUT)
+    try:
+        response.raise_for_status()
+        status = 'resumed' if response.status_code == 206 else 'uploaded'
+
+        if writer is not None and status == 'uploaded':
+            writer.abort()
+            writer = None
+        if writer is None:
+            writer = S3MultipartWriter(bucket_name, key, client=client, part_size=part_size,
+                                       extra_args={'Metadata': {**version, 'source-url': url}})
+            state.set(key, {'upload_id': writer.upload_id, 'version': version, 'part_size': part_size})
+
+        downloaded = 0
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            writer.write(chunk)
+            downloaded += len(chunk)
+        writer.close()
+    finally:
+        response.close()
+
+    state.remove(key)
+    seconds = time.perf_counter() - start
+    print(f"Data uploaded to S3 bucket '{bucket_name}' with key '{key}' ({status}, {downloaded / 1e6:.1f} MB in {seconds:.1f}s)")
+    return {'url': url, 'key': key, 'status': status, 'bytes': downloaded, 'seconds': seconds}
+
+
+def ingest_markets(markets=MARKETS, bucket_name=BUCKET_NAME, max_workers=MAX_CONCURRENT_DOWNLOADS, market_urls=None,
+                   state_path=STATE_PATH):
+    """
+    Downloads the listings, reviews and geospatial files of every market into S3 concurrently.
+
+    Args:
+        markets (list, optional): Markets to ingest.
+        bucket_name (str, optional): Destination bucket.
+        max_workers (int, optional): Files transferred at the same time.
+        market_urls (dict, optional): Market to source URLs. Read from the Inside Airbnb page when None.
+        state_path (str, optional): Record of unfinished uploads, see IngestState.
+
+    Returns:
+        list: ingest_file results; failed files have status failed and an error.
+    """
+    if market_urls is None:
+        response = _session().get(AIRBNB_DATA_URL, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            raise ValueError(f"Failed to download Inside Airbnb page. Status code: {response.status_code}")
+        market_urls = {market: download_airbnb_urls(market, response.content) for market in markets}
+
+    client = get_s3_client()
+    state = IngestState(state_path)
+
+    transfers = []
+    for market in markets:
+        for url in market_urls.get(market, []):
+            key = s3_key_for_url(url, market)
+            if key is None:
+                logger.info(f'Skipping {url}, not an ingested file type')
+                continue
+            transfers.append((url, key))
+
+    def ingest_or_fail(transfer):
+        url, key = transfer
+        try:
+            return ingest_file(url, key, bucket_name, client, state)
+        except Exception as e:
+            # The unfinished upload is kept so the next run resumes it
+            logger.error(f'Failed to ingest {url}: {e}')
+            return {'url': url, 'key': key, 'status': 'failed', 'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(ingest_or_fail, transfers))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Download Inside Airbnb files for each market into S3')
+    parser.add_argument('--markets', nargs='+', default=MARKETS)
+    parser.add_argument('--bucket', default=BUCKET_NAME)
+    parser.add_argument('--max-workers', type=int, default=MAX_CONCURRENT_DOWNLOADS)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = ingest_markets(args.markets, args.bucket, args.max_workers)
+    print(json.dumps(results, indent=4))
+    print(f'Ingested {len(results)} files in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,291 @@
+## this file contains the parallel listings processing pipeline from raw .csv.gz to processed Parquet on S3
+import os
+import gzip
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import boto3
+from botocore.config import Config
+
+from s3_loader import BUCKET_NAME, S3MultipartWriter
+
+logger = logging.getLogger(__name__)
+
+RAW_LISTINGS_PREFIX = 'raw/listings/'
+PROCESSED_LISTINGS_PREFIX = 'processed/listings/'
+
+# Rows decoded, cleaned and written as one Parquet row group at a time
+CHUNK_SIZE = 50_000
+
+DATE_COLUMNS = ['last_scraped', 'host_since', 'calendar_last_scraped', 'first_review', 'last_review']
+
+COLUMNS_TO_DROP = ['source', 'calendar_updated', 'listing_url', 'picture_url', 'host_url', 'host_thumbnail_url',
+                   'host_picture_url', 'neighbourhood_group_cleansed']
+
+# Explicit dtypes keep every chunk on the same schema and skip type inference;
+# columns not listed here (e.g. added by a newer scrape) are still inferred
+INTEGER_COLUMNS = [
+    'id', 'scrape_id', 'host_id', 'accommodates', 'minimum_nights', 'maximum_nights',
+    'minimum_minimum_nights', 'maximum_minimum_nights', 'minimum_maximum_nights', 'maximum_maximum_nights',
+    'availability_30', 'availability_60', 'availability_90', 'availability_365',
+    'number_of_reviews', 'number_of_reviews_ltm', 'number_of_reviews_l30d',
+    'calculated_host_listings_count', 'calculated_host_listings_count_entire_homes',
+    'calculated_host_listings_count_private_rooms', 'calculated_host_listings_count_shared_rooms'
+]
+FLOAT_COLUMNS = [
+    'host_listings_count', 'host_total_listings_count', 'latitude', 'longitude', 'bathrooms', 'bedrooms', 'beds',
+    'minimum_nights_avg_ntm', 'maximum_nights_avg_ntm', 'review_scores_rating', 'review_scores_accuracy',
+    'review_scores_cleanliness', 'review_scores_checkin', 'review_scores_communication',
+    'review_scores_location', 'review_scores_value', 'reviews_per_month'
+]
+STRING_COLUMNS = [
+    'listing_url', 'last_scraped', 'source', 'name', 'description', 'neighborhood_overview', 'picture_url',
+    'host_url', 'host_name', 'host_since', 'host_location', 'host_about', 'host_response_time',
+    'host_response_rate', 'host_acceptance_rate', 'host_is_superhost', 'host_thumbnail_url', 'host_picture_url',
+    'host_neighbourhood', 'host_verifications', 'host_has_profile_pic', 'host_identity_verified', 'neighbourhood',
+    'neighbourhood_cleansed', 'neighbourhood_group_cleansed', 'property_type', 'room_type', 'bathrooms_text',
+    'amenities', 'price', 'calendar_updated', 'has_availability', 'calendar_last_scraped', 'first_review',
+    'last_review', 'license', 'instant_bookable'
+]
+LISTINGS_DTYPES = {
+    **{col: 'Int64' for col in INTEGER_COLUMNS},
+    **{col: 'float64' for col in FLOAT_COLUMNS},
+    **{col: str for col in STRING_COLUMNS}
+}
+
+
+def market_from_key(key):
+    """
+    Returns the market of a raw listings file, e.g. raw/listings/new-york-city-listings.csv.gz -> new-york-city.
+    """
+    file_name = key.split('/')[-1]
+    return '-'.join(file_name.split('-')[:-1])
+
+
+def processed_listings_key(market_name, prefix=PROCESSED_LISTINGS_PREFIX):
+    return f'{prefix}{market_name}-listings_processed.parquet'
+
+
+def list_files_in_folder(bucket_name, folder_prefix, client=None):
+    """
+    Lists the files (not folders) under a prefix.
+    """
+    client = client if client is not None else boto3.client('s3')
+    obj_list = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=folder_prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                obj_list.append(obj['Key'])
+    return obj_list
+
+
+def read_listings_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Decompresses and parses a listings .csv.gz in chunks.
+
+    Args:
+        fileobj (file-like): Gzip compressed CSV, e.g. an S3 StreamingBody; read sequentially.
+        chunk_size (int, optional): Rows per chunk.
+
+    Returns:
+        pandas TextFileReader: Iterator of DataFrames.
+    """
+    return pd.read_csv(gzip.GzipFile(fileobj=fileobj), dtype=LISTINGS_DTYPES, chunksize=chunk_size)
+
+
+def clean_listings_data(df, market_name):
+    """
+    Cleans a chunk of listings in place; the same steps as the original notebook, vectorized.
+
+    Args:
+        df (pd.DataFrame): Raw listings.
+        market_name (str): Market of the listings.
+
+    Returns:
+        pd.DataFrame: Cleaned listings, without the dropped columns. Duplicates are removed
+            by the caller, see process_market.
+    """
+    # Add market name column
+    df['market'] = market_name
+
+    # Remove $ from price and convert to numeric
+    df['price'] = pd.to_numeric(df['price'].str.replace('$', '', regex=False), errors='coerce')
+    df['host_response_rate'] = df['host_response_rate'].str.replace('%', '', regex=False).astype(float)
+    df['host_acceptance_rate'] = df['host_acceptance_rate'].str.replace('%', '', regex=False).astype(float)
+
+    # Convert list of amenities into a string
+    df['amenities'] = (df['amenities'].str.replace('"', '', regex=False).str.replace('[', '', regex=False)
+                       .str.replace(']', '', regex=False).str.replace('\\u2013', '-', regex=False))
+
+    # Convert superhost column from 'f' or 't' to 0 or 1
+    df['host_is_superhost'] = df['host_is_superhost'].map({'f': 0, 't': 1}).fillna(0).astype(int)
+    df['host_verifications'] = (df['host_verifications'].str.replace("'", '', regex=False)
+                                .str.replace('[', '', regex=False).str.replace(']', '', regex=False))
+
+    df['license'] = df['license'].astype('str')
+
+    # Dates are kept as datetimes here and written as Parquet dates, see to_arrow
+    for col in DATE_COLUMNS:
+        df[col] = pd.to_datetime(df[col], format='%Y-%m-%d', errors='coerce')
+
+    return df.drop(columns=[col for col in COLUMNS_TO_DROP if col in df.columns])
+
+
+def drop_seen_duplicates(df, seen_hashes):
+    """
+    Drops rows duplicated within the chunk or seen in an earlier chunk of the same file.
+
+    Args:
+        df (pd.DataFrame): Cleaned chunk.
+        seen_hashes (set): 64-bit row hashes of earlier chunks; updated in place.
+
+    Returns:
+        tuple: (deduplicated chunk, number of rows dropped).
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    keep = ~pd.Series(row_hashes).duplicated().to_numpy()
+    if seen_hashes:
+        keep &= ~np.isin(row_hashes, np.fromiter(seen_hashes, dtype=np.uint64, count=len(seen_hashes)))
+    seen_hashes.update(row_hashes[keep].tolist())
+    dropped = int(len(df) - keep.sum())
+    return (df[keep] if dropped else df), dropped
+
+
+def to_arrow(df, schema=None):
+    """
+    Converts a cleaned chunk to an Arrow table, casting to schema when given.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for col in DATE_COLUMNS:
+        index = table.schema.get_field_index(col)
+        if index >= 0:
+            table = table.set_column(index, col, table.column(index).cast(pa.date32()))
+    return table if schema is None else table.cast(schema)
+
+
+def write_listings_parquet(chunks, sink, market_name):
+    """
+    Cleans chunks of listings and writes each as a Parquet row group as soon as it is ready.
+
+    Args:
+        chunks (iterable): Raw listings DataFrames, see read_listings_chunks.
+        sink (str or file-like): Parquet destination, e.g. an S3MultipartWriter.
+        market_name (str): Market of the listings.
+
+    Returns:
+        dict: Rows written and duplicate rows dropped.
+    """
+    writer = None
+    seen_hashes = set()
+    rows = duplicates = 0
+    try:
+        for chunk in chunks:
+            cleaned, dropped = drop_seen_duplicates(clean_listings_data(chunk, market_name), seen_hashes)
+            table = to_arrow(cleaned, writer.schema if writer is not None else None)
+            if writer is None:
+                writer = pq.ParquetWriter(sink, table.schema)
+            writer.write_table(table)
+            rows += len(cleaned)
+            duplicates += dropped
+    finally:
+        if writer is not None:
+            writer.close()
+    return {'rows': rows, 'duplicates': duplicates}
+
+
+def _client():
+    # Each worker process opens its own client; boto3 clients must not cross a fork
+    return boto3.client('s3', config=Config(retries={'max_attempts': 5, 'mode': 'standard'}))
+
+
+def process_market(key, bucket_name=BUCKET_NAME, output_prefix=PROCESSED_LISTINGS_PREFIX, chunk_size=CHUNK_SIZE):
+    """
+    Streams one raw listings file from S3 through the cleaning steps back to S3 as Parquet.
+
+    The gzip body is decoded while it downloads and the Parquet is uploaded part by part,
+    so memory stays around one chunk plus one upload part regardless of the file size.
+
+    Args:
+        key (str): Raw listings key, e.g. raw/listings/albany-listings.csv.gz.
+        bucket_name (str, optional): Bucket holding the raw and processed files.
+        output_prefix (str, optional): Prefix of the processed files.
+        chunk_size (int, optional): Rows per chunk and Parquet row group.
+
+    Returns:
+        dict: Market, output key, rows, duplicates and seconds.
+    """
+    start = time.perf_counter()
+    client = _client()
+    market_name = market_from_key(key)
+    output_key = processed_listings_key(market_name, output_prefix)
+
+    logger.info(f'Processing file: {key}')
+    body = client.get_object(Bucket=bucket_name, Key=key)['Body']
+    try:
+        with S3MultipartWriter(bucket_name, output_key, client=client) as sink:
+            result = write_listings_parquet(read_listings_chunks(body, chunk_size), sink, market_name)
+    finally:
+        body.close()
+
+    result.update({'market': market_name, 'key': output_key, 'seconds': time.perf_counter() - start})
+    logger.info(f'Found {result["duplicates"]} duplicate rows for market: {market_name}')
+    print(f"File uploaded to S3 bucket '{bucket_name}' with key '{output_key}' "
+          f"({result['rows']} rows in {result['seconds']:.1f}s)")
+    return result
+
+
+def process_files(bucket_name=BUCKET_NAME, folder_prefix=RAW_LISTINGS_PREFIX, output_prefix=PROCESSED_LISTINGS_PREFIX,
+                  processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Processes every raw listings file under a prefix, one market per worker process.
+
+    Args:
+        bucket_name (str, optional): Bucket holding the raw and processed files.
+        folder_prefix (str, optional): Prefix of the raw .csv.gz files.
+        output_prefix (str, optional): Prefix of the processed files.
+        processes (int, optional): Worker processes. Defaults to the CPU count; 1 runs in-process.
+        chunk_size (int, optional): Rows per chunk and Parquet row group.
+
+    Returns:
+        list: process_market results in the order of the raw files.
+    """
+    items = list_files_in_folder(bucket_name, folder_prefix, client=_client())
+    processes = min(processes or os.cpu_count() or 1, max(len(items), 1))
+
+    if processes == 1:
+        return [process_market(item, bucket_name, output_prefix, chunk_size) for item in items]
+
+    # spawn so no worker inherits the parent's connections or locks
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(process_market, item, bucket_name, output_prefix, chunk_size): item
+                   for item in items}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return [results[item] for item in items]
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Clean raw listings files and upload them as Parquet')
+    parser.add_argument('--bucket', default=BUCKET_NAME)
+    parser.add_argument('--input-prefix', default=RAW_LISTINGS_PREFIX)
+    parser.add_argument('--output-prefix', default=PROCESSED_LISTINGS_PREFIX)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = process_files(args.bucket, args.input_prefix, args.output_prefix, args.processes, args.chunk_size)
+    print(json.dumps(results, indent=4))
+    print(f'Processed {len(results)} markets in {time.perf_counter() - start:.1f}s')
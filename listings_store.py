@@ -0,0 +1,206 @@
+## this file contains the columnar, memory-mapped store for listings_cleaned_h3
+import os
+import json
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.ipc as ipc
+
+from s3_loader import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+LISTINGS_CSV_KEY = 'models/listings_cleaned_h3.csv'
+LISTINGS_STORE_KEY = 'models/listings_cleaned_h3.arrow'
+LISTINGS_STORE_FILE = 'listings_cleaned_h3.arrow'
+
+# Schema metadata key holding the market of each record batch
+MARKETS_METADATA_KEY = b'markets'
+
+
+def build_listings_store(source, path):
+    """
+    Converts listings_cleaned_h3 to an Arrow IPC file with one record batch per market.
+
+    Args:
+        source (bytes, str or pa.Table): CSV contents, path to a CSV file, or an Arrow table.
+        path (str): Destination of the Arrow IPC file.
+
+    Returns:
+        list: Markets written, in batch order.
+    """
+    if isinstance(source, pa.Table):
+        table = source
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        # Parse straight from the downloaded buffer instead of decoding to a str first
+        table = pa_csv.read_csv(pa.BufferReader(source))
+    else:
+        table = pa_csv.read_csv(source)
+
+    table = table.sort_by('market')
+    markets = [market for market in pc.unique(table['market']).to_pylist() if market is not None]
+    counts = pc.value_counts(table['market']).to_pylist()
+    market_counts = {item['values']: item['counts'] for item in counts}
+
+    schema = table.schema.with_metadata({MARKETS_METADATA_KEY: json.dumps(markets).encode('utf-8')})
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with ipc.new_file(sink, schema) as writer:
+            offset = 0
+            for market in markets:
+                # Rows are sorted by market, so each market is one contiguous slice
+                market_table = table.slice(offset, market_counts[market]).combine_chunks()
+                writer.write_batch(market_table.to_batches()[0])
+                offset += market_counts[market]
+
+    # Replace atomically so a reader never maps a partially written file
+    os.replace(tmp_path, path)
+    logger.info(f'Wrote {table.num_rows} listings for {len(markets)} markets to {path}')
+    return markets
+
+
+def listings_version(store):
+    """
+    Returns the version of a listings store.
+
+    Store files are named after the ETag they came from, either the published store's or the
+    converted CSV's, so the file name changes whenever the listings are republished.
+    """
+    return os.path.basename(store.path)
+
+
+class ListingsStore:
+    """
+    Read-only view over a listings Arrow IPC file.
+
+    The file is memory mapped, so every reader in the process (and every process on the
+    host) shares the operating system's page cache instead of holding its own copy.
+    Filtering to one market only touches that market's record batch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._source = pa.memory_map(path, 'r')
+        self._reader = ipc.open_file(self._source)
+
+        markets = json.loads(self._reader.schema.metadata[MARKETS_METADATA_KEY].decode('utf-8'))
+        self._batch_index = {market: i for i, market in enumerate(markets)}
+
+    @property
+    def markets(self):
+        return list(self._batch_index)
+
+    @property
+    def schema(self):
+        return self._reader.schema
+
+    @property
+    def num_rows(self):
+        return sum(self._reader.get_batch(i).num_rows for i in range(self._reader.num_record_batches))
+
+    def market_table(self, market, columns=None):
+        """
+        Returns one market's rows as a zero-copy Arrow table.
+
+        Args:
+            market (str): Market name, e.g. new-york-city.
+            columns (list, optional): Columns to keep.
+
+        Returns:
+            pa.Table: The market's rows. Empty when the market is not in the store.
+        """
+        if market not in self._batch_index:
+            table = self._reader.schema.empty_table()
+        else:
+            table = pa.Table.from_batches([self._reader.get_batch(self._batch_index[market])])
+
+        if columns is not None:
+            table = table.select(columns)
+        return table
+
+    def market(self, market, columns=None):
+        """
+        Returns one market's rows as a pandas DataFrame.
+
+        Args:
+            market (str): Market name, e.g. new-york-city.
+            columns (list, optional): Columns to load.
+
+        Returns:
+            pd.DataFrame: The market's rows.
+        """
+        return self.market_table(market, columns).to_pandas()
+
+    def table(self, columns=None):
+        """
+        Returns every market as a zero-copy Arrow table.
+
+        Args:
+            columns (list, optional): Columns to keep.
+
+        Returns:
+            pa.Table: All rows of the store.
+        """
+        table = self._reader.read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table
+
+    def to_pandas(self, columns=None):
+        """
+        Materializes all markets as a pandas DataFrame; pass columns to load only what is needed.
+        """
+        return self.table(columns).to_pandas()
+
+
+def open_listings_store(object_cache, cache_dir=CACHE_DIR):
+    """
+    Opens the listings store, building it from the CSV the first time a CSV version is seen.
+
+    The published Arrow artifact is memory mapped straight from the S3 object cache when it
+    exists, otherwise the CSV is converted to a local Arrow file named after its ETag.
+
+    Args:
+        object_cache (s3_loader.S3ObjectCache): Shared S3 loader.
+        cache_dir (str, optional): Directory holding locally built Arrow files.
+
+    Returns:
+        ListingsStore: Memory-mapped store.
+    """
+    try:
+        return ListingsStore(object_cache.get_path(LISTINGS_STORE_KEY))
+    except FileNotFoundError:
+        logger.info(f'{LISTINGS_STORE_KEY} is not published, converting {LISTINGS_CSV_KEY} instead')
+
+    csv_object = object_cache.fetch(LISTINGS_CSV_KEY)
+    stem, extension = os.path.splitext(LISTINGS_STORE_FILE)
+    path = os.path.join(cache_dir, f'{stem}-{csv_object.etag}{extension}')
+
+    if not os.path.exists(path):
+        build_listings_store(csv_object.path, path)
+
+    return ListingsStore(path)
+
+
+if __name__ == '__main__':
+    import argparse
+    from s3_loader import S3ObjectCache
+
+    parser = argparse.ArgumentParser(description='Build and publish the Arrow listings store')
+    parser.add_argument('--bucket', default='airbnb-capstone-project')
+    parser.add_argument('--output', default=os.path.join(CACHE_DIR, LISTINGS_STORE_FILE))
+    parser.add_argument('--upload', action='store_true', help=f'Upload the store to {LISTINGS_STORE_KEY}')
+    args = parser.parse_args()
+
+    object_cache = S3ObjectCache(bucket_name=args.bucket)
+
+    markets = build_listings_store(object_cache.get_path(LISTINGS_CSV_KEY), args.output)
+    print(f'Listings store written to {args.output} for markets {markets}')
+
+    if args.upload:
+        object_cache.client.upload_file(args.output, args.bucket, LISTINGS_STORE_KEY)
+        print(f'Listings store uploaded to s3://{args.bucket}/{LISTINGS_STORE_KEY}')
@@ -0,0 +1,143 @@
+## this file contains the choropleth map builder and the cross-session cache of rendered map HTML
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the memory held by rendered maps, shared by every session in the process
+MAP_CACHE_MAX_BYTES = int(os.getenv('AIRBNB_MAP_CACHE_MB', '64')) * 1024 * 1024
+
+_map_cache = None
+_map_cache_lock = threading.Lock()
+
+
+class HTMLCache:
+    """
+    Thread safe LRU cache of rendered HTML bounded by total size.
+
+    Entries are evicted least recently used first once the UTF-8 size of the cached strings exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes=MAP_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def put(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            logger.warning(f'Rendered map for {key} is {size} bytes, larger than the cache; not cached')
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = html
+            self._size += size
+
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def get_or_render(self, key, render):
+        """
+        Returns the cached HTML for key, calling render() and caching its result on a miss.
+        """
+        html = self.get(key)
+        if html is None:
+            html = render()
+            self.put(key, html)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+def get_map_cache():
+    """
+    Returns the process wide rendered map cache shared by both map pages.
+    """
+    global _map_cache
+    with _map_cache_lock:
+        if _map_cache is None:
+            _map_cache = HTMLCache()
+        return _map_cache
+
+
+def build_choropleth_map(geojson_data, data, columns, legend_name, map_center):
+    """
+    Builds the hexagon choropleth used by the map pages.
+
+    Args:
+        geojson_data (dict): Hexagons of the market.
+        data (pd.DataFrame): Values per hexagon.
+        columns (list): [h3_index column, value column].
+        legend_name (str): Legend title.
+        map_center (list): [latitude, longitude] the map opens on.
+
+    Returns:
+        folium.Map: Map with the choropleth and tile layers.
+    """
+    # folium is only imported when a map has to be rendered, not on a cache hit
+    import folium
+
+    m = folium.Map(location=map_center, zoom_start=10, tiles='CartoDB positron')
+
+    # Add Choropleth layer
+    folium.Choropleth(
+        geo_data=geojson_data,
+        data=data,
+        columns=columns,
+        key_on='feature.properties.h3_index',
+        fill_color='OrRd',
+        name='Hexagon',
+        fill_opacity=0.5,
+        line_opacity=0.2,
+        legend_name=legend_name
+    ).add_to(m)
+
+    # Add tile layers for different viewing modes
+    folium.TileLayer('cartodbdark_matter', overlay=True, name='Dark Mode', show=False).add_to(m)
+    folium.TileLayer('openstreetmap', overlay=True, name='Open Street Map', show=False).add_to(m)
+    folium.LayerControl(collapsed=True).add_to(m)
+
+    return m
+
+
+def render_map_html(m):
+    """
+    Renders a folium map to the standalone HTML document streamlit_folium.folium_static embeds.
+    """
+    import folium
+
+    return folium.Figure().add_child(m).render()
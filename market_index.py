@@ -0,0 +1,73 @@
+## this file contains the per-market index and stats table used by the dashboard pages
+import numpy as np
+import pandas as pd
+
+# Hexagon level features the H3 model takes as market medians
+MEDIAN_COLUMNS = ['accommodates_median', 'bathrooms_median', 'beds_median', 'price_median']
+
+
+class MarketIndex:
+    """
+    Holds a DataFrame sorted by market so each market's rows are one contiguous slice.
+
+    The sort and slice boundaries are computed once when the data is loaded; looking up a
+    market afterwards is a dictionary lookup plus a positional slice instead of a boolean
+    scan over every market.
+    """
+
+    def __init__(self, df, market_column='market'):
+        self.market_column = market_column
+        self.data = df.sort_values(market_column, kind='stable').reset_index(drop=True)
+
+        markets = self.data[market_column].to_numpy()
+        uniques, starts = np.unique(markets, return_index=True)
+        stops = np.append(starts[1:], len(markets))
+        self._slices = {market: slice(start, stop) for market, start, stop in zip(uniques, starts, stops)}
+
+    @property
+    def markets(self):
+        return list(self._slices)
+
+    def __contains__(self, market):
+        return market in self._slices
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, market):
+        """
+        Returns the rows for one market.
+
+        Args:
+            market (str): Market name, e.g. new-york-city.
+
+        Returns:
+            pd.DataFrame: The market's rows; empty when the market is not indexed.
+        """
+        return self.data.iloc[self._slices.get(market, slice(0, 0))]
+
+
+def build_market_stats(market_index, columns=None, agg='median'):
+    """
+    Precomputes one row of summary statistics per market.
+
+    Args:
+        market_index (MarketIndex): Indexed data.
+        columns (list, optional): Columns to summarize. Defaults to all numeric columns.
+        agg (str or list, optional): Aggregation(s) accepted by DataFrame.agg.
+
+    Returns:
+        pd.DataFrame: Statistics indexed by market.
+    """
+    if columns is None:
+        columns = market_index.data.select_dtypes('number').columns.tolist()
+
+    stats = {market: market_index.get(market)[columns].agg(agg) for market in market_index.markets}
+
+    if isinstance(agg, str):
+        return pd.DataFrame.from_dict(stats, orient='index')
+
+    # Flatten to column names like price_median when several aggregations are requested
+    rows = {market: {f'{column}_{name}': value for (name, column), value in stat.stack().items()}
+            for market, stat in stats.items()}
+    return pd.DataFrame.from_dict(rows, orient='index')
@@ -0,0 +1,162 @@
+## this file contains the precomputed price statistics, histogram and boxplot data for the Market Analysis page
+import os
+import json
+import logging
+import numpy as np
+import pyarrow.compute as pc
+
+from s3_loader import CACHE_DIR
+from listings_store import listings_version
+
+logger = logging.getLogger(__name__)
+
+MARKET_SUMMARY_KEY = 'models/market_summary.json'
+MARKET_SUMMARY_FILE = 'market_summary.json'
+
+# Same number of bins the page used to pass to plt.hist
+HISTOGRAM_BINS = 30
+
+# Outliers kept per market for the boxplot; thinned evenly over their sorted values, extremes included
+MAX_FLIERS = 200
+
+
+def _thin(values, max_values):
+    values = np.sort(np.asarray(values, dtype=float))
+    if len(values) <= max_values:
+        return values
+    return values[np.linspace(0, len(values) - 1, max_values).round().astype(int)]
+
+
+def boxplot_stats(prices, label, max_fliers=MAX_FLIERS):
+    """
+    Computes the statistics matplotlib's Axes.bxp draws one box from.
+
+    Args:
+        prices (np.ndarray): Prices of one market, without NaN.
+        label (str): Box label.
+        max_fliers (int, optional): Outliers kept, see MAX_FLIERS.
+
+    Returns:
+        dict: label, med, q1, q3, whislo, whishi and fliers, as plain floats.
+    """
+    # Imported here so loading the summary doesn't import matplotlib
+    from matplotlib.cbook import boxplot_stats as matplotlib_boxplot_stats
+
+    stats = matplotlib_boxplot_stats(prices, whis=1.5)[0]
+    return {
+        'label': label,
+        'med': float(stats['med']),
+        'q1': float(stats['q1']),
+        'q3': float(stats['q3']),
+        'whislo': float(stats['whislo']),
+        'whishi': float(stats['whishi']),
+        'fliers': _thin(stats['fliers'], max_fliers).tolist()
+    }
+
+
+def build_market_summary(store, bins=HISTOGRAM_BINS, max_fliers=MAX_FLIERS):
+    """
+    Aggregates the listings store into everything the Market Analysis page draws.
+
+    Args:
+        store (listings_store.ListingsStore): Listings to summarize.
+        bins (int, optional): Histogram bins over all markets.
+        max_fliers (int, optional): Outliers kept per market in the boxplot.
+
+    Returns:
+        dict: listings_version and num_rows of the store, per-market summary stats, histogram
+        edges and counts, and one boxplot entry per market in store order.
+    """
+    markets = {}
+    boxplots = []
+    for market in store.markets:
+        table = store.market_table(market, ['price'])
+        prices = pc.drop_null(table['price']).to_numpy(zero_copy_only=False).astype(float)
+        prices = prices[~np.isnan(prices)]
+        if len(prices) == 0:
+            continue
+
+        markets[market] = {
+            'count': table.num_rows,
+            'min': float(prices.min()),
+            'max': float(prices.max()),
+            'median': float(np.median(prices))
+        }
+        boxplots.append(boxplot_stats(prices, market, max_fliers))
+
+    all_prices = pc.drop_null(store.table(['price'])['price']).to_numpy(zero_copy_only=False).astype(float)
+    counts, edges = np.histogram(all_prices[~np.isnan(all_prices)], bins=bins)
+
+    return {
+        'listings_version': listings_version(store),
+        'num_rows': store.num_rows,
+        'markets': markets,
+        'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()},
+        'boxplot': boxplots
+    }
+
+
+def write_market_summary(summary, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(summary, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load_market_summary(object_cache, store, cache_dir=CACHE_DIR):
+    """
+    Returns the summary of the listings store.
+
+    Uses the published artifact when it was built from the same version of the listings,
+    otherwise builds it locally once per store file.
+
+    Args:
+        object_cache (s3_loader.S3ObjectCache): Shared S3 loader.
+        store (listings_store.ListingsStore): Listings shown on the page.
+        cache_dir (str, optional): Directory holding locally built summaries.
+
+    Returns:
+        dict: See build_market_summary.
+    """
+    try:
+        with open(object_cache.get_path(MARKET_SUMMARY_KEY)) as f:
+            summary = json.load(f)
+        if summary.get('listings_version') == listings_version(store):
+            return summary
+        logger.info(f'{MARKET_SUMMARY_KEY} was built from other listings, rebuilding it locally')
+    except FileNotFoundError:
+        logger.info(f'{MARKET_SUMMARY_KEY} is not published, building it from the listings store')
+
+    stem, extension = os.path.splitext(MARKET_SUMMARY_FILE)
+    store_stem = os.path.splitext(os.path.basename(store.path))[0]
+    path = os.path.join(cache_dir, f'{stem}-{store_stem}{extension}')
+
+    if not os.path.exists(path):
+        write_market_summary(build_market_summary(store), path)
+
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    import argparse
+    from s3_loader import S3ObjectCache
+    from listings_store import open_listings_store
+
+    parser = argparse.ArgumentParser(description='Build and publish the Market Analysis summary')
+    parser.add_argument('--bucket', default='airbnb-capstone-project')
+    parser.add_argument('--output', default=os.path.join(CACHE_DIR, MARKET_SUMMARY_FILE))
+    parser.add_argument('--upload', action='store_true', help=f'Upload the summary to {MARKET_SUMMARY_KEY}')
+    args = parser.parse_args()
+
+    object_cache = S3ObjectCache(bucket_name=args.bucket)
+
+    summary = build_market_summary(open_listings_store(object_cache))
+    write_market_summary(summary, args.output)
+    print(f'Summary of {summary["num_rows"]} listings in {len(summary["markets"])} markets written to {args.output} '
+          f'({os.path.getsize(args.output) / 1024:.0f} KB)')
+
+    if args.upload:
+        object_cache.client.upload_file(args.output, args.bucket, MARKET_SUMMARY_KEY)
+        print(f'Summary uploaded to s3://{args.bucket}/{MARKET_SUMMARY_KEY}')
@@ -1,69 +1,144 @@
+# Start timing before the imports so their cost shows up in the profile
+from startup_profiler import page_profiler, render_profile
+profiler = page_profiler('Price Prediction')
+
+import threading
 import streamlit as st
 import pandas as pd
-import joblib
-import folium
-from streamlit_folium import folium_static
-import json
-import boto3
-from io import BytesIO, StringIO
+import streamlit.components.v1 as components
 import os
-from dotenv import load_dotenv
-
-# Load environment variables from a .env file
-load_dotenv()
-
-try:
-    AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
-    AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
-    
-    if not AWS_ACCESS_KEY_ID:
-        raise ValueError("Environment variable AWS_ACCESS_KEY_ID must be set")
-    if not AWS_SECRET_ACCESS_KEY:
-        raise ValueError("Environment variable AWS_SECRET_ACCESS_PWD must be set")
-
-except ValueError as ve:
-    print(f"Error: {ve}")
-    
-except Exception as e:
-    print(f"An unexpected error occurred: {e}")
-
-
-# Initialize S3 client
-s3 = boto3.client('s3',
-                  aws_access_key_id=AWS_ACCESS_KEY_ID,
-                  aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
-
-bucket_name = 'airbnb-capstone-project'
-def read_s3_file(file_key):
-    obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-    return obj['Body'].read()
-
-# Use st.cache_data to cache data first time its downloaded
-@st.cache_data
-def load_model(allow_output_mutation=True):
-    model_data = read_s3_file('models/model_h3.joblib')
-    return joblib.load(BytesIO(model_data))
-
-@st.cache_data
-def load_hexagon_data():
+import logging
+from io import BytesIO
+from s3_loader import get_object_cache
+from hexagon_geojson import HEXAGON_GEOJSON_KEY, load_market_geojson
+from prediction_cache import MODEL_KEY, load_market_predictions, invalidate_prediction_cache
+from listings_store import LISTINGS_CSV_KEY, LISTINGS_STORE_KEY, open_listings_store, listings_version
+from market_index import MarketIndex, build_market_stats, MEDIAN_COLUMNS
+from hexagon_index import HexagonIndex, with_hexagon_features
+from pricing import FastPricer
+from forest_export import COMPACT_MODEL_KEY, load_compact_pricer
+from map_cache import get_map_cache, build_choropleth_map, render_map_html
+from pricing_service import PricingServiceError, get_pricing_client
+from price_table import GRID, load_price_table
+profiler.mark('imports')
+
+# Shared S3 loader: one pooled client and a local disk cache revalidated by ETag
+s3_cache = get_object_cache()
+read_s3_file = s3_cache.get_object
+
+# Download independent artifacts in parallel on a cold start, in the background so the page renders meanwhile
+@st.cache_resource
+def prefetch_artifacts():
+    thread = threading.Thread(target=s3_cache.prefetch, daemon=True,
+                              args=([LISTINGS_STORE_KEY, LISTINGS_CSV_KEY, HEXAGON_GEOJSON_KEY,
+                                     COMPACT_MODEL_KEY, 'models/hexagon_data.csv'],))
+    thread.start()
+    return thread
+
+# Check the model version every few minutes so a re-uploaded model invalidates cached predictions
+@st.cache_data(ttl=300)
+def load_model_version():
+    # A HEAD request is enough when the pickled pipeline isn't needed, see load_pricer
+    return s3_cache.etag(MODEL_KEY, download=False)
+
+# Use st.cache_resource so every session shares one copy of the model for a given version
+@st.cache_resource(max_entries=1)
+def load_model(model_version):
+    # joblib (and scikit-learn with it) is only imported when there is no compact forest to load
+    import joblib
+    return joblib.load(s3_cache.get_path(MODEL_KEY))
+
+# Index hexagons by market once per hexagon_data.csv version so lookups don't scan every market
+@st.cache_resource(max_entries=1)
+def load_hexagon_data(data_version):
     hexagon_data = read_s3_file('models/hexagon_data.csv')
-    return pd.read_csv(StringIO(hexagon_data.decode('utf-8')))
+    return MarketIndex(pd.read_csv(BytesIO(hexagon_data)))
 
-@st.cache_data
+# Market medians only change when hexagon_data.csv is republished
+@st.cache_resource(max_entries=1)
+def load_market_stats(data_version):
+    return build_market_stats(load_hexagon_data(data_version), columns=MEDIAN_COLUMNS)
+
+# Resolves a location to its hexagon's features, falling back to nearby and parent hexagons
+@st.cache_resource(max_entries=1)
+def load_hexagon_index(data_version):
+    return HexagonIndex(load_hexagon_data(data_version).data)
+
+# Use st.cache_resource so sessions share the memory-mapped store instead of copies of a DataFrame
+@st.cache_resource
 def load_listings_data():
-    listings_data = read_s3_file('models/listings_cleaned_h3.csv')
-    return pd.read_csv(StringIO(listings_data.decode('utf-8')))
+    return open_listings_store(s3_cache)
 
+# Load only the selected market's hexagons so the map HTML doesn't carry every market
 @st.cache_data
-def load_geojson_data():
-    geojson_data = read_s3_file('models/hexagon_data.geojson')
-    return json.loads(geojson_data.decode('utf-8'))
-
-# load model and data
-pipeline = load_model()
-hexagon_aggregated_data = load_hexagon_data()
-listings_cleaned_h3 = load_listings_data()
-geojson_data = load_geojson_data()
+def load_geojson_data(market):
+    return load_market_geojson(s3_cache, market)
+
+# Version of the listings and hexagons shown on the map
+@st.cache_data(ttl=300)
+def load_data_version():
+    return (listings_version(load_listings_data()), s3_cache.etag(HEXAGON_GEOJSON_KEY))
+
+# Prefer the memory-mapped forest exported from this model version; unpickle the pipeline otherwise
+@st.cache_resource(max_entries=1)
+def load_pricer(model_version):
+    try:
+        pricer = load_compact_pricer(s3_cache.get_path(COMPACT_MODEL_KEY), model_version)
+        if pricer is not None:
+            return pricer
+    except FileNotFoundError:
+        pass
+    return FastPricer(load_model(model_version))
+
+# Predictions are shared across sessions and keyed by model version, listings version and market
+@st.cache_resource
+def load_predictions(model_version, listings_version, market):
+    return load_market_predictions(lambda: load_pricer(model_version), listings_cleaned_h3.market(market), market,
+                                   model_version, listings_version)
+
+# Version of hexagon_data.csv, which the market medians in the price table come from
+@st.cache_data(ttl=300)
+def load_hexagon_data_version():
+    return s3_cache.etag('models/hexagon_data.csv', download=False)
+
+# Every input the form allows is priced ahead of time, so the button reads an array instead of calling the model
+@st.cache_resource(max_entries=1)
+def load_form_prices(model_version, data_version):
+    return load_price_table(s3_cache, model_version, data_version, lambda: load_pricer(model_version),
+                            lambda: load_market_stats(data_version))
+
+# Client for the shared pricing service when PRICING_SERVICE_URL is set; the page predicts in-process otherwise
+@st.cache_resource
+def pricing_client():
+    return get_pricing_client()
+
+def predict_prices(listing_specs):
+    client = pricing_client()
+    if client is not None:
+        try:
+            return client.predict(listing_specs)
+        except PricingServiceError as e:
+            logging.warning(f'{e}; predicting in-process')
+    return load_pricer(model_version).predict(listing_specs, load_market_stats(load_hexagon_data_version()))
+
+@st.cache_resource
+def active_model_version():
+    # Holds the model and listings versions the shared prediction cache was built for
+    return {'version': None}
+
+# Only what the map needs is loaded up front; the pricer and market stats wait for the button
+prefetch_artifacts()
+with profiler.phase('s3_fetch'):
+    model_version = load_model_version()
+with profiler.phase('parse'):
+    listings_cleaned_h3 = load_listings_data()
+current_listings_version = listings_version(listings_cleaned_h3)
+
+# Drop predictions made by a previous model or for previous listings when either is published
+if active_model_version()['version'] != (model_version, current_listings_version):
+    load_predictions.clear()
+    invalidate_prediction_cache(keep_version=model_version, keep_listings_version=current_listings_version)
+    active_model_version()['version'] = (model_version, current_listings_version)
 
 
 # Streamlit interface
@@ -82,102 +157,94 @@ markets_dict = {
 
 # User input fields
 market = st.selectbox("Market",  sorted(markets_dict.values()))
-room_type = st.selectbox("Room Type", ['Entire home/apt', 'Hotel room','Private room','Shared room'])
-beds = st.slider("Number of Beds", min_value=1, max_value=10, value=1)
-accommodates = st.slider("Accommodates", min_value=1, max_value=16, value=1)
-bathrooms = st.slider("Number of Bathrooms", min_value=1, max_value=6, value=1)
+room_type = st.selectbox("Room Type", GRID['room_type'])
+beds = st.slider("Number of Beds", min_value=min(GRID['beds']), max_value=max(GRID['beds']), value=1)
+accommodates = st.slider("Accommodates", min_value=min(GRID['accommodates']), max_value=max(GRID['accommodates']), value=1)
+bathrooms = st.slider("Number of Bathrooms", min_value=min(GRID['bathrooms']), max_value=max(GRID['bathrooms']), value=1)
 
 # Map the selected market back, e.g., New York City to new-york-city
 reverse_markets_dict = {v: k for k, v in markets_dict.items()}
 selected_market = reverse_markets_dict[market]
 
+# Optional listing location, priced with its hexagon's medians instead of the market's
+use_location = st.checkbox("Price at a specific location")
+if use_location:
+    center_latitude, center_longitude = load_hexagon_index(load_hexagon_data_version()).market_center(selected_market)
+    latitude = st.number_input("Latitude", min_value=-90.0, max_value=90.0, value=float(center_latitude), format="%.5f")
+    longitude = st.number_input("Longitude", min_value=-180.0, max_value=180.0, value=float(center_longitude), format="%.5f")
+
 if 'price_recommendation' not in st.session_state:
     st.session_state['price_recommendation'] = None
-
-if 'selected_market' not in st.session_state:
-    st.session_state['selected_market'] = None
-
-if 'map_data' not in st.session_state:
-    st.session_state['map_data'] = None
+    st.session_state['price_inputs'] = None
 
 # Predict button
 if st.button("Get Listing Price Prediction"):
-    # Filter hexagon_aggregated_data for the selected market
-    market_data = hexagon_aggregated_data[hexagon_aggregated_data['market'] == selected_market]
-    
-    # Calculate overall median values for the selected market
-    market_medians = market_data.median(numeric_only=True)
-
-    # Create input df for prediction
-    input_data = pd.DataFrame({
+    # Listing specs; the market medians are joined from the precomputed stats table
+    listing_specs = {
         'market': [selected_market],
         'room_type': [room_type],
         'accommodates': [accommodates],
         'bathrooms': [bathrooms],
-        'beds': [beds],
-        'accommodates_median': [market_medians['accommodates_median']],
-        'bathrooms_median': [market_medians['bathrooms_median']],
-        'beds_median': [market_medians['beds_median']],
-        'price_median': [market_medians['price_median']]
-    })
+        'beds': [beds]
+    }
 
-    # Make prediction using the loaded pipeline
-    predicted_price = pipeline.predict(input_data)
+    # Make prediction using the loaded pipeline's parameters without building a DataFrame
+    with profiler.phase('predict'):
+        if use_location:
+            listing_specs = with_hexagon_features({**listing_specs, 'latitude': [latitude], 'longitude': [longitude]},
+                                                  load_hexagon_index(load_hexagon_data_version()))
+            predicted_price = predict_prices(listing_specs)
+        else:
+            predicted_price = load_form_prices(model_version, load_hexagon_data_version()).predict(listing_specs)
 
-    # store result in session state
+    # store result in session state; the what-if chart is read from the price table, so only without a location
     st.session_state['price_recommendation'] = predicted_price
+    st.session_state['price_inputs'] = None if use_location else {name: values[0] for name, values in listing_specs.items()}
 
 price_recommendation = st.session_state['price_recommendation']
 
 if st.session_state['price_recommendation'] is not None:
     st.markdown(f"Recommended Price: **${price_recommendation[0]:.2f}**")
 
+# What-if curve: the price as one input changes and the others stay as entered
+price_inputs = st.session_state['price_inputs']
+if price_inputs is not None:
+    vary = st.selectbox("See how the price changes with", ['beds', 'accommodates', 'bathrooms'],
+                        format_func=lambda name: {'beds': 'Number of Beds', 'accommodates': 'Accommodates',
+                                                  'bathrooms': 'Number of Bathrooms'}[name])
+    price_table = load_form_prices(model_version, load_hexagon_data_version())
+    st.line_chart(price_table.sensitivity(vary, **price_inputs))
+
 st.write('')
 st.subheader(f'Predicted listing prices for {market}')
 st.write('Hexagons shown have a diameter of 1.4 km or 0.87 miles')
 
-# Additional feature: Filter listings and generate predictions
-if selected_market != st.session_state['selected_market']:
-    # Market has changed so update the map
-    st.session_state['selected_market'] = selected_market
-
-    # Filter the listings based on user input
-    filtered_listings = listings_cleaned_h3[listings_cleaned_h3['market'] == selected_market]
-
-    # Prepare the filtered data for prediction
-    filtered_input_data = filtered_listings.drop(columns=['price', 'latitude', 'longitude', 'h3_index'])
-
-    # Generate predictions for the filtered data
-    filtered_listings['predicted_price'] = pipeline.predict(filtered_input_data)
-
-    # Store the predictions in session state
-    st.session_state['map_data'] = filtered_listings
-
-    # Create a Folium map
-    map_center = [filtered_listings['latitude'].mean(), filtered_listings['longitude'].mean()]
-    m = folium.Map(location=map_center, zoom_start=10, tiles='CartoDB positron')
-
-    # Add Choropleth layer
-    folium.Choropleth(
-        geo_data=geojson_data,
-        data=filtered_listings,
-        columns=['h3_index', 'predicted_price'],
-        key_on='feature.properties.h3_index',
-        fill_color='OrRd',
-        name='Hexagon',
-        fill_opacity=0.5,
-        line_opacity=0.2,
-        legend_name='Predicted Listing Price'
-    ).add_to(m)
-
-    # Add tile layers for different viewing modes
-    folium.TileLayer('cartodbdark_matter', overlay=True, name='Dark Mode', show=False).add_to(m)
-    folium.TileLayer('openstreetmap', overlay=True, name='Open Street Map', show=False).add_to(m)
-    folium.LayerControl(collapsed=True).add_to(m)
-
-    # Use session_state to prevent the map from disappearing
-    st.session_state.m = m
-
-
-if st.session_state['map_data'] is not None:
-    folium_static(st.session_state['m'], width=700, height=500)
+def load_prediction_grid(market):
+    # The service keeps every market's grid in memory; read the precomputed predictions locally otherwise
+    client = pricing_client()
+    if client is not None:
+        try:
+            return client.market_grid(market)
+        except PricingServiceError as e:
+            logging.warning(f'{e}; predicting in-process')
+    filtered_listings, hexagon_predictions = load_predictions(model_version, current_listings_version, market)
+    return [filtered_listings['latitude'].mean(), filtered_listings['longitude'].mean()], hexagon_predictions
+
+def render_prediction_map(market):
+    with profiler.phase('predict'):
+        map_center, hexagon_predictions = load_prediction_grid(market)
+    with profiler.phase('parse'):
+        geojson_data = load_geojson_data(market)
+
+    with profiler.phase('map_render'):
+        m = build_choropleth_map(geojson_data, hexagon_predictions, ['h3_index', 'predicted_price'],
+                                 'Predicted Listing Price', map_center)
+        return render_map_html(m)
+
+# The rendered map only depends on market, model version and data version, so it is shared across sessions
+with profiler.phase('s3_fetch'):
+    map_key = ('prediction', selected_market, model_version, load_data_version())
+map_html = get_map_cache().get_or_render(map_key, lambda: render_prediction_map(selected_market))
+components.html(map_html, width=700, height=510)
+
+render_profile(profiler.finish(map_cache=get_map_cache().stats(), s3=dict(s3_cache.stats)))
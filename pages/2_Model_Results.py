@@ -1,41 +1,18 @@
+# Start timing before the imports so their cost shows up in the profile
+from startup_profiler import page_profiler, render_profile
+profiler = page_profiler('Model Results')
+
 import json
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-import joblib
-import boto3
-from io import BytesIO, StringIO
-import os
-from dotenv import load_dotenv
 import streamlit as st
+from s3_loader import get_object_cache
+profiler.mark('imports')
 
-load_dotenv()
-
-try:
-    AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
-    AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
-    
-    if not AWS_ACCESS_KEY_ID:
-        raise ValueError("Environment variable AWS_ACCESS_KEY_ID must be set")
-    if not AWS_SECRET_ACCESS_KEY:
-        raise ValueError("Environment variable AWS_SECRET_ACCESS_PWD must be set")
-
-except ValueError as ve:
-    print(f"Error: {ve}")
-    
-except Exception as e:
-    print(f"An unexpected error occurred: {e}")
-
-
-# Initialize S3 client
-s3 = boto3.client('s3',
-                  aws_access_key_id=AWS_ACCESS_KEY_ID,
-                  aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
-
-bucket_name = 'airbnb-capstone-project'
-def read_s3_file(file_key):
-    obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-    return obj['Body'].read()
+# Shared S3 loader: one pooled client and a local disk cache revalidated by ETag
+s3_cache = get_object_cache()
+read_s3_file = s3_cache.get_object
 
 @st.cache_data
 def load_experiment_logs():
@@ -43,7 +20,8 @@ def load_experiment_logs():
     return json.loads(json_data)
 
 # load experiment logs
-experiment_logs = load_experiment_logs()
+with profiler.phase('s3_fetch'):
+    experiment_logs = load_experiment_logs()
 
 st.title('Model Results')
 
@@ -97,8 +75,9 @@ def plot_model_performance():
 st.divider()
 st.subheader('Original Model')
 st.write('#### Model Performance')
-fig1 = plot_model_performance()
-st.pyplot(fig1)
+with profiler.phase('charts'):
+    fig1 = plot_model_performance()
+    st.pyplot(fig1)
 
 st.write('#### Feature Performance')
 st.image("images/feature_importance.png", use_column_width=True)
@@ -109,4 +88,6 @@ st.write('#### Correlation Matrix')
 st.image("images/h3_model_correlation_matrix.png", use_column_width=True)
 
 st.write('#### Distribution of errors')
-st.image("images/h3_model_errors.png", use_column_width=True)
\ No newline at end of file
+st.image("images/h3_model_errors.png", use_column_width=True)
+
+render_profile(profiler.finish(s3=dict(s3_cache.stats)))
\ No newline at end of file
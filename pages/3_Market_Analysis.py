@@ -1,64 +1,47 @@
-import pandas as pd
-import folium
-import h3
-import seaborn as sns
+# Start timing before the imports so their cost shows up in the profile
+from startup_profiler import page_profiler, render_profile
+profiler = page_profiler('Market Analysis')
+
+import numpy as np
 import matplotlib.pyplot as plt
 import streamlit as st
-from streamlit_folium import folium_static
-import json
-import boto3
-from io import BytesIO, StringIO
+import streamlit.components.v1 as components
 import os
-from dotenv import load_dotenv
+from io import BytesIO
+from s3_loader import get_object_cache
+from hexagon_geojson import HEXAGON_GEOJSON_KEY, load_market_geojson
+from listings_store import open_listings_store
+from market_summary import load_market_summary
+from map_cache import get_map_cache, build_choropleth_map, render_map_html
+profiler.mark('imports')
 
 st.title('Market Analysis')
 
-# Load environment variables from a .env file
-load_dotenv()
-
-try:
-    AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
-    AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
-    
-    if not AWS_ACCESS_KEY_ID:
-        raise ValueError("Environment variable AWS_ACCESS_KEY_ID must be set")
-    if not AWS_SECRET_ACCESS_KEY:
-        raise ValueError("Environment variable AWS_SECRET_ACCESS_PWD must be set")
-
-except ValueError as ve:
-    print(f"Error: {ve}")
-    
-except Exception as e:
-    print(f"An unexpected error occurred: {e}")
-
-
-# Initialize S3 client
-s3 = boto3.client('s3',
-                  aws_access_key_id=AWS_ACCESS_KEY_ID,
-                  aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+# Shared S3 loader: one pooled client and a local disk cache revalidated by ETag
+s3_cache = get_object_cache()
 
-# Initialize S3 client
-s3 = boto3.client('s3',
-                  aws_access_key_id=AWS_ACCESS_KEY_ID,
-                  aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+# Use st.cache_resource so sessions share the memory-mapped store instead of copies of a DataFrame
+@st.cache_resource
+def load_listings_data():
+    return open_listings_store(s3_cache)
 
-bucket_name = 'airbnb-capstone-project'
-def read_s3_file(file_key):
-    obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-    return obj['Body'].read()
+# Price stats, histogram counts and boxplot quantiles are aggregated once per listings version
+@st.cache_resource
+def load_summary():
+    return load_market_summary(s3_cache, load_listings_data())
 
+# Load only the selected market's hexagons so the map HTML doesn't carry every market
 @st.cache_data
-def load_listings_data():
-    listings_data = read_s3_file('models/listings_cleaned_h3.csv')
-    return pd.read_csv(StringIO(listings_data.decode('utf-8')))
+def load_geojson_data(market):
+    return load_market_geojson(s3_cache, market)
 
-@st.cache_data
-def load_geojson_data():
-    geojson_data = read_s3_file('models/hexagon_data.geojson')
-    return json.loads(geojson_data.decode('utf-8'))
+# Version of the listings and hexagons shown on the map
+@st.cache_data(ttl=300)
+def load_data_version():
+    return (os.path.basename(load_listings_data().path), s3_cache.etag(HEXAGON_GEOJSON_KEY))
 
-listings_cleaned_h3 = load_listings_data()
-geojson_data = load_geojson_data()
+with profiler.phase('parse'):
+    listings_cleaned_h3 = load_listings_data()
 
 # create market mapping
 markets_dict = {
@@ -78,77 +61,53 @@ market = st.selectbox("Market",  sorted(markets_dict.values()))
 reverse_markets_dict = {v: k for k, v in markets_dict.items()}
 selected_market = reverse_markets_dict[market]
 
-if 'selected_market' not in st.session_state:
-    st.session_state['selected_market'] = None
-
-if 'map_data' not in st.session_state:
-    st.session_state['map_data'] = None
-
 st.subheader(f'Actual median listing prices for {market}')
 st.write('Hexagons shown have a diameter of 1.4 km or 0.87 miles')
 st.write('Summary Statistics')
 
-# Additional feature: Filter listings and generate predictions
-if selected_market != st.session_state['selected_market']:
-    # Market has changed so update the map
-    st.session_state['selected_market'] = selected_market
+# Read the selected market's precomputed stats instead of scanning its listings
+with profiler.phase('parse'):
+    market_summary = load_summary()['markets'][selected_market]
 
-    # Filter the listings based on user input
-    filtered_listings = listings_cleaned_h3[listings_cleaned_h3['market'] == selected_market]
+    min_price = int(market_summary['min'])
+    max_price = int(market_summary['max'])
+    median_price = int(market_summary['median'])
+    unique_listings = market_summary['count']
 
-    min_price = int(filtered_listings['price'].min())
-    max_price = int(filtered_listings['price'].max())
-    median_price = int(filtered_listings['price'].median())
-    unique_listings = len(filtered_listings)
+st.markdown(f'- Number of listings: **{unique_listings}**')
+st.markdown(f'- Min price: **${min_price}**')
+st.markdown(f'- Median price: **${median_price}**')
+st.markdown(f'- Max price: **${max_price}**')
 
-    st.markdown(f'- Number of listings: **{unique_listings}**')
-    st.markdown(f'- Min price: **${min_price}**')
-    st.markdown(f'- Median price: **${median_price}**')
-    st.markdown(f'- Max price: **${max_price}**')
+def render_median_price_map(market):
+    with profiler.phase('parse'):
+        market_listings = listings_cleaned_h3.market(market, columns=['h3_index', 'price_median', 'latitude', 'longitude'])
+        hexagon_prices = market_listings[['h3_index', 'price_median']].drop_duplicates('h3_index')
+        geojson_data = load_geojson_data(market)
 
-    # Store the predictions in session state
-    st.session_state['map_data'] = filtered_listings
+    with profiler.phase('map_render'):
+        map_center = [market_listings['latitude'].mean(), market_listings['longitude'].mean()]
+        m = build_choropleth_map(geojson_data, hexagon_prices, ['h3_index', 'price_median'],
+                                 'Median Price', map_center)
+        return render_map_html(m)
 
-    # Create a Folium map
-    map_center = [filtered_listings['latitude'].mean(), filtered_listings['longitude'].mean()]
-    m = folium.Map(location=map_center, zoom_start=10, tiles='CartoDB positron')
-
-    # Add Choropleth layer
-    folium.Choropleth(
-        geo_data=geojson_data,
-        data=filtered_listings,
-        columns=['h3_index', 'price_median'],
-        key_on='feature.properties.h3_index',
-        fill_color='OrRd',
-        name='Hexagon',
-        fill_opacity=0.5,
-        line_opacity=0.2,
-        legend_name='Median Price'
-    ).add_to(m)
-
-    # Add tile layers for different viewing modes
-    folium.TileLayer('cartodbdark_matter', overlay=True, name='Dark Mode', show=False).add_to(m)
-    folium.TileLayer('openstreetmap', overlay=True, name='Open Street Map', show=False).add_to(m)
-    folium.LayerControl(collapsed=True).add_to(m)
-
-    # Use session_state to prevent the map from disappearing
-    st.session_state.m = m
-
-
-if st.session_state['map_data'] is not None:
-    folium_static(st.session_state['m'], width=700, height=500)
+# The rendered map only depends on market and data version, so it is shared across sessions
+with profiler.phase('s3_fetch'):
+    map_key = ('median_price', selected_market, load_data_version())
+map_html = get_map_cache().get_or_render(map_key, lambda: render_median_price_map(selected_market))
+components.html(map_html, width=700, height=510)
 
 
 st.divider()
 
 st.write("This histogram shows the range of Airbnb prices across markets to help you see how your property’s price compares to others. Use this to check if your pricing is competitive and consider adjustments to align with market trends.")
 
-def plot_histogram():
-    # Plot the histogram
+def plot_histogram(histogram):
+    # Plot the precomputed histogram counts
     fig = plt.figure(figsize=(10, 6))
 
-    # Drop NaN values and create the histogram
-    plt.hist(listings_cleaned_h3['price'].dropna(), bins=30, edgecolor='black')
+    edges = np.array(histogram['edges'])
+    plt.bar(edges[:-1], histogram['counts'], width=np.diff(edges), align='edge', edgecolor='black')
 
     # Add titles and labels
     plt.title('Distribution of Airbnb Prices for All Markets')
@@ -162,17 +121,37 @@ def plot_histogram():
     return fig
 
 st.write("The visualizations display Airbnb prices across markets with outliers removed to give you a clearer view of typical pricing. Outliers are identified and excluded based on the Interquartile Range (IQR), which is calculated using the 25th percentile (Q1) and the 75th percentile (Q3) of the price data. This method helps to remove extreme values that could skew the results and allow you to focus on the most relevant price ranges.")
-def plot_boxplot():
-    # Create a Seaborn boxplot for rental prices
-    fig = plt.figure(figsize=(12, 6))
+def plot_boxplot(boxplot):
+    # Draw the boxplot from the precomputed quartiles, whiskers and outliers
+    fig, ax = plt.subplots(figsize=(12, 6))
     plt.title('Boxplot of Airbnb Prices for Each Market')
-    sns.boxplot(data=listings_cleaned_h3, x='market', y='price')
+    ax.bxp(boxplot, patch_artist=True, boxprops={'facecolor': 'tab:blue', 'alpha': 0.8},
+           medianprops={'color': 'black'}, flierprops={'marker': 'd', 'markersize': 4})
+    ax.set_xlabel('market')
+    ax.set_ylabel('price')
 
     return fig
 
+# st.image resizes wider images on every run, so the charts are rendered at most this wide
+CHART_WIDTH = 1400
+
+def figure_png(fig):
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight', dpi=CHART_WIDTH / fig.get_figwidth())
+    plt.close(fig)
+    return buffer.getvalue()
+
+# The charts only change with the listings, so the PNGs are rendered once per data version
+@st.cache_data
+def render_charts(data_version):
+    summary = load_summary()
+    return figure_png(plot_histogram(summary['histogram'])), figure_png(plot_boxplot(summary['boxplot']))
+
+
+with profiler.phase('charts'):
+    histogram_png, boxplot_png = render_charts(load_data_version())
+    st.image(histogram_png, output_format='PNG', use_column_width=True)
 
-fig1 = plot_histogram()
-st.pyplot(fig1)
+    st.image(boxplot_png, output_format='PNG', use_column_width=True)
 
-fig2 = plot_boxplot()
-st.pyplot(fig2)
\ No newline at end of file
+render_profile(profiler.finish(map_cache=get_map_cache().stats(), s3=dict(s3_cache.stats)))
\ No newline at end of file
@@ -0,0 +1,195 @@
+## this file contains the per-market prediction cache used by the Price Prediction map
+import os
+import shutil
+import logging
+import pandas as pd
+
+from s3_loader import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+MODEL_KEY = 'models/model_h3.joblib'
+
+# Columns in listings_cleaned_h3 that are not model features
+NON_FEATURE_COLUMNS = ['price', 'latitude', 'longitude', 'h3_index']
+
+
+def predict_market_listings(pipeline, listings, market):
+    """
+    Predicts the price of every listing in a market.
+
+    Args:
+        pipeline (sklearn.pipeline.Pipeline): Trained H3 pipeline.
+        listings (pd.DataFrame): listings_cleaned_h3 data for one or more markets.
+        market (str): Market to predict, e.g. new-york-city.
+
+    Returns:
+        pd.DataFrame: The market's listings with a predicted_price column.
+    """
+    market_listings = listings[listings['market'] == market].copy()
+    input_data = market_listings.drop(columns=NON_FEATURE_COLUMNS)
+    market_listings['predicted_price'] = pipeline.predict(input_data)
+    return market_listings
+
+
+def aggregate_predictions_by_hexagon(market_predictions):
+    """
+    Aggregates listing level predictions to one row per hexagon for the choropleth.
+
+    Args:
+        market_predictions (pd.DataFrame): Output of predict_market_listings.
+
+    Returns:
+        pd.DataFrame: h3_index, predicted_price (median) and listing_count per hexagon.
+    """
+    hexagon_predictions = market_predictions.groupby('h3_index').agg(
+        predicted_price=('predicted_price', 'median'),
+        listing_count=('predicted_price', 'size')
+    ).reset_index()
+    return hexagon_predictions
+
+
+def _version_dir(model_version, listings_version, cache_dir):
+    return os.path.join(cache_dir, 'predictions', model_version, listings_version)
+
+
+def _cache_paths(model_version, listings_version, market, cache_dir):
+    version_dir = _version_dir(model_version, listings_version, cache_dir)
+    listings_path = os.path.join(version_dir, f'{market}-listings.parquet')
+    hexagons_path = os.path.join(version_dir, f'{market}-hexagons.parquet')
+    return listings_path, hexagons_path
+
+
+def _write_market_predictions(market_predictions, hexagon_predictions, model_version, listings_version, market,
+                              cache_dir):
+    listings_path, hexagons_path = _cache_paths(model_version, listings_version, market, cache_dir)
+    os.makedirs(os.path.dirname(listings_path), exist_ok=True)
+
+    # Write to a temporary file first so concurrent readers never see a partial file
+    for df, path in [(market_predictions, listings_path), (hexagon_predictions, hexagons_path)]:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+
+def load_market_predictions(pipeline, listings, market, model_version, listings_version, cache_dir=CACHE_DIR):
+    """
+    Returns cached predictions for a market, computing and storing them on first use.
+
+    Predictions are cached per model version and listings version, so republishing either
+    one is never answered with predictions made for the other.
+
+    Args:
+        pipeline (sklearn.pipeline.Pipeline or callable): Trained pipeline, or a function returning it.
+            Only used on a cache miss.
+        listings (pd.DataFrame): listings_cleaned_h3 data.
+        market (str): Market to load.
+        model_version (str): Version tag of the pipeline, e.g. the ETag of models/model_h3.joblib.
+        listings_version (str): Version tag of the listings, see listings_store.listings_version.
+        cache_dir (str, optional): Root of the local cache.
+
+    Returns:
+        tuple: (listing level predictions, hexagon level predictions) as DataFrames.
+    """
+    listings_path, hexagons_path = _cache_paths(model_version, listings_version, market, cache_dir)
+
+    if os.path.exists(listings_path) and os.path.exists(hexagons_path):
+        logger.info(f'Prediction cache hit for {market} (model {model_version}, listings {listings_version})')
+        return pd.read_parquet(listings_path), pd.read_parquet(hexagons_path)
+
+    logger.info(f'Prediction cache miss for {market} (model {model_version}, listings {listings_version})')
+    if callable(pipeline) and not hasattr(pipeline, 'predict'):
+        pipeline = pipeline()
+
+    market_predictions = predict_market_listings(pipeline, listings, market)
+    hexagon_predictions = aggregate_predictions_by_hexagon(market_predictions)
+    _write_market_predictions(market_predictions, hexagon_predictions, model_version, listings_version, market,
+                              cache_dir)
+
+    return market_predictions, hexagon_predictions
+
+
+def build_prediction_cache(pipeline, listings, model_version, listings_version, cache_dir=CACHE_DIR):
+    """
+    Precomputes predictions for every market offline so the dashboard never predicts on a market switch.
+
+    Args:
+        pipeline (sklearn.pipeline.Pipeline): Trained H3 pipeline.
+        listings (pd.DataFrame): listings_cleaned_h3 data.
+        model_version (str): Version tag of the pipeline.
+        listings_version (str): Version tag of the listings.
+        cache_dir (str, optional): Root of the local cache.
+
+    Returns:
+        list: Markets written to the cache.
+    """
+    markets = sorted(listings['market'].unique())
+    for market in markets:
+        market_predictions = predict_market_listings(pipeline, listings, market)
+        hexagon_predictions = aggregate_predictions_by_hexagon(market_predictions)
+        _write_market_predictions(market_predictions, hexagon_predictions, model_version, listings_version, market,
+                                  cache_dir)
+        print(f'Cached {len(market_predictions)} predictions for {market} (model {model_version})')
+
+    invalidate_prediction_cache(keep_version=model_version, keep_listings_version=listings_version,
+                                cache_dir=cache_dir)
+    return markets
+
+
+def invalidate_prediction_cache(keep_version=None, keep_listings_version=None, cache_dir=CACHE_DIR):
+    """
+    Removes cached predictions for model versions other than keep_version, and for listings
+    versions other than keep_listings_version under the kept model version.
+
+    Args:
+        keep_version (str, optional): Version to keep. All versions are removed when None.
+        keep_listings_version (str, optional): Listings version to keep. All are kept when None.
+        cache_dir (str, optional): Root of the local cache.
+
+    Returns:
+        list: Versions that were removed, as model version or model version/listings version.
+    """
+    predictions_dir = os.path.join(cache_dir, 'predictions')
+    if not os.path.isdir(predictions_dir):
+        return []
+
+    removed = []
+    for version in os.listdir(predictions_dir):
+        if version != keep_version:
+            shutil.rmtree(os.path.join(predictions_dir, version), ignore_errors=True)
+            removed.append(version)
+        elif keep_listings_version is not None:
+            # Locally built price tables sit next to the listings versions as files, see price_table.py
+            version_dir = os.path.join(predictions_dir, version)
+            for listings_version in os.listdir(version_dir):
+                path = os.path.join(version_dir, listings_version)
+                if listings_version != keep_listings_version and os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed.append(f'{version}/{listings_version}')
+
+    if removed:
+        logger.info(f'Removed cached predictions for versions {removed}')
+    return removed
+
+
+if __name__ == '__main__':
+    import argparse
+    import joblib
+    from s3_loader import S3ObjectCache
+    from listings_store import open_listings_store, listings_version
+
+    parser = argparse.ArgumentParser(description='Precompute per-market predictions for the Price Prediction map')
+    parser.add_argument('--bucket', default='airbnb-capstone-project')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args()
+
+    object_cache = S3ObjectCache(bucket_name=args.bucket, cache_dir=args.cache_dir)
+
+    store = open_listings_store(object_cache, cache_dir=args.cache_dir)
+    build_prediction_cache(
+        joblib.load(object_cache.get_path(MODEL_KEY)),
+        store.to_pandas(),
+        object_cache.etag(MODEL_KEY),
+        listings_version(store),
+        cache_dir=args.cache_dir
+    )
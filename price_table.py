@@ -0,0 +1,200 @@
+## this file contains the precomputed price table over every input of the Price Prediction form
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+from s3_loader import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+PRICE_TABLE_KEY = 'models/price_table.npz'
+PRICE_TABLE_FILE = 'price_table.npz'
+
+# Inputs of the Price Prediction form in table axis order, with every value the widgets allow
+GRID = {
+    'market': ['albany', 'chicago', 'los-angeles', 'new-york-city', 'san-francisco', 'seattle', 'washington-dc'],
+    'room_type': ['Entire home/apt', 'Hotel room', 'Private room', 'Shared room'],
+    'beds': list(range(1, 11)),
+    'accommodates': list(range(1, 17)),
+    'bathrooms': list(range(1, 7))
+}
+
+
+class PriceTable:
+    """
+    Dense array of predicted prices with one axis per form input.
+
+    A listing's price is read by turning each input into its position on its axis, so pricing
+    any listing on the grid costs a few dictionary lookups instead of a model call. The table is
+    tagged with the model version and the hexagon_data.csv version its market medians came from.
+    """
+
+    def __init__(self, prices, axes, model_version=None, data_version=None):
+        self.prices = prices
+        self.axes = {name: list(values) for name, values in axes.items()}
+        self.model_version = model_version
+        self.data_version = data_version
+        self._positions = {name: {value: i for i, value in enumerate(values)} for name, values in self.axes.items()}
+
+    def _ordinals(self, name, values):
+        positions = self._positions[name]
+        ordinals = np.fromiter((positions.get(value, -1) for value in np.asarray(values).tolist()),
+                               dtype=np.int64, count=len(values))
+        if (ordinals < 0).any():
+            outside = sorted({str(value) for value in np.asarray(values)[ordinals < 0]})
+            raise KeyError(f'{name} values {outside} are not in the price table')
+        return ordinals
+
+    def predict(self, specs):
+        """
+        Reads the prices of a batch of listings.
+
+        Args:
+            specs (dict or pd.DataFrame): Column name to values for every axis of the table.
+
+        Returns:
+            np.ndarray: Price of each listing.
+
+        Raises:
+            KeyError: When a listing is not on the grid, e.g. more beds than the form allows.
+        """
+        ordinals = tuple(self._ordinals(name, specs[name]) for name in self.axes)
+        return self.prices[ordinals].astype(float)
+
+    def lookup(self, **inputs):
+        """
+        Returns the price of one listing, e.g. lookup(market='albany', room_type='Private room', beds=1, ...).
+        """
+        return float(self.prices[tuple(self._positions[name][inputs[name]] for name in self.axes)])
+
+    def sensitivity(self, vary, **inputs):
+        """
+        Returns how the price changes along one input while the others stay fixed.
+
+        Args:
+            vary (str): Input to vary, e.g. 'beds'.
+            **inputs: Values of the other inputs.
+
+        Returns:
+            pd.Series: Price indexed by every value of the varied input.
+        """
+        index = tuple(slice(None) if name == vary else self._positions[name][inputs[name]] for name in self.axes)
+        return pd.Series(self.prices[index].astype(float), index=pd.Index(self.axes[vary], name=vary),
+                         name='predicted_price')
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        # Strings are stored as fixed width unicode arrays so loading never needs pickle
+        np.savez(tmp_path, prices=self.prices,
+                 model_version=np.array(self.model_version or ''), data_version=np.array(self.data_version or ''),
+                 **{f'axis_{name}': np.array(values) for name, values in self.axes.items()})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            axes = {name[len('axis_'):]: data[name].tolist() for name in data.files if name.startswith('axis_')}
+            # Keep the axis order of the table; npz files list members in the order they were written
+            return cls(data['prices'], axes, str(data['model_version']) or None, str(data['data_version']) or None)
+
+
+def build_price_table(pricer, market_stats, model_version=None, data_version=None, grid=GRID):
+    """
+    Prices every combination of form inputs in one batch.
+
+    Args:
+        pricer (pricing.FastPricer): H3 model pricer, e.g. forest_export.load_compact_pricer.
+        market_stats (pd.DataFrame): Median features indexed by market, see market_index.build_market_stats.
+        model_version (str, optional): Version of the model, stored with the table.
+        data_version (str, optional): Version of hexagon_data.csv the medians came from, stored with the table.
+        grid (dict, optional): Input name to its values, in axis order.
+
+    Returns:
+        PriceTable: Prices as float32, one axis per input.
+    """
+    shape = tuple(len(values) for values in grid.values())
+    # One row per grid cell in C order, so the predictions reshape straight into the table
+    ordinals = np.indices(shape).reshape(len(shape), -1)
+    specs = {name: np.asarray(values)[ordinals[i]] for i, (name, values) in enumerate(grid.items())}
+
+    prices = np.asarray(pricer.predict(specs, market_stats), dtype=np.float32).reshape(shape)
+    return PriceTable(prices, grid, model_version, data_version)
+
+
+def load_price_table(object_cache, model_version, data_version, pricer, market_stats, cache_dir=CACHE_DIR):
+    """
+    Returns the price table for a model and hexagon_data.csv version.
+
+    Uses the published table when it matches both versions, otherwise builds it locally once next
+    to the model version's cached predictions, so prediction_cache.invalidate_prediction_cache
+    removes it along with them.
+
+    Args:
+        object_cache (s3_loader.S3ObjectCache): Shared S3 loader.
+        model_version (str): ETag of the pickled pipeline.
+        data_version (str): ETag of hexagon_data.csv.
+        pricer (callable): Returns the pricer; only called when the table is built.
+        market_stats (callable): Returns the market medians; only called when the table is built.
+        cache_dir (str, optional): Directory holding locally built tables.
+
+    Returns:
+        PriceTable: Table for the given versions.
+    """
+    try:
+        table = PriceTable.load(object_cache.get_path(PRICE_TABLE_KEY))
+        if (table.model_version, table.data_version) == (model_version, data_version):
+            return table
+        logger.info(f'{PRICE_TABLE_KEY} was built for other model or data versions, rebuilding it locally')
+    except FileNotFoundError:
+        logger.info(f'{PRICE_TABLE_KEY} is not published, building it locally')
+
+    stem, extension = os.path.splitext(PRICE_TABLE_FILE)
+    path = os.path.join(cache_dir, 'predictions', model_version, f'{stem}-{data_version}{extension}')
+    if not os.path.exists(path):
+        build_price_table(pricer(), market_stats(), model_version, data_version).save(path)
+    return PriceTable.load(path)
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    from io import BytesIO
+    from s3_loader import S3ObjectCache
+    from prediction_cache import MODEL_KEY
+    from forest_export import COMPACT_MODEL_KEY, load_compact_pricer
+    from market_index import MarketIndex, build_market_stats, MEDIAN_COLUMNS
+
+    parser = argparse.ArgumentParser(description='Precompute the price of every Price Prediction form input')
+    parser.add_argument('--bucket', default='airbnb-capstone-project')
+    parser.add_argument('--output', default=os.path.join(CACHE_DIR, PRICE_TABLE_FILE))
+    parser.add_argument('--upload', action='store_true', help=f'Upload the table to {PRICE_TABLE_KEY}')
+    args = parser.parse_args()
+
+    object_cache = S3ObjectCache(bucket_name=args.bucket)
+    model_version = object_cache.etag(MODEL_KEY, download=False)
+    data_version = object_cache.etag('models/hexagon_data.csv')
+
+    pricer = None
+    try:
+        pricer = load_compact_pricer(object_cache.get_path(COMPACT_MODEL_KEY), model_version)
+    except FileNotFoundError:
+        pass
+    if pricer is None:
+        import joblib
+        from pricing import FastPricer
+        pricer = FastPricer(joblib.load(object_cache.get_path(MODEL_KEY)))
+
+    hexagon_data = pd.read_csv(BytesIO(object_cache.get_object('models/hexagon_data.csv')))
+    market_stats = build_market_stats(MarketIndex(hexagon_data), columns=MEDIAN_COLUMNS)
+
+    start = time.perf_counter()
+    table = build_price_table(pricer, market_stats, model_version, data_version)
+    table.save(args.output)
+    print(f'Priced {table.prices.size} listings in {time.perf_counter() - start:.2f}s, '
+          f'table written to {args.output} ({os.path.getsize(args.output) / 1024:.0f} KB)')
+
+    if args.upload:
+        object_cache.client.upload_file(args.output, args.bucket, PRICE_TABLE_KEY)
+        print(f'Table uploaded to s3://{args.bucket}/{PRICE_TABLE_KEY}')
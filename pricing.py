@@ -0,0 +1,202 @@
+## this file contains the batch pricing API for the H3 model, independent of Streamlit
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from market_index import MEDIAN_COLUMNS
+
+# Inputs a user provides for a listing
+SPEC_COLUMNS = ['market', 'room_type', 'accommodates', 'bathrooms', 'beds']
+
+# Columns the H3 pipeline was trained on
+FEATURE_COLUMNS = SPEC_COLUMNS + MEDIAN_COLUMNS
+
+
+def _as_columns(specs):
+    """
+    Converts a batch of listing specs to a dict of NumPy arrays.
+
+    Args:
+        specs (dict, pd.DataFrame or pa.Table): Column name to values.
+
+    Returns:
+        dict: Column name to 1-D NumPy array.
+    """
+    if isinstance(specs, (pa.Table, pa.RecordBatch)):
+        return {name: specs.column(name).to_numpy(zero_copy_only=False) for name in specs.column_names}
+    if isinstance(specs, pd.DataFrame):
+        return {name: specs[name].to_numpy() for name in specs.columns}
+    return {name: np.asarray(values) for name, values in specs.items()}
+
+
+def join_market_medians(specs, market_stats):
+    """
+    Adds the market median features to a batch of listing specs in one vectorized lookup.
+
+    Median columns already present in specs (e.g. hexagon level medians) are kept as given.
+
+    Args:
+        specs (dict, pd.DataFrame or pa.Table): Listing specs with at least SPEC_COLUMNS.
+        market_stats (pd.DataFrame): Median features indexed by market, see market_index.build_market_stats.
+
+    Returns:
+        dict: Column name to NumPy array for every column in FEATURE_COLUMNS.
+    """
+    columns = _as_columns(specs)
+
+    missing = [column for column in SPEC_COLUMNS if column not in columns]
+    if missing:
+        raise ValueError(f'Listing specs are missing columns {missing}')
+
+    missing_medians = [column for column in MEDIAN_COLUMNS if column not in columns]
+    if missing_medians:
+        if market_stats is None:
+            raise ValueError(f'market_stats is required to fill {missing_medians}')
+
+        # Map each market to its row in the stats table, then gather all rows at once
+        rows = market_stats.index.get_indexer(columns['market'])
+        if (rows < 0).any():
+            unknown = sorted({str(market) for market in np.asarray(columns['market'])[rows < 0]})
+            raise ValueError(f'Unknown markets {unknown}')
+
+        medians = market_stats[missing_medians].to_numpy(dtype=float)[rows]
+        for i, column in enumerate(missing_medians):
+            columns[column] = medians[:, i]
+
+    return {column: columns[column] for column in FEATURE_COLUMNS}
+
+
+def price_listings(pipeline, specs, market_stats=None):
+    """
+    Prices a batch of listings with the full sklearn pipeline in a single predict call.
+
+    Args:
+        pipeline (sklearn.pipeline.Pipeline): Trained H3 pipeline.
+        specs (dict, pd.DataFrame or pa.Table): Listing specs, see join_market_medians.
+        market_stats (pd.DataFrame, optional): Median features indexed by market.
+
+    Returns:
+        np.ndarray: Predicted price for each listing.
+    """
+    features = join_market_medians(specs, market_stats)
+    return pipeline.predict(pd.DataFrame(features, columns=FEATURE_COLUMNS))
+
+
+class FastPricer:
+    """
+    Prices listings with the pipeline's model while encoding features directly in NumPy.
+
+    The StandardScaler and OneHotEncoder parameters are read from the fitted
+    ColumnTransformer once, so each call skips building a DataFrame and running the
+    pandas column selection. Predictions match pipeline.predict.
+    """
+
+    def __init__(self, pipeline):
+        # Imported here so pricers loaded with from_state never import scikit-learn
+        from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+        preprocessor = pipeline.named_steps['preprocessor']
+        self.model = pipeline.steps[-1][1]
+
+        self.numerical_features = []
+        self.categorical_features = []
+        self.mean = None
+        self.scale = None
+        self.categories = []
+        self.handle_unknown = 'error'
+
+        # ColumnTransformer stacks its outputs in transformers_ order, so record that order
+        self._blocks = []
+        for name, transformer, features in preprocessor.transformers_:
+            if transformer == 'drop' or (name == 'remainder' and len(features) == 0):
+                continue
+            if isinstance(transformer, StandardScaler):
+                self.numerical_features = list(features)
+                self.mean = transformer.mean_ if transformer.with_mean else np.zeros(len(features))
+                self.scale = transformer.scale_ if transformer.with_std else np.ones(len(features))
+                self._blocks.append('num')
+            elif isinstance(transformer, OneHotEncoder) and transformer.drop is None:
+                self.categorical_features = list(features)
+                self.categories = [pd.Index(categories) for categories in transformer.categories_]
+                self.handle_unknown = transformer.handle_unknown
+                self._blocks.append('cat')
+            else:
+                raise ValueError(f'FastPricer does not support transformer {name}: {transformer}')
+
+        self.n_features = len(self.numerical_features) + sum(len(c) for c in self.categories)
+
+    def preprocessing_state(self):
+        """
+        Returns the encoder parameters as JSON serializable values, e.g. to store next to an exported model.
+        """
+        return {
+            'blocks': list(self._blocks),
+            'numerical_features': list(self.numerical_features),
+            'mean': None if self.mean is None else [float(value) for value in self.mean],
+            'scale': None if self.scale is None else [float(value) for value in self.scale],
+            'categorical_features': list(self.categorical_features),
+            'categories': [categories.tolist() for categories in self.categories],
+            'handle_unknown': self.handle_unknown
+        }
+
+    @classmethod
+    def from_state(cls, state, model):
+        """
+        Builds a pricer from preprocessing_state() and any model with a predict(X) method.
+        """
+        pricer = cls.__new__(cls)
+        pricer.model = model
+        pricer._blocks = list(state['blocks'])
+        pricer.numerical_features = list(state['numerical_features'])
+        pricer.mean = None if state['mean'] is None else np.asarray(state['mean'])
+        pricer.scale = None if state['scale'] is None else np.asarray(state['scale'])
+        pricer.categorical_features = list(state['categorical_features'])
+        pricer.categories = [pd.Index(categories) for categories in state['categories']]
+        pricer.handle_unknown = state['handle_unknown']
+        pricer.n_features = len(pricer.numerical_features) + sum(len(c) for c in pricer.categories)
+        return pricer
+
+    def transform(self, features):
+        """
+        Encodes a batch of features the same way as the pipeline's ColumnTransformer.
+
+        Args:
+            features (dict): Column name to NumPy array for every column in FEATURE_COLUMNS.
+
+        Returns:
+            np.ndarray: Dense feature matrix of shape (n_listings, n_features).
+        """
+        n_rows = len(features[FEATURE_COLUMNS[0]])
+        X = np.zeros((n_rows, self.n_features))
+        rows = np.arange(n_rows)
+
+        offset = 0
+        for block in self._blocks:
+            if block == 'num':
+                numerical = np.column_stack([np.asarray(features[f], dtype=float) for f in self.numerical_features])
+                X[:, offset:offset + len(self.numerical_features)] = (numerical - self.mean) / self.scale
+                offset += len(self.numerical_features)
+            else:
+                for feature, categories in zip(self.categorical_features, self.categories):
+                    codes = categories.get_indexer(features[feature])
+                    unknown = codes < 0
+                    if unknown.any() and self.handle_unknown == 'error':
+                        unknown_values = sorted({str(value) for value in np.asarray(features[feature])[unknown]})
+                        raise ValueError(f'Unknown categories {unknown_values} in {feature}')
+                    X[rows[~unknown], offset + codes[~unknown]] = 1.0
+                    offset += len(categories)
+        return X
+
+    def predict(self, specs, market_stats=None):
+        """
+        Prices a batch of listings.
+
+        Args:
+            specs (dict, pd.DataFrame or pa.Table): Listing specs, see join_market_medians.
+            market_stats (pd.DataFrame, optional): Median features indexed by market.
+
+        Returns:
+            np.ndarray: Predicted price for each listing.
+        """
+        features = join_market_medians(specs, market_stats)
+        return self.model.predict(self.transform(features))
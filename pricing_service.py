@@ -0,0 +1,574 @@
+## this file contains the standalone pricing service that serves micro-batched predictions over HTTP
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# The pages use the service when this is set, e.g. http://127.0.0.1:8765
+PRICING_SERVICE_URL_ENV = 'PRICING_SERVICE_URL'
+
+# Requests are coalesced for at most MAX_BATCH_WAIT seconds after the first one, or until MAX_BATCH_SIZE rows
+MAX_BATCH_SIZE = 512
+MAX_BATCH_WAIT = 0.002
+
+# Seconds the client waits for the service before the page predicts in-process instead
+CLIENT_TIMEOUT = 2.0
+
+# Seconds between checks for a republished model or hexagon_data.csv, like the page's model version TTL
+MODEL_CHECK_INTERVAL = 300
+
+
+class PricingServiceError(Exception):
+    """
+    Raised by PricingClient when the service can't be reached or rejects a request.
+    """
+
+
+def request_rows(columns):
+    """
+    Returns the number of listings in a request.
+
+    Raises:
+        TypeError: When the request is not a dict of column name to a list of values.
+        ValueError: When it has no listings or its columns have different lengths.
+    """
+    if not isinstance(columns, dict) or not columns:
+        raise TypeError('listings must map column names to lists of values')
+    lengths = {}
+    for name, values in columns.items():
+        if not isinstance(values, (list, tuple, np.ndarray)) or np.ndim(values) != 1:
+            raise TypeError(f'Column {name} is not a list of values')
+        lengths[name] = len(values)
+    if len(set(lengths.values())) != 1:
+        raise ValueError(f'Columns have different lengths {lengths}')
+    rows = next(iter(lengths.values()))
+    if rows == 0:
+        raise ValueError('listings has no rows')
+    return rows
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent prediction requests into one predict call.
+
+    A background thread takes the first waiting request, then keeps collecting requests for up
+    to max_wait seconds or max_batch_size rows, predicts them together and hands each caller its
+    slice. One vectorized call per batch replaces many small ones that would each hold the GIL.
+    Requests are checked before they are queued, and when a batch still fails each of its
+    requests is predicted on its own, so an error only reaches the request that caused it.
+    """
+
+    def __init__(self, predict, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT, validate=None):
+        self._predict = predict
+        self._validate = validate
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'rows': 0, 'batches': 0}
+        self._thread = threading.Thread(target=self._run, name='pricing-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, columns):
+        """
+        Queues listings for pricing.
+
+        Args:
+            columns (dict): Column name to a list of values, one per listing.
+
+        Returns:
+            concurrent.futures.Future: Resolves to an np.ndarray of prices.
+
+        Raises:
+            TypeError, ValueError: When the request is malformed, see request_rows and the validate callable.
+        """
+        rows = request_rows(columns)
+        if self._validate is not None:
+            self._validate(columns)
+        future = Future()
+        self._queue.put((columns, rows, future))
+        return future
+
+    def predict(self, columns, timeout=None):
+        return self.submit(columns).result(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        rows = first[1]
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop signal back so the loop ends after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+            rows += item[1]
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+
+            # Requests with the same columns (e.g. with or without hexagon medians) are predicted together
+            groups = {}
+            for item in batch:
+                groups.setdefault(tuple(sorted(item[0])), []).append(item)
+
+            for names, items in groups.items():
+                self._predict_items(names, items)
+
+            with self._stats_lock:
+                self.stats['requests'] += len(batch)
+                self.stats['rows'] += sum(item[1] for item in batch)
+                self.stats['batches'] += 1
+
+    def _predict_items(self, names, items):
+        columns = {name: [value for item in items for value in item[0][name]] for name in names}
+        try:
+            prices = np.asarray(self._predict(columns), dtype=float)
+            if len(prices) != sum(item[1] for item in items):
+                raise ValueError(f'Predicted {len(prices)} prices for {sum(item[1] for item in items)} listings')
+        except Exception as e:
+            if len(items) == 1:
+                items[0][2].set_exception(e)
+                return
+            # Retry each request alone so one bad request doesn't fail the others in its batch
+            for item in items:
+                self._predict_items(names, [item])
+            return
+
+        offset = 0
+        for _, rows, future in items:
+            future.set_result(prices[offset:offset + rows])
+            offset += rows
+
+
+class PricingService:
+    """
+    Loads the H3 model once and serves single-listing prices and per-market prediction grids.
+
+    The model is the compact forest exported for the current model version when it exists, the
+    pickled pipeline otherwise, as on the Price Prediction page. A background thread checks the
+    model, hexagon_data.csv and listings ETags every check_interval seconds and swaps in the new
+    versions when any was republished; requests keep using the loaded ones meanwhile.
+    """
+
+    def __init__(self, object_cache=None, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT,
+                 check_interval=MODEL_CHECK_INTERVAL):
+        from s3_loader import get_object_cache
+
+        self.object_cache = object_cache if object_cache is not None else get_object_cache()
+        self.check_interval = check_interval
+        model_version, data_version, listings_version = self._versions()
+        # (model version, data version, pricer, market stats), replaced as a whole so a batch never mixes versions
+        self._model = self._load(model_version, data_version)
+        # (listings version, store), the store is opened on the first grid request
+        self._listings = (listings_version, None)
+        self._listings_lock = threading.Lock()
+
+        self.batcher = MicroBatcher(self._predict, max_batch_size, max_wait, validate=self.validate)
+        self._grids = {}
+        self._grids_lock = threading.Lock()
+        # One lock per grid being computed, so each grid is computed once without blocking the others
+        self._grid_locks = {}
+
+        if check_interval:
+            threading.Thread(target=self._watch, name='pricing-model-watcher', daemon=True).start()
+
+    @property
+    def model_version(self):
+        return self._model[0]
+
+    def _versions(self):
+        from prediction_cache import MODEL_KEY
+        from listings_store import LISTINGS_CSV_KEY, LISTINGS_STORE_KEY
+
+        try:
+            listings_version = self.object_cache.etag(LISTINGS_STORE_KEY, download=False)
+        except FileNotFoundError:
+            # open_listings_store converts the CSV when the store is not published
+            listings_version = self.object_cache.etag(LISTINGS_CSV_KEY, download=False)
+        return (self.object_cache.etag(MODEL_KEY, download=False),
+                self.object_cache.etag('models/hexagon_data.csv', download=False),
+                listings_version)
+
+    def _load(self, model_version, data_version):
+        import pandas as pd
+        from io import BytesIO
+        from prediction_cache import MODEL_KEY
+        from forest_export import COMPACT_MODEL_KEY, load_compact_pricer
+        from market_index import MarketIndex, build_market_stats, MEDIAN_COLUMNS
+
+        pricer = None
+        try:
+            pricer = load_compact_pricer(self.object_cache.get_path(COMPACT_MODEL_KEY), model_version)
+        except FileNotFoundError:
+            pass
+        if pricer is None:
+            import joblib
+            from pricing import FastPricer
+            pricer = FastPricer(joblib.load(self.object_cache.get_path(MODEL_KEY)))
+
+        hexagon_data = pd.read_csv(BytesIO(self.object_cache.get_object('models/hexagon_data.csv')))
+        market_stats = build_market_stats(MarketIndex(hexagon_data), columns=MEDIAN_COLUMNS)
+        return model_version, data_version, pricer, market_stats
+
+    def _open_listings(self):
+        from listings_store import open_listings_store
+
+        with self._listings_lock:
+            listings_version, store = self._listings
+            if store is None:
+                store = open_listings_store(self.object_cache)
+                self._listings = (listings_version, store)
+            return listings_version, store
+
+    def refresh(self):
+        """
+        Reloads the model, market medians and listings when a new version of any was published.
+
+        Returns:
+            bool: Whether a new version was loaded.
+        """
+        from listings_store import open_listings_store
+
+        versions = self._versions()
+        if versions == self._model[:2] + (self._listings[0],):
+            return False
+        if versions[:2] != self._model[:2]:
+            logger.info(f'Loading model version {versions[0]} and hexagon data version {versions[1]}')
+            self._model = self._load(*versions[:2])
+        if versions[2] != self._listings[0]:
+            logger.info(f'Reopening listings version {versions[2]}')
+            store = open_listings_store(self.object_cache)
+            with self._listings_lock:
+                self._listings = (versions[2], store)
+        with self._grids_lock:
+            # Grids of the previous versions are never served again
+            self._grids = {key: body for key, body in self._grids.items() if key[:3] == versions}
+        return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f'Could not check for a new model version, keeping {self.model_version}: {e}')
+
+    def validate(self, columns):
+        """
+        Rejects a request the model can't price before it joins a batch.
+
+        Raises:
+            ValueError: When listing columns are missing or a market is unknown.
+        """
+        from pricing import SPEC_COLUMNS
+
+        missing = [column for column in SPEC_COLUMNS if column not in columns]
+        if missing:
+            raise ValueError(f'Listing specs are missing columns {missing}')
+        market_stats = self._model[3]
+        unknown = sorted({str(market) for market in columns['market']} - set(market_stats.index))
+        if unknown:
+            raise ValueError(f'Unknown markets {unknown}')
+
+    def _predict(self, columns):
+        _, _, pricer, market_stats = self._model
+        return pricer.predict(columns, market_stats)
+
+    def predict(self, columns, timeout=None):
+        return self.batcher.predict(columns, timeout)
+
+    def market_grid(self, market):
+        """
+        Returns the hexagon predictions of a market as the JSON body the service sends.
+
+        Computed once per market, model and listings version from the shared prediction cache, then served
+        from memory. Only the lookup holds the shared lock, so a cold market doesn't hold up the others.
+        """
+        from listings_store import listings_version
+        from prediction_cache import load_market_predictions
+
+        model_version, data_version, pricer, _ = self._model
+        version, store = self._open_listings()
+        key = (model_version, data_version, version, market)
+        with self._grids_lock:
+            body = self._grids.get(key)
+            if body is not None:
+                return body
+            grid_lock = self._grid_locks.setdefault(key, threading.Lock())
+
+        with grid_lock:
+            # Another request may have computed the grid while this one waited
+            with self._grids_lock:
+                body = self._grids.get(key)
+            if body is not None:
+                return body
+
+            try:
+                market_listings = store.market(market)
+                if market_listings.empty:
+                    raise KeyError(market)
+
+                market_predictions, hexagon_predictions = load_market_predictions(
+                    pricer, market_listings, market, model_version, listings_version(store))
+                body = json.dumps({
+                    'model_version': model_version,
+                    'center': [float(market_predictions['latitude'].mean()),
+                               float(market_predictions['longitude'].mean())],
+                    'hexagons': hexagon_predictions[['h3_index', 'predicted_price']].to_dict('list')
+                }).encode('utf-8')
+                with self._grids_lock:
+                    if self._model[:2] + (self._listings[0],) == key[:3]:
+                        self._grids[key] = body
+            finally:
+                with self._grids_lock:
+                    self._grid_locks.pop(key, None)
+            return body
+
+    def health(self):
+        return {'model_version': self.model_version, 'data_version': self._model[1],
+                'batching': dict(self.batcher.stats)}
+
+
+def _make_handler(service):
+    class PricingHandler(BaseHTTPRequestHandler):
+        # Keep connections open between requests from the same client
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def _send(self, status, body):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, service.health())
+            elif self.path.startswith('/markets/'):
+                market = unquote(self.path[len('/markets/'):]).strip('/')
+                try:
+                    self._send(200, service.market_grid(market))
+                except KeyError:
+                    self._send(404, {'error': f'unknown market {market}'})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                columns = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))['listings']
+                prices = service.predict(columns)
+            except (KeyError, ValueError, TypeError) as e:
+                self._send(400, {'error': str(e)})
+                return
+            except Exception as e:
+                logger.exception('Prediction failed')
+                self._send(500, {'error': str(e)})
+                return
+            self._send(200, {'prices': prices.tolist(), 'model_version': service.model_version})
+
+    return PricingHandler
+
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Starts the HTTP server on a background thread.
+
+    Returns:
+        ThreadingHTTPServer: Running server; call shutdown() to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), _make_handler(service))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='pricing-server', daemon=True).start()
+    logger.info(f'Pricing service listening on http://{host}:{server.server_address[1]}')
+    return server
+
+
+class PricingClient:
+    """
+    Client the pages use to price listings through the service.
+    """
+
+    def __init__(self, url, timeout=CLIENT_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        # requests sessions are not thread safe, so each thread keeps its own connection
+        if not hasattr(self._local, 'session'):
+            import requests
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _request(self, method, path, **kwargs):
+        import requests
+
+        try:
+            response = self._session().request(method, f'{self.url}{path}', timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise PricingServiceError(f'Pricing service at {self.url} is unavailable: {e}') from e
+        if response.status_code != 200:
+            raise PricingServiceError(f'Pricing service returned {response.status_code}: {response.text}')
+        return response.json()
+
+    def predict(self, specs):
+        """
+        Prices listings.
+
+        Args:
+            specs (dict): Column name to values, as accepted by pricing.FastPricer.predict.
+
+        Returns:
+            np.ndarray: Predicted price for each listing.
+        """
+        columns = {name: np.asarray(values).tolist() for name, values in specs.items()}
+        return np.asarray(self._request('POST', '/predict', json={'listings': columns})['prices'])
+
+    def market_grid(self, market):
+        """
+        Returns the predicted price per hexagon of a market.
+
+        Returns:
+            tuple: ([latitude, longitude] center of the market's listings, DataFrame of h3_index and predicted_price).
+        """
+        import pandas as pd
+
+        grid = self._request('GET', f'/markets/{market}')
+        return grid['center'], pd.DataFrame(grid['hexagons'])
+
+    def health(self):
+        return self._request('GET', '/health')
+
+
+def get_pricing_client():
+    """
+    Returns a client for the service named by PRICING_SERVICE_URL, or None to predict in-process.
+    """
+    url = os.getenv(PRICING_SERVICE_URL_ENV)
+    return PricingClient(url) if url else None
+
+
+def load_test(url, specs, concurrency=32, requests_per_worker=100):
+    """
+    Sends single-listing requests from concurrent clients and reports throughput and latency.
+
+    Args:
+        url (str): Service URL.
+        specs (list): Listing spec dicts ({column: value}); each request sends one.
+        concurrency (int, optional): Concurrent clients.
+        requests_per_worker (int, optional): Requests each client sends.
+
+    Returns:
+        dict: requests, errors, seconds, requests per second and p50/p99 latency in milliseconds.
+    """
+    client = PricingClient(url, timeout=30)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        own = []
+        for i in range(requests_per_worker):
+            spec = specs[(offset * requests_per_worker + i) % len(specs)]
+            start = time.perf_counter()
+            try:
+                client.predict({name: [value] for name, value in spec.items()})
+                own.append(time.perf_counter() - start)
+            except PricingServiceError as e:
+                with lock:
+                    errors.append(str(e))
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': seconds,
+        'requests_per_second': len(latencies) / seconds,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Serve H3 model predictions to the dashboard pages')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Start the service')
+    serve_parser.add_argument('--host', default=DEFAULT_HOST)
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    serve_parser.add_argument('--max-wait-ms', type=float, default=MAX_BATCH_WAIT * 1000)
+
+    load_parser = subparsers.add_parser('loadtest', help='Measure throughput and latency of a running service')
+    load_parser.add_argument('--url', default=f'http://{DEFAULT_HOST}:{DEFAULT_PORT}')
+    load_parser.add_argument('--concurrency', type=int, default=32)
+    load_parser.add_argument('--requests', type=int, default=100, help='Requests per concurrent client')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        service = PricingService(max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+        server = serve(service, args.host, args.port)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        rng = np.random.default_rng(0)
+        markets = ['albany', 'chicago', 'los-angeles', 'new-york-city', 'san-francisco', 'seattle', 'washington-dc']
+        room_types = ['Entire home/apt', 'Hotel room', 'Private room', 'Shared room']
+        specs = [{'market': str(rng.choice(markets)), 'room_type': str(rng.choice(room_types)),
+                  'accommodates': int(rng.integers(1, 9)), 'bathrooms': int(rng.integers(1, 4)),
+                  'beds': int(rng.integers(1, 6))} for _ in range(1000)]
+        print(json.dumps(load_test(args.url, specs, args.concurrency, args.requests), indent=4))
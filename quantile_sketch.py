@@ -0,0 +1,295 @@
+## this file contains the mergeable KLL quantile sketch kept per hexagon and per market
+import gzip
+import json
+import math
+import numpy as np
+import pandas as pd
+
+# Items kept by the top level; the sketch holds about 3 * K items however many values it has seen
+DEFAULT_K = 200
+
+# Each lower level keeps this fraction of the capacity of the level above it
+LEVEL_DECAY = 2 / 3
+
+
+def normalized_rank_error(k=DEFAULT_K):
+    """
+    Rank error of a single quantile at 99% confidence, as a fraction of the values seen.
+
+    Uses the empirical fit published for KLL sketches by Apache DataSketches, e.g. about 1.3%
+    for k=200. A median from the sketch is then the value at some rank within 0.5 +- that error.
+    """
+    return 2.296 / k ** 0.9723
+
+
+class KLLSketch:
+    """
+    KLL quantile sketch (Karnin, Lang and Liberty, 2016).
+
+    Values are kept in levels; an item on level h stands for 2**h of the values seen. When the
+    sketch is full, a level is sorted and every other item (from a random offset) is promoted to
+    the next level, so memory stays O(k) however many values are added. Sketches built on
+    different listings can be merged, e.g. hexagons into their parent or into their market.
+
+    Until the first compaction the sketch holds every value and its quantiles are exact, which is
+    the case for any hexagon with fewer than about k listings.
+    """
+
+    def __init__(self, k=DEFAULT_K, seed=None):
+        self.k = k
+        self.n = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.k * LEVEL_DECAY ** depth)), 2)
+
+    def _size(self):
+        return sum(len(items) for items in self.levels)
+
+    def _max_size(self):
+        return sum(self._capacity(level) for level in range(len(self.levels)))
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for level in range(len(self.levels)):
+                items = self.levels[level]
+                if len(items) < self._capacity(level):
+                    continue
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+
+                items = np.sort(items)
+                # An odd item out stays on this level
+                keep = items[len(items) - len(items) % 2:]
+                promoted = items[self._rng.integers(2):len(items) - len(items) % 2:2]
+                self.levels[level] = keep
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                break
+
+    @property
+    def is_exact(self):
+        return len(self.levels) == 1
+
+    def update(self, values):
+        """
+        Adds one value or an array of values; NaN is ignored.
+
+        Returns:
+            KLLSketch: self.
+        """
+        values = np.asarray(values, dtype=float).reshape(-1)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+
+        self.n += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Adds the values summarized by another sketch.
+
+        Returns:
+            KLLSketch: self.
+        """
+        if other.n == 0:
+            return self
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def copy(self):
+        sketch = KLLSketch(self.k)
+        sketch.n, sketch.min, sketch.max = self.n, self.min, self.max
+        sketch.levels = [items.copy() for items in self.levels]
+        return sketch
+
+    def _weighted_items(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_items), 2 ** level, dtype=np.int64)
+                                  for level, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        return items[order], np.cumsum(weights[order])
+
+    def quantiles(self, fractions):
+        """
+        Returns the values at the given quantiles.
+
+        Exact sketches interpolate like numpy and pandas (so the median of an even count is the
+        mean of the two middle values); larger sketches return a retained value whose rank is
+        within normalized_rank_error(k) of the requested one.
+
+        Args:
+            fractions (list): Quantiles between 0 and 1.
+
+        Returns:
+            np.ndarray: One value per fraction; NaN for an empty sketch.
+        """
+        fractions = np.asarray(fractions, dtype=float)
+        if self.n == 0:
+            return np.full(fractions.shape, np.nan)
+        if self.is_exact:
+            return np.quantile(self.levels[0], fractions)
+
+        items, cumulative = self._weighted_items()
+        positions = np.searchsorted(cumulative, fractions * cumulative[-1], side='left')
+        values = items[np.minimum(positions, len(items) - 1)]
+        # The extremes are tracked exactly
+        values = np.where(fractions <= 0, self.min, values)
+        return np.where(fractions >= 1, self.max, values)
+
+    def quantile(self, fraction):
+        return float(self.quantiles([fraction])[0])
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def rank(self, value):
+        """
+        Returns the approximate fraction of values at or below value.
+        """
+        if self.n == 0:
+            return math.nan
+        items, cumulative = self._weighted_items()
+        position = np.searchsorted(items, value, side='right')
+        return float(cumulative[position - 1] / cumulative[-1]) if position else 0.0
+
+    def to_dict(self):
+        return {
+            'k': self.k,
+            'n': self.n,
+            'min': self.min if self.n else None,
+            'max': self.max if self.n else None,
+            'levels': [items.tolist() for items in self.levels]
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['k'])
+        sketch.n = state['n']
+        if sketch.n:
+            sketch.min, sketch.max = state['min'], state['max']
+        sketch.levels = [np.asarray(items, dtype=float) for items in state['levels']]
+        return sketch
+
+
+def build_group_sketches(keys, values, k=DEFAULT_K, seed=None):
+    """
+    Builds one sketch per group.
+
+    Args:
+        keys (array-like): Group of each value, e.g. the hexagon of each listing.
+        values (array-like): Values to summarize.
+        k (int, optional): Sketch size, see DEFAULT_K.
+        seed (int, optional): Seed for the compaction offsets.
+
+    Returns:
+        dict: Group to KLLSketch.
+    """
+    keys = pd.Series(keys).to_numpy()
+    values = np.asarray(values, dtype=float)
+
+    codes, uniques = pd.factorize(keys)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+
+    rng = np.random.default_rng(seed)
+    sketches = {}
+    for i, key in enumerate(uniques):
+        sketch = KLLSketch(k, seed=rng.integers(2 ** 32))
+        sketches[key] = sketch.update(values[order[bounds[i]:bounds[i + 1]]])
+    return sketches
+
+
+def update_group_sketches(sketches, keys, values, k=DEFAULT_K):
+    """
+    Adds newly streamed values to the sketches of their groups, creating sketches for new groups.
+
+    Sketches can't forget values, so removed or changed listings need their groups rebuilt.
+
+    Returns:
+        dict: sketches, updated in place.
+    """
+    for key, sketch in build_group_sketches(keys, values, k).items():
+        if key in sketches:
+            sketches[key].merge(sketch)
+        else:
+            sketches[key] = sketch
+    return sketches
+
+
+def merge_group_sketches(sketches, parents):
+    """
+    Rolls sketches up into parent groups, e.g. hexagons into their parent hexagon or market.
+
+    Args:
+        sketches (dict): Group to KLLSketch.
+        parents (dict or callable): Parent of each group.
+
+    Returns:
+        dict: Parent to a new merged KLLSketch; the input sketches are not modified.
+    """
+    parent_of = parents if callable(parents) else parents.get
+    merged = {}
+    for key, sketch in sketches.items():
+        parent = parent_of(key)
+        if parent is None:
+            continue
+        if parent in merged:
+            merged[parent].merge(sketch)
+        else:
+            merged[parent] = sketch.copy()
+    return merged
+
+
+def sketch_quantile_table(sketches, fractions=(0.5,)):
+    """
+    Reads quantiles out of grouped sketches.
+
+    Args:
+        sketches (dict): Column name to {group: KLLSketch}.
+        fractions (tuple, optional): Quantiles to read; 0.5 is named <column>_median,
+            others <column>_p<percent>.
+
+    Returns:
+        pd.DataFrame: One row per group.
+    """
+    columns = {}
+    for column, groups in sketches.items():
+        values = np.array([groups[key].quantiles(fractions) for key in groups]).reshape(len(groups), -1)
+        for i, fraction in enumerate(fractions):
+            name = f'{column}_median' if fraction == 0.5 else f'{column}_p{fraction * 100:g}'
+            columns[name] = pd.Series(values[:, i], index=list(groups))
+    return pd.DataFrame(columns)
+
+
+def save_sketches(sketches, path):
+    """
+    Writes grouped sketches ({column: {group: KLLSketch}}) to gzipped JSON.
+    """
+    state = {column: {str(key): sketch.to_dict() for key, sketch in groups.items()}
+             for column, groups in sketches.items()}
+    with gzip.open(path, 'wt') as f:
+        json.dump(state, f, separators=(',', ':'))
+
+
+def load_sketches(path):
+    with gzip.open(path, 'rt') as f:
+        state = json.load(f)
+    return {column: {key: KLLSketch.from_dict(sketch) for key, sketch in groups.items()}
+            for column, groups in state.items()}
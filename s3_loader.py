@@ -0,0 +1,456 @@
+## this file contains the shared S3 loader used by the dashboard pages
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; processes then only merge the index, without locking it
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = 'airbnb-capstone-project'
+CACHE_DIR = os.getenv('AIRBNB_CACHE_DIR', '.cache')
+
+# Connections shared by every thread using the client
+MAX_POOL_CONNECTIONS = 16
+
+# Size of each part of a multipart upload; S3 requires at least 5 MiB for all but the last part
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+# Seconds a cached object is served without asking S3 whether it changed
+REVALIDATE_AFTER = int(os.getenv('AIRBNB_S3_REVALIDATE_AFTER', '300'))
+
+CachedObject = namedtuple('CachedObject', ['key', 'path', 'etag'])
+
+_client = None
+_client_lock = threading.Lock()
+_object_caches = {}
+
+
+def get_s3_client():
+    """
+    Returns the process wide S3 client, creating it on first use.
+
+    boto3 clients are thread safe, so one client with a larger connection pool is shared
+    by every page, session and download thread.
+
+    Returns:
+        botocore.client.S3: S3 client.
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            # Imported on first use so pages served from the disk cache don't pay for boto3
+            import boto3
+            from botocore.config import Config
+            from dotenv import load_dotenv
+
+            # Load environment variables from a .env file
+            load_dotenv()
+
+            if not os.getenv('AWS_ACCESS_KEY_ID'):
+                logger.error('Environment variable AWS_ACCESS_KEY_ID must be set')
+            if not os.getenv('AWS_SECRET_ACCESS_KEY'):
+                logger.error('Environment variable AWS_SECRET_ACCESS_KEY must be set')
+
+            _client = boto3.client('s3', config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                                                       retries={'max_attempts': 5, 'mode': 'standard'}))
+        return _client
+
+
+def _is_not_modified(error):
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304 \
+        or error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+
+def _is_missing(error):
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404 \
+        or error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey')
+
+
+class S3ObjectCache:
+    """
+    Content-addressed local disk cache in front of an S3 bucket.
+
+    Objects are stored under their ETag, and an index maps each key to the ETag last seen.
+    A cached key is revalidated with a conditional GET (If-None-Match) once it is older than
+    revalidate_after seconds, so an unchanged object costs a 304 instead of a download.
+    When S3 can't be reached the cached copy is served, which lets restarts and new
+    replicas that share the cache directory come up from local disk.
+    """
+
+    def __init__(self, client=None, bucket_name=BUCKET_NAME, cache_dir=CACHE_DIR,
+                 revalidate_after=REVALIDATE_AFTER, max_workers=MAX_POOL_CONNECTIONS):
+        self._client = client
+        self.bucket_name = bucket_name
+        self.revalidate_after = revalidate_after
+        self.max_workers = max_workers
+
+        self.objects_dir = os.path.join(cache_dir, 's3', bucket_name, 'objects')
+        self.index_path = os.path.join(cache_dir, 's3', bucket_name, 'index.json')
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._index = self._read_index()
+
+        # Keys S3 reported as missing, so optional artifacts aren't requested on every call
+        self._missing = {}
+
+        self.stats = {'hits': 0, 'not_modified': 0, 'downloads': 0, 'stale': 0}
+
+    @property
+    def client(self):
+        # Created on the first request, so cached objects can be served without it
+        if self._client is None:
+            self._client = get_s3_client()
+        return self._client
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_index(self):
+        tmp_path = f'{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    def _blob_path(self, etag):
+        # ETags may contain characters that are awkward in file names, e.g. multipart "-N" suffixes
+        return os.path.join(self.objects_dir, hashlib.sha256(etag.encode('utf-8')).hexdigest())
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _download(self, key, etag=None):
+        """
+        Performs a (conditional) GET and stores the body under its ETag.
+
+        Returns:
+            str or None: New ETag, or None when S3 answered 304 Not Modified.
+        """
+        params = {'Bucket': self.bucket_name, 'Key': key}
+        if etag is not None:
+            params['IfNoneMatch'] = f'"{etag}"'
+
+        try:
+            response = self.client.get_object(**params)
+        except ClientError as e:
+            if etag is not None and _is_not_modified(e):
+                return None
+            if _is_missing(e):
+                raise FileNotFoundError(f's3://{self.bucket_name}/{key} does not exist') from e
+            raise
+
+        new_etag = response['ETag'].strip('"')
+        blob_path = self._blob_path(new_etag)
+
+        if not os.path.exists(blob_path):
+            # Stream the body to disk so large artifacts are never fully buffered in memory
+            tmp_path = f'{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for chunk in response['Body'].iter_chunks(chunk_size=1024 * 1024):
+                    f.write(chunk)
+            os.replace(tmp_path, blob_path)
+        else:
+            response['Body'].close()
+
+        return new_etag
+
+    def _remove_unreferenced(self, etag):
+        if etag is not None and all(entry['etag'] != etag for entry in self._index.values()):
+            try:
+                os.remove(self._blob_path(etag))
+            except FileNotFoundError:
+                pass
+
+    def _update_index(self, key, entry, old_etag):
+        """
+        Stores an index entry and removes the blob it replaced once nothing references it.
+
+        Replicas sharing the cache directory write the same index.json, so it is re-read under a
+        file lock and merged, newest check first, before it is written and blobs are removed.
+        """
+        with open(f'{self.index_path}.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = self._read_index()
+            for other_key, other_entry in self._index.items():
+                if other_key not in index or other_entry['checked'] > index[other_key]['checked']:
+                    index[other_key] = other_entry
+            index[key] = entry
+            self._index = index
+            if old_etag != entry['etag']:
+                self._remove_unreferenced(old_etag)
+            self._write_index()
+
+    def fetch(self, key, revalidate=None):
+        """
+        Makes sure a key is cached locally and returns where it is.
+
+        Args:
+            key (str): Object key, e.g. models/model_h3.joblib.
+            revalidate (bool, optional): Force (True) or skip (False) the conditional GET.
+                By default the object is revalidated once it is older than revalidate_after.
+
+        Returns:
+            CachedObject: Key, local path and ETag of the object.
+        """
+        with self._key_lock(key):
+            missing_since = self._missing.get(key)
+            if missing_since is not None and revalidate is not True \
+                    and time.time() - missing_since < self.revalidate_after:
+                raise FileNotFoundError(f's3://{self.bucket_name}/{key} does not exist')
+
+            entry = self._index.get(key)
+            cached = entry is not None and os.path.exists(self._blob_path(entry['etag']))
+
+            if revalidate is None:
+                revalidate = not cached or time.time() - entry['checked'] >= self.revalidate_after
+
+            if cached and not revalidate:
+                self.stats['hits'] += 1
+                return CachedObject(key, self._blob_path(entry['etag']), entry['etag'])
+
+            try:
+                new_etag = self._download(key, entry['etag'] if cached else None)
+            except FileNotFoundError:
+                self._missing[key] = time.time()
+                raise
+            except (BotoCoreError, ClientError) as e:
+                if not cached:
+                    raise
+                logger.warning(f'Could not revalidate {key} ({e}), serving cached copy')
+                self.stats['stale'] += 1
+                return CachedObject(key, self._blob_path(entry['etag']), entry['etag'])
+
+            self._missing.pop(key, None)
+            with self._lock:
+                if new_etag is None:
+                    self.stats['not_modified'] += 1
+                    new_etag = entry['etag']
+                else:
+                    self.stats['downloads'] += 1
+                    logger.info(f'Downloaded s3://{self.bucket_name}/{key} (ETag {new_etag})')
+
+                self._update_index(key, {'etag': new_etag, 'checked': time.time()},
+                                   entry['etag'] if entry else None)
+
+            return CachedObject(key, self._blob_path(new_etag), new_etag)
+
+    def get_path(self, key):
+        """
+        Returns the local path of an object, e.g. for memory mapping.
+        """
+        return self.fetch(key).path
+
+    def get_object(self, key):
+        """
+        Returns the contents of an object as bytes.
+        """
+        with open(self.fetch(key).path, 'rb') as f:
+            return f.read()
+
+    def etag(self, key, download=True):
+        """
+        Returns the current ETag of an object; usable as a version tag for derived artifacts.
+
+        Args:
+            key (str): Object key.
+            download (bool, optional): When False, ask S3 with a HEAD request and never download
+                the object, even when the cached copy is outdated.
+        """
+        if download:
+            return self.fetch(key).etag
+
+        entry = self._index.get(key)
+        try:
+            etag = self.client.head_object(Bucket=self.bucket_name, Key=key)['ETag'].strip('"')
+        except (BotoCoreError, ClientError) as e:
+            if isinstance(e, ClientError) and _is_missing(e):
+                raise FileNotFoundError(f's3://{self.bucket_name}/{key} does not exist') from e
+            if entry is None:
+                raise
+            logger.warning(f'Could not check the ETag of {key} ({e}), using the cached one')
+            self.stats['stale'] += 1
+            return entry['etag']
+
+        if entry is not None and entry['etag'] == etag:
+            with self._lock:
+                # The cached copy is current, so the next fetch needn't revalidate it yet
+                entry['checked'] = time.time()
+        return etag
+
+    def prefetch(self, keys):
+        """
+        Downloads or revalidates independent objects in parallel.
+
+        Args:
+            keys (list): Object keys.
+
+        Returns:
+            dict: Key to CachedObject for every key that could be fetched.
+        """
+        def fetch_or_none(key):
+            try:
+                return self.fetch(key)
+            except (FileNotFoundError, BotoCoreError, ClientError) as e:
+                logger.warning(f'Could not prefetch {key}: {e}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, max(len(keys), 1))) as executor:
+            results = dict(zip(keys, executor.map(fetch_or_none, keys)))
+        return {key: result for key, result in results.items() if result is not None}
+
+
+class S3MultipartWriter:
+    """
+    Write-only file object that streams to an S3 object with a multipart upload.
+
+    Data is buffered until a part is full and uploaded as soon as it is, so at most one
+    part is held in memory no matter how large the object gets. The upload is completed
+    on close, or aborted when the with block raises.
+    """
+
+    def __init__(self, bucket_name, key, client=None, part_size=MULTIPART_PART_SIZE, extra_args=None,
+                 upload_id=None, parts=None):
+        self.client = client if client is not None else get_s3_client()
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+
+        if upload_id is None:
+            response = self.client.create_multipart_upload(Bucket=bucket_name, Key=key, **(extra_args or {}))
+            upload_id = response['UploadId']
+        self.upload_id = upload_id
+
+        # Resuming continues after parts that were already uploaded, each exactly part_size bytes
+        self._parts = list(parts or [])
+        self._buffer = bytearray()
+        self._position = len(self._parts) * part_size
+        self.closed = False
+
+    @classmethod
+    def resume(cls, bucket_name, key, upload_id, client=None, part_size=MULTIPART_PART_SIZE):
+        """
+        Reopens an unfinished upload after its leading run of complete parts.
+
+        Returns:
+            S3MultipartWriter or None: Writer positioned at tell(), or None when the upload no longer exists.
+        """
+        client = client if client is not None else get_s3_client()
+        parts = []
+        try:
+            for page in client.get_paginator('list_parts').paginate(Bucket=bucket_name, Key=key, UploadId=upload_id):
+                parts.extend(page.get('Parts', []))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchUpload', '404'):
+                return None
+            raise
+
+        completed = []
+        for part in sorted(parts, key=lambda part: part['PartNumber']):
+            if part['PartNumber'] != len(completed) + 1 or part['Size'] != part_size:
+                break
+            completed.append({'PartNumber': part['PartNumber'], 'ETag': part['ETag']})
+
+        return cls(bucket_name, key, client=client, part_size=part_size, upload_id=upload_id, parts=completed)
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readable(self):
+        return False
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed S3MultipartWriter')
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        # Parts are only uploaded once full; the remainder is uploaded on close
+        pass
+
+    def _upload_part(self, body):
+        part_number = len(self._parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=body)
+        self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def close(self):
+        """
+        Uploads the remaining data and completes the upload.
+        """
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._parts:
+                self._upload_part(bytes(self._buffer))
+                self._buffer.clear()
+            self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': self._parts})
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+
+    def abort(self):
+        """
+        Discards the upload and every part uploaded so far.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        except (BotoCoreError, ClientError) as e:
+            logger.warning(f'Could not abort multipart upload of {self.key}: {e}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def get_object_cache(bucket_name=BUCKET_NAME, cache_dir=CACHE_DIR):
+    """
+    Returns the process wide object cache for a bucket so every page shares one client and index.
+    """
+    with _client_lock:
+        cache = _object_caches.get((bucket_name, cache_dir))
+    if cache is None:
+        cache = S3ObjectCache(bucket_name=bucket_name, cache_dir=cache_dir)
+        with _client_lock:
+            cache = _object_caches.setdefault((bucket_name, cache_dir), cache)
+    return cache
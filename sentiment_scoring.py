@@ -0,0 +1,413 @@
+## this file contains the parallel, streaming sentiment scoring pipeline for reviews
+import os
+import re
+import time
+import hashlib
+import logging
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+from nltk.tokenize import word_tokenize
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+from helper_functions import get_data_batches, bulk_write_to_snowflake, BULK_CHUNK_ROWS
+
+logger = logging.getLogger(__name__)
+
+NLTK_RESOURCES = ['stopwords', 'punkt', 'punkt_tab', 'wordnet', 'omw-1.4', 'vader_lexicon']
+
+# Reviews scored per task sent to a worker process
+CHUNK_SIZE = 5000
+
+# Review scores above/below these compound scores are positive/negative, the rest neutral
+POSITIVE_THRESHOLD = 0.05
+NEGATIVE_THRESHOLD = -0.05
+
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+# NLTK objects are created once per process, in the parent or in each pool worker
+_stop_words = None
+_lemmatizer = None
+_sid = None
+
+
+def download_nltk_resources():
+    for resource in NLTK_RESOURCES:
+        nltk.download(resource, quiet=True)
+
+
+def _init_worker():
+    global _stop_words, _lemmatizer, _sid
+    if _sid is None:
+        _stop_words = frozenset(stopwords.words('english'))
+        _lemmatizer = WordNetLemmatizer()
+        _sid = SentimentIntensityAnalyzer()
+
+
+@lru_cache(maxsize=500_000)
+def _clean_token(word):
+    # Review vocabularies are heavily repeated, so the stopword check and WordNet lookup run once per word
+    if word in _stop_words:
+        return None
+    return _lemmatizer.lemmatize(word)
+
+
+def clean_text(text):
+    """
+    Removes punctuation and stopwords from a review and lemmatizes the remaining words.
+
+    Args:
+        text (str): Review comment.
+
+    Returns:
+        str: Cleaned comment, words separated by single spaces.
+    """
+    _init_worker()
+
+    # Remove punctuation and convert to lowercase
+    text = PUNCTUATION_RE.sub('', text).lower()
+
+    words = (_clean_token(word) for word in word_tokenize(text))
+    return ' '.join(word for word in words if word is not None)
+
+
+def comment_hash(text):
+    """
+    Returns the hex MD5 of a comment, equal to Snowflake's MD5(COMMENTS).
+    """
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def get_sentiment_score(text):
+    _init_worker()
+    return _sid.polarity_scores(text)['compound']
+
+
+def score_reviews(df):
+    """
+    Adds clean_comments, sentiment_score, sentiment and comment_hash columns to a chunk of reviews.
+
+    comment_hash records which version of a review was scored, so incremental runs can
+    skip reviews whose text has not changed.
+
+    Args:
+        df (pd.DataFrame): Reviews with a comments column.
+
+    Returns:
+        pd.DataFrame: The same frame with the added columns.
+    """
+    _init_worker()
+
+    df['clean_comments'] = [clean_text(text) for text in df['comments']]
+    scores = np.array([_sid.polarity_scores(text)['compound'] for text in df['clean_comments']], dtype=float)
+    df['sentiment_score'] = scores
+    df['sentiment'] = np.select([scores >= POSITIVE_THRESHOLD, scores <= NEGATIVE_THRESHOLD],
+                                ['positive', 'negative'], default='neutral')
+    df['comment_hash'] = [comment_hash(text) for text in df['comments']]
+    return df
+
+
+def rechunk(chunks, chunk_size=CHUNK_SIZE):
+    """
+    Regroups a stream of DataFrames into frames of at most chunk_size rows.
+    """
+    pending = []
+    pending_rows = 0
+    for chunk in chunks:
+        for start in range(0, len(chunk), chunk_size):
+            piece = chunk.iloc[start:start + chunk_size]
+            pending.append(piece)
+            pending_rows += len(piece)
+            if pending_rows >= chunk_size:
+                combined = pd.concat(pending, ignore_index=True)
+                yield combined.iloc[:chunk_size]
+                rest = combined.iloc[chunk_size:]
+                pending, pending_rows = ([rest], len(rest)) if len(rest) else ([], 0)
+    if pending_rows:
+        yield pd.concat(pending, ignore_index=True)
+
+
+def score_review_chunks(chunks, processes=None, max_pending=None):
+    """
+    Scores a stream of review chunks across a process pool.
+
+    At most max_pending chunks are in flight, so memory stays bounded no matter how many
+    reviews the stream holds. Scored chunks are yielded in input order.
+
+    Args:
+        chunks (iterable): DataFrames of reviews with a comments column.
+        processes (int, optional): Worker processes. Defaults to the CPU count; 1 scores in-process.
+        max_pending (int, optional): Chunks submitted but not yet yielded. Defaults to 2 per process.
+
+    Yields:
+        pd.DataFrame: Scored chunks, see score_reviews.
+    """
+    processes = processes or os.cpu_count() or 1
+
+    if processes == 1:
+        for chunk in chunks:
+            yield score_reviews(chunk)
+        return
+
+    max_pending = max_pending or 2 * processes
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(score_reviews, chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_query_chunks(conn, sql_query, params=None, chunk_size=CHUNK_SIZE):
+    """
+    Streams the result of a query in chunks.
+
+    Args:
+        conn (snowflake.connector or SnowflakeConnectionPool): Snowflake connection or pool.
+        sql_query (str): SQL query to execute.
+        params (tuple, optional): Query parameters.
+        chunk_size (int, optional): Rows per yielded chunk.
+
+    Yields:
+        pd.DataFrame: Rows with lowercase column names.
+    """
+    return rechunk(get_data_batches(sql_query, conn, params=params), chunk_size)
+
+
+def read_review_chunks(conn, market, chunk_size=CHUNK_SIZE, source_schema='ODS'):
+    """
+    Streams all of a market's reviews with a comment from the ODS REVIEWS table in chunks.
+    """
+    sql_query = f'SELECT * FROM {source_schema}.REVIEWS WHERE market = %s AND COMMENTS IS NOT NULL'
+    return read_query_chunks(conn, sql_query, (market,), chunk_size)
+
+
+def read_changed_review_chunks(conn, market, chunk_size=CHUNK_SIZE, source_schema='ODS',
+                               schema_name='FEATURE_STORE', table_name='REVIEWS_SENTIMENT_SCORES'):
+    """
+    Streams only the reviews that have no score for their current text.
+
+    The comparison runs in Snowflake: a review is returned when the scores table has no
+    row with the same id and the same MD5 of the comment. Reviews without a comment are never
+    scored; MD5(NULL) is NULL and would match no score, so they are left out here too. An id
+    loaded more than once is returned once, with its latest review, since the MERGE of the
+    scores rejects duplicate ids.
+
+    Args:
+        conn (snowflake.connector): Snowflake connection.
+        market (str): Market name.
+        chunk_size (int, optional): Rows per yielded chunk.
+        source_schema (str, optional): Schema of the REVIEWS table.
+        schema_name (str, optional): Schema of the scores table.
+        table_name (str, optional): Scores table.
+
+    Yields:
+        pd.DataFrame: New or changed reviews with lowercase column names.
+    """
+    sql_query = f"""
+        SELECT r.*
+        FROM {source_schema}.REVIEWS r
+        LEFT JOIN {schema_name}.{table_name} s
+            ON s.ID = r.ID AND s.COMMENT_HASH = MD5(r.COMMENTS)
+        WHERE r.MARKET = %s AND r.COMMENTS IS NOT NULL AND s.ID IS NULL
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY r.ID ORDER BY r.REVIEW_DATE DESC, r.COMMENTS) = 1
+    """
+    return read_query_chunks(conn, sql_query, (market,), chunk_size)
+
+
+def _table_columns(conn, schema_name, table_name):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s',
+                       (schema_name.upper(), table_name.upper()))
+        return {row[0].upper() for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def process_and_upload_sentiment_scores(markets, conn, output_conn=None, processes=None, chunk_size=CHUNK_SIZE,
+                                        incremental=False, write_rows=BULK_CHUNK_ROWS, source_schema='ODS',
+                                        schema_name='FEATURE_STORE', table_name='REVIEWS_SENTIMENT_SCORES'):
+    """
+    Scores each market's reviews and writes them to Snowflake chunk by chunk.
+
+    Scored chunks are collected until write_rows reviews or the end of the market and then
+    written with one bulk load, so the stage, PUT and COPY INTO are paid per write rather than
+    per scoring chunk. In full mode the first write recreates the table and later writes are
+    appended, matching the original notebook pipeline. In incremental mode only reviews without a score for
+    their current text are scored and merged on ID, so scores of reviews whose text changed
+    are replaced in place and a refresh costs time proportional to the new reviews.
+
+    Args:
+        markets (list): Markets to process.
+        conn (snowflake.connector or SnowflakeConnectionPool): Connection or pool used to read reviews.
+        output_conn (snowflake.connector, optional): Connection used for writes. Defaults to conn.
+        processes (int, optional): Worker processes, see score_review_chunks.
+        chunk_size (int, optional): Reviews per chunk.
+        incremental (bool, optional): Score only new or changed reviews.
+        write_rows (int, optional): Scored reviews collected per bulk write.
+        source_schema (str, optional): Schema of the REVIEWS table.
+        schema_name (str, optional): Schema to write to.
+        table_name (str, optional): Table to write to.
+
+    Returns:
+        dict: Market to number of reviews scored.
+    """
+    output_conn = output_conn or conn
+
+    if incremental:
+        columns = _table_columns(output_conn, schema_name, table_name)
+        if not columns:
+            print(f'Table {schema_name}.{table_name} does not exist, running a full refresh')
+            incremental = False
+        elif 'COMMENT_HASH' not in columns:
+            # Scores written before comment hashes existed are rescored once
+            cursor = output_conn.cursor()
+            try:
+                cursor.execute(f'ALTER TABLE {schema_name}.{table_name} ADD COLUMN COMMENT_HASH VARCHAR(32)')
+            finally:
+                cursor.close()
+
+    create_table = not incremental
+    counts = {}
+
+    def write(scored_chunks):
+        nonlocal create_table
+        scored = pd.concat(scored_chunks, ignore_index=True)
+        # Capitalize column names prior to writing to Snowflake
+        scored.columns = [column.upper() for column in scored.columns]
+        if incremental:
+            bulk_write_to_snowflake(scored, output_conn, schema_name, table_name, merge_keys=['ID'])
+        else:
+            bulk_write_to_snowflake(scored, output_conn, schema_name, table_name, overwrite_table=create_table)
+        create_table = False
+
+    for market in markets:
+        print(f'Running pipeline for market: {market}')
+        start = time.perf_counter()
+        counts[market] = 0
+
+        if incremental:
+            chunks = read_changed_review_chunks(conn, market, chunk_size, source_schema, schema_name, table_name)
+        else:
+            chunks = read_review_chunks(conn, market, chunk_size, source_schema)
+
+        pending, pending_rows = [], 0
+        for scored in score_review_chunks(chunks, processes):
+            pending.append(scored)
+            pending_rows += len(scored)
+            counts[market] += len(scored)
+            if pending_rows >= write_rows:
+                write(pending)
+                pending, pending_rows = [], 0
+        if pending:
+            write(pending)
+
+        elapsed = time.perf_counter() - start
+        print(f'Scored {counts[market]} reviews for {market} in {elapsed:.1f}s '
+              f'({counts[market] / max(elapsed, 1e-9):.0f} reviews/sec)')
+
+    return counts
+
+
+def _score_reviews_baseline(df):
+    # The original notebook path: uncached lemmatizer and row by row .apply
+    stop_words = set(stopwords.words('english'))
+    lemmatizer = WordNetLemmatizer()
+    sid = SentimentIntensityAnalyzer()
+
+    def baseline_clean_text(text):
+        text = re.sub(r'[^\w\s]', '', text)
+        text = text.lower()
+        words = word_tokenize(text)
+        words = [word for word in words if word not in stop_words]
+        words = [lemmatizer.lemmatize(word) for word in words]
+        return ' '.join(words)
+
+    df['clean_comments'] = df['comments'].apply(baseline_clean_text)
+    df['sentiment_score'] = df['clean_comments'].apply(lambda text: sid.polarity_scores(text)['compound'])
+    df['sentiment'] = df['sentiment_score'].apply(
+        lambda x: 'positive' if x >= 0.05 else ('negative' if x <= -0.05 else 'neutral'))
+    return df
+
+
+def benchmark(reviews, processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Compares reviews/sec of the original .apply path with the streaming pool.
+
+    Args:
+        reviews (pd.DataFrame): Reviews with a comments column.
+        processes (int, optional): Worker processes for the streaming path.
+        chunk_size (int, optional): Reviews per chunk for the streaming path.
+
+    Returns:
+        dict: Review count, seconds and reviews/sec for each path, and the speedup.
+    """
+    start = time.perf_counter()
+    baseline = _score_reviews_baseline(reviews[['comments']].copy())
+    baseline_seconds = time.perf_counter() - start
+
+    chunks = (reviews[['comments']].iloc[i:i + chunk_size].copy() for i in range(0, len(reviews), chunk_size))
+    start = time.perf_counter()
+    streaming = pd.concat(list(score_review_chunks(chunks, processes)), ignore_index=True)
+    streaming_seconds = time.perf_counter() - start
+
+    if not np.allclose(baseline['sentiment_score'].to_numpy(), streaming['sentiment_score'].to_numpy()):
+        logger.warning('Streaming scores differ from the baseline scores')
+
+    return {
+        'reviews': len(reviews),
+        'baseline_seconds': baseline_seconds,
+        'baseline_reviews_per_sec': len(reviews) / baseline_seconds,
+        'streaming_seconds': streaming_seconds,
+        'streaming_reviews_per_sec': len(reviews) / streaming_seconds,
+        'speedup': baseline_seconds / streaming_seconds
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Score review sentiment or benchmark the scoring pipeline')
+    parser.add_argument('--markets', nargs='+',
+                        default=['albany', 'chicago', 'los-angeles', 'new-york-city', 'san-francisco', 'seattle', 'washington-dc'])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--write-rows', type=int, default=BULK_CHUNK_ROWS, help='Scored reviews per bulk write')
+    parser.add_argument('--incremental', action='store_true', help='Score only new or changed reviews')
+    parser.add_argument('--benchmark', metavar='REVIEWS_FILE',
+                        help='Parquet or CSV file of reviews to benchmark instead of running the pipeline')
+    parser.add_argument('--sample', type=int, default=20000, help='Reviews to use for the benchmark')
+    args = parser.parse_args()
+
+    download_nltk_resources()
+
+    if args.benchmark:
+        if args.benchmark.endswith('.parquet'):
+            reviews = pd.read_parquet(args.benchmark, columns=['comments'])
+        else:
+            reviews = pd.read_csv(args.benchmark, usecols=['comments'])
+        reviews = reviews.dropna(subset=['comments']).head(args.sample)
+        print(json.dumps(benchmark(reviews, args.processes, args.chunk_size), indent=4))
+    else:
+        from helper_functions import get_connection_pool
+
+        # Reviews are streamed on one pooled session while scores are written on another
+        pool = get_connection_pool(schema_name='ODS')
+        try:
+            with pool.connection() as output_conn:
+                process_and_upload_sentiment_scores(args.markets, pool, output_conn=output_conn,
+                                                    processes=args.processes, chunk_size=args.chunk_size,
+                                                    incremental=args.incremental, write_rows=args.write_rows)
+            print(json.dumps(pool.metrics(), indent=4))
+        finally:
+            pool.close()
@@ -0,0 +1,434 @@
+## this file contains the batch stage that renders the per-market sentiment charts from the scored reviews
+import os
+import json
+import time
+import heapq
+import hashlib
+import logging
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from sentiment_scoring import CHUNK_SIZE, read_query_chunks, rechunk
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_DIR = os.path.join('Plots', 'Sentiment_Analysis_Visualizations')
+MANIFEST_FILE = 'manifest.json'
+
+# Charts written per market, named <market>_<chart>.png like the notebook's
+CHARTS = ['digram', 'trigram', 'wordcloud', 'sentiment_time', 'distribution_sentiment', 'distribution_sentiment_scores']
+
+# N-grams are hashed once into 31 bits, then counted in a count-min sketch whose rows have pairwise coprime
+# widths, so each row puts a different set of n-grams in the same counter. 4 x 2**20 counts take 32 MB
+HASH_FEATURES = 2 ** 31 - 1
+SKETCH_WIDTHS = (2 ** 20, 2 ** 20 - 1, 2 ** 20 - 3, 2 ** 20 - 5)
+TOP_K = 20
+WORDCLOUD_WORDS = 200
+
+# Reviews kept per market to name the most frequent n-grams, see NgramCounter
+NAME_SAMPLE_DOCS = 20_000
+
+SCORE_BINS = np.linspace(-1, 1, 21)
+SENTIMENTS = ['positive', 'neutral', 'negative']
+SENTIMENT_COLORS = ['green', 'red', 'blue']
+
+# Bumped whenever the summaries or charts change, so every market is re-rendered once
+STAGE_VERSION = '1'
+
+
+def _single_feature(text):
+    return [text]
+
+
+def word_ngrams(text, max_ngram=3):
+    """
+    Returns the words of a cleaned review followed by its n-grams of up to max_ngram words.
+
+    clean_comments are lowercased words separated by single spaces, so splitting is all the
+    tokenizing needed; zipping shifted word lists is several times faster than sklearn's analyzer.
+    """
+    words = text.split()
+    ngrams = list(words)
+    for n in range(2, max_ngram + 1):
+        ngrams.extend(map(' '.join, zip(*(words[i:] for i in range(n)))))
+    return ngrams
+
+
+def _vectorizer(analyzer):
+    return HashingVectorizer(n_features=HASH_FEATURES, analyzer=analyzer, alternate_sign=False, norm=None)
+
+
+class NgramCounter:
+    """
+    Counts n-grams over a stream of texts with hashed vectorization.
+
+    Every chunk is tokenized once into all n-gram sizes and hashed; the hashes are added to a
+    count-min sketch of fixed size, so memory does not grow with the vocabulary. Hashes can't be
+    turned back into text, so a reservoir sample of the texts is kept and, once the stream ends,
+    the sample's n-grams are ranked by their sketch counts. A count can only be too high, by the
+    n-grams colliding with it in every row.
+    """
+
+    def __init__(self, max_ngram=3, sample_size=NAME_SAMPLE_DOCS, seed=0):
+        self.analyzer = partial(word_ngrams, max_ngram=max_ngram)
+        self.vectorizer = _vectorizer(self.analyzer)
+        self.sketch = [np.zeros(width, dtype=np.float64) for width in SKETCH_WIDTHS]
+        self.sample = []
+        self.sample_size = sample_size
+        self.seen = 0
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, texts):
+        texts = list(texts)
+        if not texts:
+            return
+        hashed = self.vectorizer.transform(texts)
+        for row, width in zip(self.sketch, SKETCH_WIDTHS):
+            row += np.bincount(hashed.indices % width, weights=hashed.data, minlength=width)
+
+        # Reservoir sampling: every text seen so far has the same chance of being in the sample
+        free = max(self.sample_size - len(self.sample), 0)
+        self.sample.extend(texts[:free])
+        if len(texts) > free:
+            positions = np.arange(self.seen + free, self.seen + len(texts)) + 1
+            slots = self._rng.integers(0, positions)
+            for i in np.flatnonzero(slots < self.sample_size).tolist():
+                self.sample[slots[i]] = texts[free + i]
+        self.seen += len(texts)
+
+    def estimate(self, hashes):
+        hashes = np.asarray(hashes)
+        return np.min([row[hashes % width] for row, width in zip(self.sketch, SKETCH_WIDTHS)], axis=0)
+
+    def top(self, k=TOP_K):
+        """
+        Returns the k most frequent n-grams of every size.
+
+        Returns:
+            dict: N-gram size to (n-gram, count) pairs, most frequent first.
+        """
+        ngrams = sorted({ngram for text in self.sample for ngram in self.analyzer(text)})
+        if not ngrams:
+            return {}
+        hashes = _vectorizer(_single_feature).transform(ngrams).indices
+        counts = self.estimate(hashes)
+
+        by_size = {}
+        for ngram, count in zip(ngrams, counts.tolist()):
+            by_size.setdefault(ngram.count(' ') + 1, []).append((ngram, int(count)))
+        return {size: heapq.nlargest(k, pairs, key=lambda pair: pair[1]) for size, pairs in by_size.items()}
+
+
+class MarketSummary:
+    """
+    Everything the charts of one market need, accumulated chunk by chunk in a single pass.
+    """
+
+    def __init__(self, market, freq='W', top_k=TOP_K, wordcloud_words=WORDCLOUD_WORDS):
+        self.market = market
+        self.freq = freq
+        self.top_k = top_k
+        self.wordcloud_words = wordcloud_words
+        self.ngrams = NgramCounter(max_ngram=3)
+        self.sentiment_counts = pd.Series(0, index=SENTIMENTS, dtype='int64')
+        self.score_histogram = np.zeros(len(SCORE_BINS) - 1, dtype=np.int64)
+        self.over_time = None
+        self.reviews = 0
+
+    def update(self, chunk):
+        """
+        Adds a chunk of scored reviews with clean_comments, sentiment_score, sentiment and review_date columns.
+        """
+        texts = chunk['clean_comments'].fillna('').astype(str).tolist()
+        self.ngrams.update(texts)
+
+        self.sentiment_counts = self.sentiment_counts.add(chunk['sentiment'].value_counts(), fill_value=0).astype('int64')
+        scores = pd.to_numeric(chunk['sentiment_score'], errors='coerce').dropna().to_numpy()
+        self.score_histogram += np.histogram(np.clip(scores, -1, 1), bins=SCORE_BINS)[0]
+
+        # Reviews per time bucket and sentiment; small enough to merge into the running total every chunk
+        dates = pd.to_datetime(chunk['review_date'], errors='coerce')
+        buckets = dates.dt.to_period(self.freq).dt.start_time
+        counts = chunk.groupby([buckets, chunk['sentiment']]).size().unstack(fill_value=0)
+        self.over_time = counts if self.over_time is None else self.over_time.add(counts, fill_value=0)
+        self.reviews += len(chunk)
+
+    def to_dict(self):
+        """
+        Returns the summary as plain data for a render worker.
+        """
+        over_time = self.over_time if self.over_time is not None else pd.DataFrame()
+        over_time = over_time.reindex(columns=[s for s in SENTIMENTS[::-1] if s in over_time.columns]).fillna(0)
+        top = self.ngrams.top(max(self.top_k, self.wordcloud_words))
+        return {
+            'market': self.market,
+            'reviews': self.reviews,
+            'digram': top.get(2, [])[:self.top_k],
+            'trigram': top.get(3, [])[:self.top_k],
+            'words': dict(top.get(1, [])[:self.wordcloud_words]),
+            'sentiment_counts': self.sentiment_counts.reindex(SENTIMENTS, fill_value=0).tolist(),
+            'score_histogram': self.score_histogram.tolist(),
+            'over_time': {
+                'dates': [date.strftime('%Y-%m-%d') for date in over_time.index.sort_values()],
+                'counts': {column: over_time.sort_index()[column].astype(int).tolist() for column in over_time.columns}
+            }
+        }
+
+
+def _ngram_chart(plt, path, ngrams, n):
+    plt.figure(figsize=(10, 5))
+    plt.bar([ngram for ngram, _ in ngrams], [count for _, count in ngrams])
+    plt.title(f'Top {len(ngrams)} Most Common {n}-grams')
+    plt.xlabel(f'{n}-grams')
+    plt.ylabel('Frequency')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+
+def render_market_charts(summary, output_dir=OUTPUT_DIR):
+    """
+    Renders every chart of one market. Runs in a worker process.
+
+    Args:
+        summary (dict): See MarketSummary.to_dict.
+        output_dir (str, optional): Directory to write the charts to.
+
+    Returns:
+        dict: Market, chart paths and render seconds.
+    """
+    start = time.perf_counter()
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from wordcloud import WordCloud
+
+    market = summary['market']
+    paths = {chart: os.path.join(output_dir, f'{market}_{chart}.png') for chart in CHARTS}
+
+    _ngram_chart(plt, paths['digram'], summary['digram'], 2)
+    _ngram_chart(plt, paths['trigram'], summary['trigram'], 3)
+
+    plt.figure(figsize=(10, 5))
+    if summary['words']:
+        wordcloud = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(summary['words'])
+        plt.imshow(wordcloud, interpolation='bilinear')
+    plt.axis('off')
+    plt.savefig(paths['wordcloud'], bbox_inches='tight')
+    plt.close()
+
+    over_time = summary['over_time']
+    plt.figure(figsize=(15, 7))
+    dates = pd.to_datetime(over_time['dates'])
+    for sentiment, counts in over_time['counts'].items():
+        plt.plot(dates, counts, label=sentiment)
+    plt.title('Sentiment Trends Over Time')
+    plt.xlabel('Date')
+    plt.ylabel('Number of Reviews')
+    plt.legend(title='sentiment')
+    plt.savefig(paths['sentiment_time'], bbox_inches='tight')
+    plt.close()
+
+    plt.figure(figsize=(10, 5))
+    plt.bar(SENTIMENTS, summary['sentiment_counts'], color=SENTIMENT_COLORS)
+    plt.title('Distribution of Sentiment')
+    plt.xlabel('Sentiment')
+    plt.ylabel('Frequency')
+    plt.xticks(rotation=90)
+    plt.savefig(paths['distribution_sentiment'], bbox_inches='tight')
+    plt.close()
+
+    plt.figure(figsize=(10, 5))
+    plt.hist(SCORE_BINS[:-1], bins=SCORE_BINS, weights=summary['score_histogram'], color='skyblue', edgecolor='black')
+    plt.title('Distribution of Sentiment Scores')
+    plt.xlabel('Sentiment Score')
+    plt.ylabel('Frequency')
+    plt.savefig(paths['distribution_sentiment_scores'], bbox_inches='tight')
+    plt.close()
+
+    return {'market': market, 'paths': list(paths.values()), 'render_seconds': time.perf_counter() - start}
+
+
+def stage_settings(freq, top_k):
+    return f'{STAGE_VERSION}:{freq}:{top_k}:{SKETCH_WIDTHS}'
+
+
+def fingerprint(*parts):
+    return hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def snowflake_fingerprints(conn, markets, settings, schema_name='FEATURE_STORE', table_name='REVIEWS_SENTIMENT_SCORES'):
+    """
+    Fingerprints each market's scored reviews without reading them.
+
+    Snowflake's HASH_AGG over the id, comment hash and score of every review changes whenever a
+    review is added, removed, edited or rescored, and doesn't depend on row order.
+
+    Returns:
+        dict: Market to fingerprint.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'SELECT MARKET, COUNT(*), HASH_AGG(ID, COMMENT_HASH, SENTIMENT_SCORE) '
+                       f'FROM {schema_name}.{table_name} WHERE MARKET IN ({", ".join(["%s"] * len(markets))}) '
+                       f'GROUP BY MARKET', tuple(markets))
+        return {market: fingerprint(settings, count, digest) for market, count, digest in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def frame_fingerprint(reviews, settings):
+    """
+    Fingerprints a market's scored reviews held in a DataFrame, independent of row order.
+    """
+    columns = [column for column in ('id', 'comment_hash', 'sentiment_score', 'clean_comments', 'review_date')
+               if column in reviews.columns]
+    digest = int(pd.util.hash_pandas_object(reviews[columns], index=False).sum())
+    return fingerprint(settings, len(reviews), digest)
+
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest, output_dir):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def is_current(manifest, market, market_fingerprint, output_dir):
+    entry = manifest.get(market)
+    return (entry is not None and entry['fingerprint'] == market_fingerprint
+            and all(os.path.exists(os.path.join(output_dir, f'{market}_{chart}.png')) for chart in CHARTS))
+
+
+def render_sentiment_charts(market_chunks, fingerprints, output_dir=OUTPUT_DIR, processes=None, freq='W',
+                            top_k=TOP_K, force=False):
+    """
+    Renders the charts of every market whose scored reviews changed since they were last rendered.
+
+    Each market's reviews are read once, chunk by chunk, into a MarketSummary. The finished summary
+    is handed to a process pool to render while the next market is read, so reading and rendering
+    overlap and memory holds one chunk plus the summaries.
+
+    Args:
+        market_chunks (callable): Returns an iterable of review chunks for a market.
+        fingerprints (dict): Market to fingerprint of its reviews; markets missing here are skipped.
+        output_dir (str, optional): Directory holding the charts and the manifest.
+        processes (int, optional): Render worker processes. Defaults to the CPU count; 1 renders in-process.
+        freq (str, optional): Pandas period of the sentiment over time buckets, e.g. 'D', 'W' or 'M'.
+        top_k (int, optional): N-grams per chart.
+        force (bool, optional): Re-render markets whose fingerprint didn't change.
+
+    Returns:
+        dict: Market to its manifest entry, with 'skipped' set for markets that were current.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    processes = processes or os.cpu_count() or 1
+    results = {}
+
+    stale = []
+    for market, market_fingerprint in fingerprints.items():
+        if not force and is_current(manifest, market, market_fingerprint, output_dir):
+            print(f'Charts for {market} are up to date')
+            results[market] = {**manifest[market], 'skipped': True}
+        else:
+            stale.append(market)
+
+    def summarize(market):
+        start = time.perf_counter()
+        summary = MarketSummary(market, freq, top_k)
+        for chunk in market_chunks(market):
+            summary.update(chunk)
+        return summary.to_dict(), time.perf_counter() - start
+
+    def record(market, summary, read_seconds, rendered):
+        manifest[market] = {'fingerprint': fingerprints[market], 'reviews': summary['reviews'],
+                            'read_seconds': round(read_seconds, 3), 'render_seconds': round(rendered['render_seconds'], 3),
+                            'rendered_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        results[market] = {**manifest[market], 'skipped': False}
+        # Saved after every market so an interrupted run keeps what it finished
+        save_manifest(manifest, output_dir)
+        print(f'Rendered charts for {market} from {summary["reviews"]} reviews '
+              f'(read {read_seconds:.1f}s, render {rendered["render_seconds"]:.1f}s)')
+
+    if processes == 1 or len(stale) <= 1:
+        for market in stale:
+            summary, read_seconds = summarize(market)
+            record(market, summary, read_seconds, render_market_charts(summary, output_dir))
+        return results
+
+    with ProcessPoolExecutor(max_workers=min(processes, len(stale))) as executor:
+        pending = []
+        for market in stale:
+            summary, read_seconds = summarize(market)
+            pending.append((market, summary, read_seconds, executor.submit(render_market_charts, summary, output_dir)))
+        for market, summary, read_seconds, future in pending:
+            record(market, summary, read_seconds, future.result())
+
+    return results
+
+
+def read_scored_review_chunks(conn, market, chunk_size=CHUNK_SIZE,
+                              schema_name='FEATURE_STORE', table_name='REVIEWS_SENTIMENT_SCORES'):
+    """
+    Streams the columns the charts need from a market's scored reviews.
+    """
+    sql_query = (f'SELECT REVIEW_DATE, CLEAN_COMMENTS, SENTIMENT_SCORE, SENTIMENT '
+                 f'FROM {schema_name}.{table_name} WHERE MARKET = %s')
+    return read_query_chunks(conn, sql_query, (market,), chunk_size)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Render the per-market sentiment charts from the scored reviews')
+    parser.add_argument('--markets', nargs='+',
+                        default=['albany', 'chicago', 'los-angeles', 'new-york-city', 'san-francisco', 'seattle', 'washington-dc'])
+    parser.add_argument('--input', help='Parquet or CSV file of scored reviews to read instead of Snowflake')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--freq', default='W', help="Time bucket of the sentiment over time chart, e.g. 'D', 'W' or 'M'")
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    parser.add_argument('--force', action='store_true', help='Re-render markets whose reviews did not change')
+    args = parser.parse_args()
+
+    settings = stage_settings(args.freq, args.top_k)
+    start = time.perf_counter()
+
+    if args.input:
+        reviews = pd.read_parquet(args.input) if args.input.endswith('.parquet') else pd.read_csv(args.input)
+        reviews.columns = [column.lower() for column in reviews.columns]
+        by_market = {market: frame for market, frame in reviews.groupby('market') if market in args.markets}
+        fingerprints = {market: frame_fingerprint(frame, settings) for market, frame in by_market.items()}
+        results = render_sentiment_charts(lambda market: rechunk([by_market[market]], args.chunk_size), fingerprints,
+                                          args.output_dir, args.processes, args.freq, args.top_k, args.force)
+    else:
+        from helper_functions import get_connection_pool
+
+        pool = get_connection_pool(schema_name='FEATURE_STORE')
+        try:
+            with pool.connection() as conn:
+                fingerprints = snowflake_fingerprints(conn, args.markets, settings)
+            results = render_sentiment_charts(lambda market: read_scored_review_chunks(pool, market, args.chunk_size),
+                                              fingerprints, args.output_dir, args.processes, args.freq, args.top_k,
+                                              args.force)
+        finally:
+            pool.close()
+
+    rendered = sum(not result['skipped'] for result in results.values())
+    print(f'Rendered {rendered} of {len(results)} markets in {time.perf_counter() - start:.1f}s')
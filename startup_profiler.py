@@ -0,0 +1,227 @@
+## this file contains the startup profiler that times the phases of each dashboard page run
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Phases the pages report; a page may time any subset
+PHASES = ['imports', 's3_fetch', 'parse', 'predict', 'charts', 'map_render']
+
+# Show the profile on every page (also enabled per session with ?profile=1)
+PROFILE_ENABLED = os.getenv('AIRBNB_PROFILE', '0') == '1'
+
+# Runs kept per page so a slow rerun can be compared with earlier ones
+HISTORY_SIZE = 20
+
+# A phase regressed when it is this much slower than the baseline, and by at least MIN_REGRESSION_SECONDS
+REGRESSION_THRESHOLD = 0.2
+MIN_REGRESSION_SECONDS = 0.05
+
+_history = {}
+_history_lock = threading.Lock()
+_last_record = None
+
+
+class PageProfiler:
+    """
+    Times the phases of one page run.
+
+    Phases with the same name add up, so e.g. every S3 fetch in a run counts towards s3_fetch.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self.started = time.perf_counter()
+        self._checkpoint = self.started
+        self.timings = {}
+
+    def mark(self, name):
+        """
+        Counts the time since the profiler started, or since the previous mark, towards a phase.
+
+        Used for the imports at the top of a page, which can't be wrapped in a with block.
+        """
+        now = time.perf_counter()
+        self.timings[name] = self.timings.get(name, 0.0) + now - self._checkpoint
+        self._checkpoint = now
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._checkpoint = time.perf_counter()
+            self.timings[name] = self.timings.get(name, 0.0) + self._checkpoint - start
+
+    def finish(self, **stats):
+        """
+        Records the run in the page's history.
+
+        Args:
+            **stats: Extra counters to keep with the timings, e.g. cache statistics.
+
+        Returns:
+            dict: page, started_at, total seconds, seconds per phase and the extra counters.
+        """
+        global _last_record
+
+        record = {
+            'page': self.page,
+            'started_at': time.time(),
+            'total': time.perf_counter() - self.started,
+            'phases': dict(self.timings),
+            **stats
+        }
+        with _history_lock:
+            _history.setdefault(self.page, deque(maxlen=HISTORY_SIZE)).append(record)
+            _last_record = record
+
+        phases = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in record['phases'].items())
+        logger.info(f'{self.page} ran in {record["total"]:.3f}s ({phases})')
+        return record
+
+
+def page_profiler(page):
+    """
+    Starts profiling a page run; call at the very top of the page, before its imports.
+    """
+    return PageProfiler(page)
+
+
+def page_history(page):
+    with _history_lock:
+        return list(_history.get(page, []))
+
+
+def last_record():
+    with _history_lock:
+        return _last_record
+
+
+def render_profile(record):
+    """
+    Shows the run's timings, the page's recent runs and the extra counters in an expander.
+
+    Only renders when profiling is enabled for the process or the session (?profile=1).
+    """
+    import streamlit as st
+    import pandas as pd
+
+    if not (PROFILE_ENABLED or st.query_params.get('profile') == '1'):
+        return
+
+    with st.expander('Startup profile'):
+        st.write(f'Total: **{record["total"]:.3f}s**')
+        st.table(pd.DataFrame({'seconds': record['phases']}).round(3))
+
+        history = page_history(record['page'])
+        if len(history) > 1:
+            st.write('Recent runs')
+            st.dataframe(pd.DataFrame([{'total': run['total'], **run['phases']} for run in history]).round(3))
+
+        for name, value in record.items():
+            if isinstance(value, dict) and name != 'phases':
+                st.write(name)
+                st.json(value)
+
+
+def compare_to_baseline(results, baseline, threshold=REGRESSION_THRESHOLD, min_seconds=MIN_REGRESSION_SECONDS):
+    """
+    Lists the phases that got slower than in a baseline run.
+
+    Args:
+        results (dict): Page to {'cold': record, 'warm': record}, see profile_pages.
+        baseline (dict): Earlier results in the same format.
+        threshold (float, optional): Relative slowdown that counts as a regression.
+        min_seconds (float, optional): Absolute slowdown that counts as a regression.
+
+    Returns:
+        list: (page, run, phase, baseline seconds, seconds) for every regression.
+    """
+    regressions = []
+    for page, runs in results.items():
+        for run, record in runs.items():
+            previous = baseline.get(page, {}).get(run)
+            if previous is None:
+                continue
+            timings = {'total': record['total'], **record['phases']}
+            previous_timings = {'total': previous['total'], **previous['phases']}
+            for phase, seconds in timings.items():
+                before = previous_timings.get(phase)
+                if before is not None and seconds > before * (1 + threshold) and seconds - before >= min_seconds:
+                    regressions.append((page, run, phase, before, seconds))
+    return regressions
+
+
+def _profile_page(path):
+    # Runs in a fresh interpreter so the first run pays the page's real import cost
+    from streamlit.testing.v1 import AppTest
+    # The pages record into the imported module, not into this script's __main__
+    import startup_profiler
+
+    results = {}
+    app = AppTest.from_file(os.path.abspath(path), default_timeout=600)
+    for run in ['cold', 'warm']:
+        app.run()
+        if app.exception:
+            raise RuntimeError(f'{path} raised {[exception.value for exception in app.exception]}')
+        results[run] = startup_profiler.last_record()
+    return results
+
+
+def profile_pages(paths):
+    """
+    Measures a cold run and a warm rerun of each page, each page in its own process.
+
+    Returns:
+        dict: Page path to {'cold': record, 'warm': record}.
+    """
+    import subprocess
+
+    results = {}
+    for path in paths:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', path],
+                                capture_output=True, text=True, check=True).stdout
+        results[path] = json.loads(output.strip().splitlines()[-1])
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Time the startup phases of the dashboard pages')
+    parser.add_argument('pages', nargs='*', default=['pages/1_Price_Prediction.py', 'pages/2_Model_Results.py',
+                                                     'pages/3_Market_Analysis.py'])
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Results of an earlier run to report regressions against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(_profile_page(args.child)))
+        sys.exit(0)
+
+    results = profile_pages(args.pages)
+    for path, runs in results.items():
+        for run, record in runs.items():
+            phases = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in record['phases'].items())
+            print(f'{path} {run}: {record["total"]:.3f}s ({phases})')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.threshold)
+        for page, run, phase, before, seconds in regressions:
+            print(f'REGRESSION {page} {run} {phase}: {before:.3f}s -> {seconds:.3f}s')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,120 @@
+import glob
+import re
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from helper_functions import bulk_write_to_snowflake
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def execute(self, sql):
+        sql = ' '.join(sql.split())
+        self.conn.statements.append(sql)
+        self._rows = []
+        if sql.startswith('PUT '):
+            # Read the staged files back while they still exist
+            pattern = re.match(r"PUT 'file://(.+?)'", sql).group(1)
+            paths = sorted(glob.glob(pattern))
+            self.conn.staged = pd.concat([pq.read_table(path).to_pandas() for path in paths], ignore_index=True)
+            self.conn.staged_files = len(paths)
+            self._rows = [(path, path, 100, 100, 'NONE', 'NONE', 'UPLOADED', '') for path in paths]
+        elif sql.startswith('COPY INTO '):
+            self._rows = [('file', 'LOADED', len(self.conn.staged), len(self.conn.staged))]
+        elif sql.startswith('MERGE INTO '):
+            self._rows = [(1, 2)]
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.staged = None
+        self.staged_files = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+@pytest.fixture
+def scores():
+    return pd.DataFrame({'ID': [1, 2, 3, 4, 5], 'SENTIMENT_SCORE': [0.1, -0.2, 0.3, 0.0, 0.5],
+                         'SENTIMENT': ['positive', 'negative', 'positive', 'neutral', 'positive']})
+
+
+def test_append_puts_chunks_and_copies_into_table(scores, tmp_path):
+    conn = FakeConnection()
+    stats = bulk_write_to_snowflake(scores, conn, 'feature_store', 'scores', chunk_rows=2, staging_dir=str(tmp_path))
+
+    create, create_stage, put, copy, drop_stage = conn.statements
+    assert create.startswith('CREATE TABLE IF NOT EXISTS "FEATURE_STORE"."SCORES" ("ID" NUMBER(38, 0), '
+                             '"SENTIMENT_SCORE" FLOAT, "SENTIMENT" TEXT)')
+    stage = re.match(r'CREATE TEMPORARY STAGE ("FEATURE_STORE"\."SCORES_STAGE_\w+") FILE_FORMAT = \(TYPE = PARQUET\)',
+                     create_stage).group(1)
+    assert put.endswith(f'@{stage} PARALLEL = 8 AUTO_COMPRESS = FALSE')
+    assert copy == (f'COPY INTO "FEATURE_STORE"."SCORES" FROM @{stage} '
+                    'MATCH_BY_COLUMN_NAME = CASE_SENSITIVE PURGE = TRUE ON_ERROR = ABORT_STATEMENT')
+    assert drop_stage == f'DROP STAGE IF EXISTS {stage}'
+
+    assert conn.staged_files == 3
+    pd.testing.assert_frame_equal(conn.staged, scores)
+    assert stats['rows'] == 5 and stats['chunks'] == 3 and stats['copy']['rows'] == 5
+
+
+def test_overwrite_replaces_table(scores):
+    conn = FakeConnection()
+    bulk_write_to_snowflake(scores, conn, 'feature_store', 'scores', overwrite_table=True)
+
+    assert conn.statements[0].startswith('CREATE OR REPLACE TABLE "FEATURE_STORE"."SCORES" (')
+    assert conn.staged_files == 1
+
+
+def test_merge_copies_into_temporary_table_and_merges(scores):
+    conn = FakeConnection()
+    stats = bulk_write_to_snowflake(scores, conn, 'feature_store', 'scores', merge_keys=['ID'], overwrite_table=True)
+
+    create, create_stage, put, create_temp, copy, merge, drop_temp, drop_stage = conn.statements
+    assert create.startswith('CREATE TABLE IF NOT EXISTS "FEATURE_STORE"."SCORES" (')
+    temp = re.match(r'CREATE TEMPORARY TABLE ("FEATURE_STORE"\."SCORES_MERGE_\w+") LIKE "FEATURE_STORE"\."SCORES"',
+                    create_temp).group(1)
+    assert copy.startswith(f'COPY INTO {temp} FROM @')
+    assert merge == (f'MERGE INTO "FEATURE_STORE"."SCORES" t USING {temp} s ON t."ID" = s."ID" '
+                     'WHEN MATCHED THEN UPDATE SET t."SENTIMENT_SCORE" = s."SENTIMENT_SCORE", '
+                     't."SENTIMENT" = s."SENTIMENT" '
+                     'WHEN NOT MATCHED THEN INSERT ("ID", "SENTIMENT_SCORE", "SENTIMENT") '
+                     'VALUES (s."ID", s."SENTIMENT_SCORE", s."SENTIMENT")')
+    assert drop_temp == f'DROP TABLE IF EXISTS {temp}'
+    assert drop_stage.startswith('DROP STAGE IF EXISTS ')
+    assert stats['merge']['inserted'] == 1 and stats['merge']['updated'] == 2
+
+
+def test_merge_rejects_duplicate_keys(scores):
+    conn = FakeConnection()
+    with pytest.raises(ValueError):
+        bulk_write_to_snowflake(pd.concat([scores, scores.head(1)]), conn, 'feature_store', 'scores', merge_keys=['ID'])
+    assert conn.statements == []
+
+
+def test_stage_is_dropped_when_copy_fails(scores):
+    conn = FakeConnection()
+
+    class FailingCursor(FakeCursor):
+        def execute(self, sql):
+            super().execute(sql)
+            if sql.startswith('COPY INTO '):
+                raise RuntimeError('copy failed')
+
+    conn.cursor = lambda: FailingCursor(conn)
+    with pytest.raises(RuntimeError):
+        bulk_write_to_snowflake(scores, conn, 'feature_store', 'scores')
+    assert conn.statements[-1].startswith('DROP STAGE IF EXISTS ')
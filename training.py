@@ -0,0 +1,428 @@
+## this file contains the H3 model training with cached fold matrices and a successive halving search
+import os
+import json
+import math
+import time
+import logging
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from s3_loader import CACHE_DIR
+from market_index import MEDIAN_COLUMNS
+from hexagon_features import group_medians
+
+logger = logging.getLogger(__name__)
+
+EXPERIMENT_LOG = os.path.join('Model', 'experiment_log.json')
+TRAINING_CACHE_DIR = os.path.join(CACHE_DIR, 'training')
+
+# Features of the H3 model, as in Model/H3_Model_Development.ipynb
+CATEGORICAL_FEATURES = ['market', 'room_type']
+NUMERICAL_FEATURES = ['accommodates', 'bathrooms', 'beds'] + MEDIAN_COLUMNS
+
+# Search space of the notebook's RandomizedSearchCV
+PARAM_DISTRIBUTIONS = {
+    'n_estimators': [50, 100, 150, 200],
+    'max_depth': [None, 10, 20, 30, 40],
+    'min_samples_split': [2, 5, 10, 15],
+    'min_samples_leaf': [1, 2, 4, 6]
+}
+
+# Each halving round keeps 1/FACTOR of the candidates and gives them FACTOR times the rows
+HALVING_FACTOR = 3
+
+# Fewest training rows a candidate is fitted on in the first round
+MIN_ROWS = 2000
+
+# Bump when the fold matrices change layout so older caches are not reused
+FOLD_CACHE_VERSION = 1
+
+
+def split_listings(listings, train_size=0.8, random_state=42):
+    """
+    Splits listings_cleaned_h3 into train and test sets like the notebook.
+
+    The stored hexagon medians and coordinates are dropped; medians are recomputed from the
+    training rows only, see hexagon_medians.
+
+    Returns:
+        tuple: X_train, X_test, y_train, y_test; X keeps h3_index.
+    """
+    from sklearn.model_selection import train_test_split
+
+    X = listings.drop(columns=['price', 'latitude', 'longitude'] + MEDIAN_COLUMNS, errors='ignore')
+    y = listings['price']
+    return train_test_split(X, y, train_size=train_size, random_state=random_state)
+
+
+def hexagon_medians(X, y):
+    """
+    Medians of accommodates, bathrooms, beds and price per hexagon of the given rows.
+
+    Returns:
+        pd.DataFrame: MEDIAN_COLUMNS indexed by h3_index.
+    """
+    codes, cells = pd.factorize(X['h3_index'])
+    values = np.column_stack([X['accommodates'], X['bathrooms'], X['beds'], y]).astype(float)
+    first_rows, _, medians = group_medians([codes], values)
+    return pd.DataFrame(medians, columns=MEDIAN_COLUMNS, index=pd.Index(cells[codes[first_rows]], name='h3_index'))
+
+
+def add_hexagon_medians(X, medians):
+    """
+    Joins hexagon medians to rows by h3_index and drops h3_index; hexagons without medians get NaN.
+    """
+    rows = medians.index.get_indexer(X['h3_index'])
+    joined = X.drop(columns=['h3_index'] + [column for column in MEDIAN_COLUMNS if column in X.columns])
+    values = np.where((rows >= 0)[:, None], medians.to_numpy()[rows], np.nan)
+    for i, column in enumerate(MEDIAN_COLUMNS):
+        joined[column] = values[:, i]
+    return joined
+
+
+def build_preprocessor():
+    from sklearn.compose import ColumnTransformer
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    return ColumnTransformer(transformers=[
+        ('num', StandardScaler(), NUMERICAL_FEATURES),
+        ('cat', OneHotEncoder(), CATEGORICAL_FEATURES)
+    ])
+
+
+def _fold_matrix(preprocessor, X):
+    matrix = preprocessor.transform(X)
+    matrix = matrix.toarray() if hasattr(matrix, 'toarray') else matrix
+    # The forest converts its input to float32, so store it that way once
+    return np.ascontiguousarray(matrix, dtype=np.float32)
+
+
+def build_fold_matrices(X, y, n_splits=5, random_state=42, cache_dir=TRAINING_CACHE_DIR):
+    """
+    Transforms every cross-validation fold once and caches the matrices on disk.
+
+    For each fold the hexagon medians are computed from the fold's training rows and the
+    preprocessor is fitted on them, so validation prices never leak into the features. The
+    matrices are saved as .npy files in a directory named after a hash of the data and the
+    settings, so later searches on the same data skip this step and every worker process
+    memory-maps the same files. Training rows are stored shuffled, so their first n rows
+    are a random sample.
+
+    Args:
+        X (pd.DataFrame): Training listings with h3_index, see split_listings.
+        y (pd.Series): Training prices.
+        n_splits (int, optional): Folds.
+        random_state (int, optional): Seed of the fold split and the shuffle.
+        cache_dir (str, optional): Directory holding the cached folds.
+
+    Returns:
+        str: Directory with fold<i>_X_train.npy, fold<i>_y_train.npy, fold<i>_X_val.npy and fold<i>_y_val.npy.
+    """
+    import joblib
+    from sklearn.model_selection import KFold
+
+    key = joblib.hash((X, y, n_splits, random_state, NUMERICAL_FEATURES, CATEGORICAL_FEATURES, FOLD_CACHE_VERSION))
+    fold_dir = os.path.join(cache_dir, key)
+    done_path = os.path.join(fold_dir, 'folds.json')
+    if os.path.exists(done_path):
+        logger.info(f'Using cached fold matrices in {fold_dir}')
+        return fold_dir
+
+    tmp_dir = f'{fold_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    rng = np.random.default_rng(random_state)
+    y = np.asarray(y, dtype=float)
+
+    for fold, (train_rows, val_rows) in enumerate(KFold(n_splits, shuffle=True, random_state=random_state).split(X)):
+        train_rows = rng.permutation(train_rows)
+        medians = hexagon_medians(X.iloc[train_rows], y[train_rows])
+        X_train = add_hexagon_medians(X.iloc[train_rows], medians)
+        X_val = add_hexagon_medians(X.iloc[val_rows], medians)
+
+        preprocessor = build_preprocessor().fit(X_train)
+        np.save(os.path.join(tmp_dir, f'fold{fold}_X_train.npy'), _fold_matrix(preprocessor, X_train))
+        np.save(os.path.join(tmp_dir, f'fold{fold}_y_train.npy'), y[train_rows])
+        np.save(os.path.join(tmp_dir, f'fold{fold}_X_val.npy'), _fold_matrix(preprocessor, X_val))
+        np.save(os.path.join(tmp_dir, f'fold{fold}_y_val.npy'), y[val_rows])
+
+    with open(os.path.join(tmp_dir, 'folds.json'), 'w') as f:
+        json.dump({'n_splits': n_splits, 'random_state': random_state, 'rows': len(X)}, f)
+    try:
+        os.replace(tmp_dir, fold_dir)
+    except OSError:
+        # Another process cached the same folds first
+        import shutil
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return fold_dir
+
+
+def load_fold_matrices(fold_dir):
+    """
+    Memory-maps cached folds.
+
+    Returns:
+        list: (X_train, y_train, X_val, y_val) per fold.
+    """
+    with open(os.path.join(fold_dir, 'folds.json')) as f:
+        n_splits = json.load(f)['n_splits']
+    return [tuple(np.load(os.path.join(fold_dir, f'fold{fold}_{name}.npy'), mmap_mode='r')
+                  for name in ['X_train', 'y_train', 'X_val', 'y_val'])
+            for fold in range(n_splits)]
+
+
+_worker_folds = None
+
+
+def _init_worker(fold_dir):
+    global _worker_folds
+    _worker_folds = load_fold_matrices(fold_dir)
+
+
+def _evaluate(candidate, params, fold, n_rows, random_state):
+    # Runs in a worker: fit on the first n_rows of the fold's (shuffled) training rows, score on its validation rows
+    from sklearn.ensemble import RandomForestRegressor
+
+    X_train, y_train, X_val, y_val = _worker_folds[fold]
+    model = RandomForestRegressor(**params, random_state=random_state, n_jobs=1)
+
+    start = time.perf_counter()
+    model.fit(X_train[:n_rows], y_train[:n_rows])
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    errors = np.asarray(y_val) - model.predict(X_val)
+    predict_seconds = time.perf_counter() - start
+
+    return {
+        'candidate': candidate,
+        'fold': fold,
+        'mae': float(np.mean(np.abs(errors))),
+        'rmse': float(np.sqrt(np.mean(errors ** 2))),
+        'fit_seconds': fit_seconds,
+        'predict_seconds': predict_seconds
+    }
+
+
+def successive_halving_search(fold_dir, n_candidates=10, factor=HALVING_FACTOR, min_rows=MIN_ROWS, processes=None,
+                              param_distributions=PARAM_DISTRIBUTIONS, random_state=42):
+    """
+    Searches random forest parameters on cached folds, dropping weak candidates early.
+
+    Candidates are sampled like RandomizedSearchCV. In the first round each is fitted on a
+    sample of every fold's training rows; only the best 1/factor by mean validation MAE go on
+    to the next round with factor times the rows, until the last candidates use all rows. Every
+    (candidate, fold) fit of a round runs in a process pool whose workers memory-map the folds.
+
+    Args:
+        fold_dir (str): Cached folds, see build_fold_matrices.
+        n_candidates (int, optional): Parameter combinations sampled.
+        factor (int, optional): Candidates kept per round are divided, and rows multiplied, by this.
+        min_rows (int, optional): Fewest training rows per fit in the first round.
+        processes (int, optional): Worker processes. Defaults to the number of CPUs.
+        param_distributions (dict, optional): RandomForestRegressor parameter to candidate values.
+        random_state (int, optional): Seed of the sampling and the forests.
+
+    Returns:
+        tuple: Result of the best candidate in the last round and one result per candidate and
+        round (params, round, rows, cv_mae_mean/std, cv_rmse_mean/std, fit_seconds,
+        predict_seconds), in the order evaluated.
+    """
+    from sklearn.model_selection import ParameterSampler
+
+    folds = load_fold_matrices(fold_dir)
+    max_rows = min(len(fold[0]) for fold in folds)
+    candidates = list(ParameterSampler(param_distributions, n_candidates, random_state=random_state))
+
+    rounds = max(math.ceil(math.log(len(candidates), factor)), 1) if len(candidates) > 1 else 1
+    remaining = list(range(len(candidates)))
+    results = []
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(fold_dir,)) as executor:
+        for search_round in range(rounds):
+            n_rows = max_rows if search_round == rounds - 1 else \
+                min(max(max_rows // factor ** (rounds - 1 - search_round), min_rows), max_rows)
+            round_start = time.perf_counter()
+
+            futures = [executor.submit(_evaluate, candidate, candidates[candidate], fold, n_rows, random_state)
+                       for candidate in remaining for fold in range(len(folds))]
+            scores = {}
+            for future in futures:
+                score = future.result()
+                scores.setdefault(score['candidate'], []).append(score)
+
+            round_results = []
+            for candidate in remaining:
+                fold_scores = scores[candidate]
+                mae = [score['mae'] for score in fold_scores]
+                rmse = [score['rmse'] for score in fold_scores]
+                result = {
+                    'params': candidates[candidate],
+                    'round': search_round,
+                    'rows': n_rows,
+                    'cv_mae_mean': float(np.mean(mae)),
+                    'cv_mae_std': float(np.std(mae)),
+                    'cv_rmse_mean': float(np.mean(rmse)),
+                    'cv_rmse_std': float(np.std(rmse)),
+                    'fit_seconds': sum(score['fit_seconds'] for score in fold_scores),
+                    'predict_seconds': sum(score['predict_seconds'] for score in fold_scores)
+                }
+                round_results.append((candidate, result))
+                logger.info(f'Round {search_round} ({n_rows} rows) {candidates[candidate]}: '
+                            f'MAE {result["cv_mae_mean"]:.2f}, fit {result["fit_seconds"]:.1f}s')
+            results.extend(result for _, result in round_results)
+
+            print(f'Round {search_round}: {len(remaining)} candidates on {n_rows} rows per fold '
+                  f'in {time.perf_counter() - round_start:.1f}s')
+
+            ranked = sorted(round_results, key=lambda item: item[1]['cv_mae_mean'])
+            remaining = [candidate for candidate, _ in ranked[:max(math.ceil(len(ranked) / factor), 1)]]
+
+    best = min((result for result in results if result['round'] == rounds - 1), key=lambda result: result['cv_mae_mean'])
+    return best, results
+
+
+def log_to_file(log_file, params, metrics, training_details):
+    """
+    Appends an entry to the experiment log read by the Model Results page.
+    """
+    try:
+        with open(log_file, 'r') as f:
+            logs = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        logs = []
+
+    logs.append({
+        'params': params,
+        'metrics': metrics,
+        'training_details': training_details
+    })
+
+    with open(log_file, 'w') as f:
+        json.dump(logs, f, indent=4)
+
+
+def train_h3_model(listings, n_candidates=10, n_splits=5, factor=HALVING_FACTOR, min_rows=MIN_ROWS, processes=None,
+                   random_state=42, log_file=EXPERIMENT_LOG, cache_dir=TRAINING_CACHE_DIR):
+    """
+    Searches parameters, refits the best H3 pipeline on all training rows and logs the experiment.
+
+    Args:
+        listings (pd.DataFrame): listings_cleaned_h3.
+        n_candidates (int, optional): Parameter combinations sampled.
+        n_splits (int, optional): Cross-validation folds.
+        factor (int, optional): See successive_halving_search.
+        min_rows (int, optional): See successive_halving_search.
+        processes (int, optional): Worker processes.
+        random_state (int, optional): Seed of the split, folds, sampling and forests.
+        log_file (str, optional): Experiment log to append to; None skips logging.
+        cache_dir (str, optional): Directory holding cached folds.
+
+    Returns:
+        tuple: Fitted sklearn Pipeline (preprocessor and model, as served by the dashboard) and the log entry.
+    """
+    from sklearn.pipeline import Pipeline
+    from sklearn.ensemble import RandomForestRegressor
+
+    start_time = datetime.now()
+    X_train, X_test, y_train, y_test = split_listings(listings, random_state=random_state)
+
+    start = time.perf_counter()
+    fold_dir = build_fold_matrices(X_train, y_train, n_splits, random_state, cache_dir)
+    fold_seconds = time.perf_counter() - start
+    print(f'Fold matrices ready in {fold_seconds:.1f}s')
+
+    search_start = time.perf_counter()
+    best, results = successive_halving_search(fold_dir, n_candidates, factor, min_rows, processes,
+                                                     random_state=random_state)
+    search_seconds = time.perf_counter() - search_start
+    best_params = best['params']
+    print(f'Best parameters found: {best_params} ({search_seconds:.1f}s search)')
+
+    # Refit on every training row, with medians from all of them, like the notebook
+    medians = hexagon_medians(X_train, y_train)
+    pipeline = Pipeline(steps=[
+        ('preprocessor', build_preprocessor()),
+        ('model', RandomForestRegressor(**best_params, random_state=random_state, n_jobs=processes or -1))
+    ])
+    pipeline.fit(add_hexagon_medians(X_train, medians), y_train)
+
+    errors = np.asarray(y_test, dtype=float) - pipeline.predict(add_hexagon_medians(X_test, medians))
+
+    params = {
+        'model_type': 'RandomForestRegressor',
+        **best_params,
+        'random_state': random_state,
+        'numerical_features': NUMERICAL_FEATURES,
+        'categorical_features': CATEGORICAL_FEATURES,
+        'best_params': {f'model__{name}': value for name, value in best_params.items()}
+    }
+    metrics = {
+        'cv_mae_mean': best['cv_mae_mean'],
+        'cv_rmse_mean': best['cv_rmse_mean'],
+        'cv_mae_std': best['cv_mae_std'],
+        'cv_rmse_std': best['cv_rmse_std'],
+        'test_mae': float(np.mean(np.abs(errors))),
+        'test_rmse': float(np.sqrt(np.mean(errors ** 2)))
+    }
+    training_details = {
+        'train_size': len(X_train),
+        'test_size': len(X_test),
+        'train_duration': str(datetime.now() - start_time),
+        'search': {
+            'method': 'successive_halving',
+            'folds': n_splits,
+            'factor': factor,
+            'fold_cache_seconds': fold_seconds,
+            'search_seconds': search_seconds,
+            'candidates': results
+        }
+    }
+
+    if log_file:
+        log_to_file(log_file, params, metrics, training_details)
+    print(f"Mean Absolute Error: {metrics['test_mae']:.2f}")
+    print(f"Root Mean Squared Error: {metrics['test_rmse']:.2f}")
+    return pipeline, {'params': params, 'metrics': metrics, 'training_details': training_details}
+
+
+if __name__ == '__main__':
+    import argparse
+    import joblib
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Train the H3 model with a successive halving search on cached folds')
+    parser.add_argument('--listings', help='Parquet or CSV export of listings_cleaned_h3; read from Snowflake when omitted')
+    parser.add_argument('--candidates', type=int, default=10)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--factor', type=int, default=HALVING_FACTOR)
+    parser.add_argument('--min-rows', type=int, default=MIN_ROWS)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--log-file', default=EXPERIMENT_LOG)
+    parser.add_argument('--output', default='model_h3.joblib')
+    parser.add_argument('--upload', action='store_true', help='Upload the model and the experiment log to S3')
+    args = parser.parse_args()
+
+    if args.listings:
+        listings = pd.read_parquet(args.listings) if args.listings.endswith('.parquet') else pd.read_csv(args.listings)
+    else:
+        from helper_functions import connect_to_snowflake, get_data
+        conn = connect_to_snowflake(schema_name='FEATURE_STORE')
+        listings = get_data('select * from listings_cleaned_h3', conn)
+        conn.close()
+
+    pipeline, _ = train_h3_model(listings, args.candidates, args.folds, args.factor, args.min_rows, args.processes,
+                                 log_file=args.log_file)
+    joblib.dump(pipeline, args.output)
+    print(f'Model written to {args.output}')
+
+    if args.upload:
+        from s3_loader import BUCKET_NAME, get_s3_client
+        from prediction_cache import MODEL_KEY
+        client = get_s3_client()
+        client.upload_file(args.output, BUCKET_NAME, MODEL_KEY)
+        client.upload_file(args.log_file, BUCKET_NAME, 'models/experiment_log.json')
+        print(f'Model and experiment log uploaded to s3://{BUCKET_NAME}/models/')